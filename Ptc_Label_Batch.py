@@ -0,0 +1,554 @@
+# -*- coding: utf-8 -*-
+"""
+Batch processing of point cloud folders for the Point Cloud Label Changer.
+
+@author: kenneyke
+"""
+
+import contextlib
+import multiprocessing
+import os
+import time
+from dataclasses import dataclass
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import laspy
+
+from Ptc_Label_Engine import (LabelRemapper, OperationCancelled, DEFAULT_CHUNK_SIZE, copy_file_fast, output_extension,
+                              partial_output_path, patch_las_file, preview_histogram, relabel_file_streaming,
+                              scan_label_histogram)
+from Ptc_Label_Discovery import read_header_summary
+from Ptc_Label_Governor import MemoryGovernor, file_memory
+from Ptc_Label_Journal import file_fingerprint, settings_digest
+from Ptc_Label_Pipeline import DEFAULT_PIPELINE_MEMORY, RelabelPipeline
+from Ptc_Label_Profiler import StageTimer, file_size, timed
+from Ptc_Label_Rules import RuleError
+
+# What to do with files the label mapping does not change
+UNAFFECTED_MODES = ("copy", "skip", "rewrite")
+
+# Leave one core for the GUI / OS by default
+DEFAULT_WORKERS = max(1, (os.cpu_count() or 1) - 1)
+
+# How often the pool loop checks for a cancel while files are running
+CANCEL_POLL_SECONDS = 0.2
+
+
+def updated_output_path(input_path, output_dir=None, extension=".laz", input_root=None):
+    # <name>_updated.laz next to the input, or inside output_dir when given (in the
+    # input's subfolder relative to input_root, so tiles of a recursive run never collide)
+    base_path, _ = os.path.splitext(input_path)
+    if output_dir:
+        relative_path = os.path.relpath(base_path, input_root) if input_root else os.path.basename(base_path)
+        base_path = os.path.join(output_dir, relative_path)
+    return f"{base_path}_updated{extension}"
+
+
+def is_las_file(file_path):
+    return os.path.splitext(file_path)[1].lower() == ".las"
+
+
+def layout_formats(headers):
+    # (path, point format) of one readable file per point layout; files with the same
+    # point format and record length share a layout, unreadable ones are left out
+    checked = set()
+    for file_path, header in headers.items():
+        layout = tuple(header[3:5])
+        if layout in checked or header[1] is None:
+            continue
+        try:
+            with laspy.open(file_path) as reader:
+                point_format = reader.header.point_format
+        except Exception:
+            continue
+        checked.add(layout)
+        yield file_path, point_format
+
+
+def check_rules(rules, headers):
+    """Validate ``rules`` on one file of every point layout before a batch runs.
+
+    ``headers`` is {path: header summary} as from ``read_header_summary``;
+    only one header per layout is opened. A rule that cannot run on a
+    layout (unknown dimension, value outside its field) raises ``RuleError``
+    naming the file, before any output is written. Unreadable files are left
+    to fail on their own.
+    """
+    for file_path, point_format in layout_formats(headers):
+        try:
+            rules.validate(point_format)
+        except RuleError as e:
+            raise RuleError(f"{os.path.basename(file_path)}: {e}") from None
+
+
+def check_mapping(remapper, dimension, headers):
+    # ValueError naming the first file whose label field is missing or cannot hold
+    # every new label of ``remapper``, checked once per point layout like check_rules.
+    # The field's own range counts, e.g. 0 to 31 for the 5-bit classification of formats 0-5
+    for file_path, point_format in layout_formats(headers):
+        try:
+            info = point_format.dimension_by_name(dimension)
+        except ValueError as e:
+            raise ValueError(f"{os.path.basename(file_path)}: {e}") from None
+        bad = remapper.values[(remapper.values < info.min) | (remapper.values > info.max)]
+        if bad.size:
+            raise ValueError(f"{os.path.basename(file_path)}: New label {bad[0]} does not fit the {dimension} "
+                             f"field of point format {point_format.id} ({info.min} to {info.max}).")
+
+
+def relabel_one_file(input_path, output_path, remapper, dimension="Ext_Class",
+                     chunk_size=DEFAULT_CHUNK_SIZE, patch=False, backend=None, timing=False, rules=None,
+                     laz_chunk_size=None, unaffected=None, histogram=None, cancel_event=None):
+    # Worker entry point: never raises, errors are returned in the result.
+    # Setting ``cancel_event`` stops a streamed file between chunks, the
+    # result is then marked "cancelled" and its partial output removed.
+    # With ``unaffected`` ("copy" or "skip") the label histogram (``histogram``,
+    # or a label-only scan) is checked first and files the remap does not
+    # change are byte-copied or skipped instead of decoded and re-encoded.
+    start = time.perf_counter()
+    timer = StageTimer(input_path) if timing else None
+    result = {"input": input_path, "output": output_path, "points": 0, "seconds": 0.0, "error": None}
+    try:
+        if unaffected is not None:
+            if histogram is None:
+                histogram = result["histogram"] = scan_label_histogram(input_path, dimension, chunk_size, backend,
+                                                                       timer)
+            result["unchanged"] = not remapper.affects(histogram)
+        if result.get("unchanged") and os.path.abspath(output_path) == os.path.abspath(input_path):
+            # In place: the file already holds the right labels
+            result["points"] = sum(histogram.values())
+        elif result.get("unchanged") and unaffected == "skip":
+            result["output"] = None
+            result["points"] = sum(histogram.values())
+        elif result.get("unchanged") and os.path.splitext(output_path)[1].lower() == \
+                os.path.splitext(input_path)[1].lower():
+            with timed(timer, "copy", input_path, nbytes=file_size(input_path)):
+                result["copied"] = copy_file_fast(input_path, output_path)
+            result["points"] = sum(histogram.values())
+        elif patch:
+            result["points"] = patch_las_file(input_path, output_path, remapper, dimension, chunk_size, timer=timer)
+        else:
+            result["points"] = relabel_file_streaming(input_path, output_path, remapper, dimension, chunk_size,
+                                                      backend=backend, timer=timer, rules=rules,
+                                                      cancel_event=cancel_event, laz_chunk_size=laz_chunk_size)
+    except OperationCancelled:
+        result["cancelled"] = True
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    result["seconds"] = time.perf_counter() - start
+    if timer is not None:
+        # Stage records travel back to the parent process with the result
+        result["stages"] = list(timer.records.values())
+    return result
+
+
+@dataclass
+class BatchOptions:
+    """Settings of a ``run_batch`` run, built by the command line and the GUI.
+
+    ``output_format`` is "laz", "las" (no compression cost, for intermediate
+    results) or "keep" (same format as each input). ``unaffected`` is one of
+    ``UNAFFECTED_MODES``, ``memory_budget`` and ``memory_limit`` are in
+    bytes. See ``run_batch`` for how each setting is used.
+    """
+    workers: int = DEFAULT_WORKERS
+    output_dir: str = None
+    # Outputs in output_dir keep the inputs' subfolders below this folder
+    input_root: str = None
+    dimension: str = "Ext_Class"
+    chunk_size: int = DEFAULT_CHUNK_SIZE
+    # Patch uncompressed .las inputs through a memory map, into a copy or the input itself
+    patch_las: bool = False
+    in_place: bool = False
+    # LAZ codec of every worker and points per LAZ chunk of compressed outputs
+    backend: str = None
+    laz_chunk_size: int = None
+    output_format: str = "laz"
+    # A RuleSet applied in the same streaming pass
+    rules: object = None
+    pipeline: bool = True
+    memory_budget: int = DEFAULT_PIPELINE_MEMORY
+    unaffected: str = "copy"
+    memory_limit: int = None
+
+
+def run_batch(files, label_changes, options=None, progress=None, cancel_event=None, timer=None, journal=None,
+              label_cache=None, headers=None):
+    """Relabel ``files`` on a pool of worker processes.
+
+    ``label_changes`` is a list of (old, new) pairs or a ``LabelRemapper``
+    and ``options`` a ``BatchOptions`` (defaults when None). Files are
+    submitted largest first (by header point count) so a big tile does not
+    end up running alone at the end of the batch. As each file completes
+    ``progress(result, files_done, files_total, points_done, points_total)``
+    is called, and a ``timer`` collects the per-stage timings of every file.
+    Setting ``cancel_event`` drops the files that have not started yet and
+    stops streamed files at their next chunk. ``headers`` ({path:
+    (point_count, mins, maxs, record_length, point_format_id)}, e.g. from
+    ``discover_point_clouds``) saves reading the headers again. Returns a
+    summary dict with the per-file results and aggregate throughput.
+
+    Uncompressed .las inputs are patched through a memory map instead of
+    being rewritten when ``patch_las`` is set (into a ``_updated.las`` copy)
+    or ``in_place`` (the input itself is modified). With one worker and
+    ``pipeline`` set, the streamed files go through a ``RelabelPipeline``
+    that reads, remaps and writes on overlapping threads, holding at most
+    ``memory_budget`` bytes of point records in flight. A new label that
+    does not fit the label field of some layout raises ``ValueError`` before
+    any file is processed (see ``check_mapping``).
+
+    Memory governor: with a ``memory_limit`` (e.g. ``default_memory_limit()``)
+    a ``MemoryGovernor`` lowers the chunk size and worker count to fit the
+    files under it, and files only start when their estimated memory fits
+    next to the running ones.
+
+    Journal: with a ``journal`` (a ``BatchJournal``) files it lists as
+    finished with the same inputs and settings are not processed again, and
+    every file that completes is appended to it, so an interrupted batch
+    resumes where it stopped.
+
+    Unaffected files: files whose label histogram holds none of the labels
+    the mapping changes are not decoded at all when ``unaffected`` is "copy"
+    (the output is a byte copy, or a rewrite when the output format differs)
+    or "skip" (no output); "rewrite" processes every file. The histograms
+    come from ``label_cache`` (a ``LabelHistogramCache``) when it has them,
+    otherwise from a label-only scan whose result is cached.
+
+    Rules and regions: ``rules`` are validated on every point layout before
+    anything runs (see ``check_rules``). They need every dimension, so .las
+    inputs are streamed rather than patched and the unaffected-file check is
+    off. When the rules are all limited to regions and there is no label
+    mapping, files whose header bounds miss every region are skipped without
+    being opened for reading points (no output is written for them).
+    """
+    options = options or BatchOptions()
+    # The governor and the rules override these for this run
+    workers, chunk_size, patch_las, in_place = options.workers, options.chunk_size, options.patch_las, options.in_place
+
+    # A compiled remapper (e.g. from a cached mapping table) is used as is
+    remapper = label_changes if isinstance(label_changes, LabelRemapper) else LabelRemapper(label_changes)
+    if options.output_dir:
+        os.makedirs(options.output_dir, exist_ok=True)
+
+    sizes = {}
+    extents = {}
+    record_lengths = {}
+    summaries = {}
+    fingerprints = {}
+    headers = headers or {}
+    with timed(timer, "schedule"):
+        for file_path in files:
+            try:
+                header = headers.get(file_path)
+                if header is None or header[1] is None:
+                    header = read_header_summary(file_path)
+                summaries[file_path] = header
+                sizes[file_path], mins, maxs, record_lengths[file_path], _ = header
+                extents[file_path] = (mins, maxs)
+                if journal is not None:
+                    fingerprints[file_path] = file_fingerprint(file_path)
+            except Exception:
+                sizes[file_path] = 0
+        if options.rules:
+            check_rules(options.rules, summaries)
+        if remapper:
+            check_mapping(remapper, options.dimension, summaries)
+
+    # Region-limited rules only: tiles outside every rule's area are left alone
+    skipped = []
+    if options.rules and not remapper and options.rules.bounds() is not None:
+        skipped = [f for f in files if f in extents and not options.rules.touches(*extents[f])]
+        files = [f for f in files if f not in skipped]
+    ordered = sorted(files, key=lambda f: sizes[f], reverse=True)
+    if options.rules:
+        patch_las = in_place = False
+    jobs = []
+    for f in ordered:
+        if in_place and is_las_file(f):
+            jobs.append((f, f, True))
+        elif patch_las and is_las_file(f):
+            jobs.append((f, updated_output_path(f, options.output_dir, ".las", options.input_root), True))
+        else:
+            extension = output_extension(f, options.output_format)
+            jobs.append((f, updated_output_path(f, options.output_dir, extension, options.input_root), False))
+    if options.output_dir:
+        for directory in {os.path.dirname(output_path) for _, output_path, _ in jobs}:
+            os.makedirs(directory, exist_ok=True)
+
+    # Files finished by an earlier run with the same inputs and settings
+    resumed = []
+    if journal is not None:
+        settings = settings_digest(remapper.label_changes, options.rules, options.dimension)
+        for job in jobs:
+            entry = journal.completed(job[0], job[1], settings, fingerprints.get(job[0]))
+            if entry is not None:
+                resumed.append((job, entry))
+        done = {job for job, _ in resumed}
+        jobs = [job for job in jobs if job not in done]
+
+    # Histograms for the unaffected-file check, from the cache where possible
+    check = options.unaffected if options.unaffected != "rewrite" and not options.rules else None
+    histograms = {}
+    if check is not None and label_cache is not None:
+        with timed(timer, "label_cache"):
+            for input_path, _, _ in jobs:
+                try:
+                    histogram = label_cache.get(input_path, options.dimension)
+                except OSError:
+                    histogram = None
+                if histogram is not None:
+                    histograms[input_path] = histogram
+            label_cache.flush()
+
+    # Chunk size and workers that keep the batch under the memory ceiling
+    governor = MemoryGovernor(options.memory_limit)
+    requested = (workers, chunk_size)
+    workers, chunk_size = governor.plan([(sizes[input_path], record_lengths.get(input_path, 0))
+                                         for input_path, _, patch in jobs if not patch], workers, chunk_size)
+
+    files_total = len(jobs) + len(skipped) + len(resumed)
+    points_total = sum(sizes[f] for f in files)
+    start = time.perf_counter()
+    results = []
+
+    def finished(result):
+        if timer is not None:
+            timer.merge(result.pop("stages", []))
+        histogram = result.pop("histogram", None)
+        if histogram is not None and label_cache is not None and result["output"] != result["input"]:
+            label_cache.put(result["input"], histogram, options.dimension)
+        if journal is not None and result["error"] is None and result["output"] and not result.get("skipped") \
+                and not result.get("resumed"):
+            try:
+                journal.record(result, settings, fingerprints.get(result["input"]))
+            except OSError as e:
+                print(f"Journal write failed: {e}")
+        results.append(result)
+        if progress:
+            progress(result, len(results), files_total, sum(r["points"] for r in results), points_total)
+
+    for file_path in skipped:
+        finished({"input": file_path, "output": None, "points": 0, "seconds": 0.0, "error": None, "skipped": True})
+    for (input_path, output_path, _), entry in resumed:
+        finished({"input": input_path, "output": output_path, "points": entry["points"], "seconds": 0.0,
+                  "error": None, "resumed": True})
+
+    cancelled = False
+    if workers <= 1 or len(jobs) <= 1:
+        streamed = []
+        for input_path, output_path, patch in jobs:
+            if cancel_event is not None and cancel_event.is_set():
+                cancelled = True
+                break
+            if options.pipeline and not patch:
+                # Only files the mapping changes go through the pipeline
+                if check is None or not unaffected_file(input_path, remapper, histograms, options.dimension,
+                                                        chunk_size, options.backend, timer, label_cache):
+                    streamed.append((input_path, output_path))
+                    continue
+            result = relabel_one_file(input_path, output_path, remapper, options.dimension, chunk_size, patch,
+                                      options.backend, timer is not None, options.rules, options.laz_chunk_size,
+                                      check, histograms.get(input_path), cancel_event)
+            if result.get("cancelled"):
+                cancelled = True
+                break
+            finished(result)
+        if streamed and not cancelled:
+            chunk_bytes = chunk_size * max(record_lengths.get(input_path, 0) for input_path, _ in streamed)
+            relabel_pipeline = RelabelPipeline(remapper, options.dimension, chunk_size, options.backend, timer,
+                                               options.rules, options.laz_chunk_size,
+                                               governor.pipeline_budget(options.memory_budget, chunk_bytes))
+            for result in relabel_pipeline.run(streamed, cancel_event):
+                finished(result)
+            # The pipeline only leaves files out when it is cancelled
+            cancelled = len(results) < files_total
+    else:
+        # spawn (the Windows default) everywhere: forking after the LAZ backend
+        # has started its thread pool can deadlock the worker processes
+        pool_size = min(workers, len(jobs))
+        pending = list(jobs)
+        estimates = [file_memory(sizes[input_path], record_lengths.get(input_path, 0),
+                                 "copy" if input_path in histograms and not remapper.affects(histograms[input_path])
+                                 else "patch" if patch else "stream", chunk_size)
+                     for input_path, _, patch in jobs]
+        running = {}
+        context = multiprocessing.get_context("spawn")
+        with contextlib.ExitStack() as stack:
+            # Workers cannot see a threading.Event, they get a Manager event set alongside it
+            worker_cancel = stack.enter_context(context.Manager()).Event() if cancel_event is not None else None
+            executor = ProcessPoolExecutor(max_workers=pool_size, mp_context=context)
+            try:
+                while pending or running:
+                    # Start the largest files whose memory fits next to the running ones; a
+                    # file that does not fit yet waits while smaller ones go ahead of it
+                    while pending and len(running) < pool_size:
+                        index = governor.admit(estimates, [estimate for _, estimate, _ in running.values()],
+                                               pool_size)
+                        if index is None:
+                            break
+                        input_path, output_path, patch = job = pending.pop(index)
+                        arguments = (input_path, output_path, remapper, options.dimension, chunk_size, patch,
+                                     options.backend, timer is not None, options.rules, options.laz_chunk_size,
+                                     check, histograms.get(input_path), worker_cancel)
+                        try:
+                            future = executor.submit(relabel_one_file, *arguments)
+                        except BrokenProcessPool:
+                            # A worker died since the last wait, carry on with a fresh pool
+                            executor.shutdown(wait=False)
+                            executor = ProcessPoolExecutor(max_workers=pool_size, mp_context=context)
+                            future = executor.submit(relabel_one_file, *arguments)
+                        running[future] = (job, estimates.pop(index), executor)
+                    # Short timeout so a cancel is seen while long files are still running
+                    done, _ = wait(running, timeout=CANCEL_POLL_SECONDS, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        (input_path, output_path, _), _, pool = running.pop(future)
+                        try:
+                            result = future.result()
+                        except BrokenProcessPool as e:
+                            # A worker was killed (e.g. out of memory) and took the pool down with it:
+                            # the files it was running fail, the pending ones go to a fresh pool
+                            result = {"input": input_path, "output": output_path, "points": 0, "seconds": 0.0,
+                                      "error": f"{type(e).__name__}: {e}"}
+                            with contextlib.suppress(OSError):
+                                os.remove(partial_output_path(output_path))
+                            if pool is executor:
+                                executor.shutdown(wait=False)
+                                executor = ProcessPoolExecutor(max_workers=pool_size, mp_context=context)
+                        if not result.get("cancelled"):
+                            finished(result)
+                    if not cancelled and cancel_event is not None and cancel_event.is_set():
+                        # Running files stop at their next chunk, the rest are dropped
+                        worker_cancel.set()
+                        cancelled = True
+                        pending = []
+            finally:
+                executor.shutdown()
+    elapsed = time.perf_counter() - start
+
+    total_points = sum(r["points"] for r in results if r["error"] is None and not r.get("resumed"))
+    return {
+        "files": len(results),
+        "succeeded": sum(1 for r in results if r["error"] is None and not r.get("skipped") and not r.get("resumed")),
+        "skipped": len(skipped),
+        "resumed": len(resumed),
+        "unchanged": sum(1 for r in results if r.get("unchanged")),
+        "copied": sum(1 for r in results if r.get("copied")),
+        "failed": sum(1 for r in results if r["error"] is not None),
+        "points": total_points,
+        "seconds": elapsed,
+        "points_per_second": total_points / elapsed if elapsed > 0 else 0.0,
+        "workers": workers,
+        "chunk_size": chunk_size,
+        "memory_limit": options.memory_limit,
+        "throttled": workers < min(requested[0], len(jobs)) or chunk_size < requested[1],
+        "laz_backend": options.backend or "auto",
+        "output_format": options.output_format,
+        "cancelled": cancelled,
+        "results": results,
+    }
+
+
+def unaffected_file(file_path, remapper, histograms, dimension="Ext_Class", chunk_size=DEFAULT_CHUNK_SIZE,
+                    backend=None, timer=None, label_cache=None):
+    # True when the remap changes no point of the file, scanning (and caching) its labels if needed
+    if file_path not in histograms:
+        try:
+            histograms[file_path] = scan_label_histogram(file_path, dimension, chunk_size, backend, timer)
+        except Exception:
+            # Unreadable files go the normal way and fail there with their error
+            return False
+        if label_cache is not None:
+            label_cache.put(file_path, histograms[file_path], dimension)
+    return not remapper.affects(histograms[file_path])
+
+
+def preview_batch(files, label_changes, histogram=None, dimension="Ext_Class", chunk_size=DEFAULT_CHUNK_SIZE,
+                  progress=None, cancel_event=None, backend=None, timer=None):
+    """Dry run of ``label_changes`` over ``files``, nothing is written.
+
+    Each file's label histogram comes from ``histogram(file_path)`` (e.g. the
+    histogram cache) or a label-only scan, and the changes are replayed on
+    the counts. Returns the predicted before/after histograms, the points each
+    pair moves and, per file, how many points change; files with no changed
+    points would be rewritten unchanged.
+    """
+    remapper = label_changes if isinstance(label_changes, LabelRemapper) else LabelRemapper(label_changes)
+    label_changes = remapper.label_changes
+    before, after = {}, {}
+    rule_points = [0] * len(label_changes)
+    results = []
+    start = time.perf_counter()
+    for i, file_path in enumerate(files, start=1):
+        if cancel_event is not None and cancel_event.is_set():
+            raise OperationCancelled()
+        if histogram is not None:
+            file_histogram = histogram(file_path)
+        else:
+            file_histogram = scan_label_histogram(file_path, dimension, chunk_size, backend, timer)
+        file_after, file_rules = preview_histogram(file_histogram, label_changes)
+        for label, count in file_histogram.items():
+            before[label] = before.get(label, 0) + count
+        for label, count in file_after.items():
+            after[label] = after.get(label, 0) + count
+        rule_points = [total + moved for total, moved in zip(rule_points, file_rules)]
+        changed = sum(file_histogram.get(label, 0) for label in remapper.keys.tolist())
+        results.append({"input": file_path, "points": sum(file_histogram.values()), "points_changed": changed,
+                        "rule_points": file_rules})
+        if progress:
+            progress(i, len(files))
+
+    return {
+        "files": len(results),
+        "files_unchanged": sum(1 for r in results if r["points_changed"] == 0),
+        "points": sum(before.values()),
+        "points_changed": sum(r["points_changed"] for r in results),
+        "seconds": time.perf_counter() - start,
+        "before": dict(sorted(before.items())),
+        "after": dict(sorted(after.items())),
+        "rules": [{"old": old, "new": new, "points": moved}
+                  for (old, new), moved in zip(label_changes, rule_points)],
+        "results": results,
+    }
+
+
+def format_preview(preview, max_files=20):
+    lines = [f"{preview['points_changed']:,} of {preview['points']:,} points would change in "
+             f"{preview['files'] - preview['files_unchanged']} of {preview['files']} files "
+             f"({preview['seconds']:.1f} s, nothing written)"]
+    lines.append("Rules:")
+    for rule in preview["rules"]:
+        lines.append(f"  {rule['old']} -> {rule['new']}: {rule['points']:,} points")
+    lines.append("Labels (before -> after):")
+    for label in sorted(set(preview["before"]) | set(preview["after"])):
+        lines.append(f"  {label}: {preview['before'].get(label, 0):,} -> {preview['after'].get(label, 0):,}")
+    unchanged = [r for r in preview["results"] if r["points_changed"] == 0]
+    if unchanged:
+        lines.append(f"Unchanged files ({len(unchanged)}):")
+        lines.extend(f"  {os.path.basename(r['input'])}" for r in unchanged[:max_files])
+        if len(unchanged) > max_files:
+            lines.append(f"  ... and {len(unchanged) - max_files} more")
+    return "\n".join(lines)
+
+
+def format_batch_summary(summary):
+    lines = [f"{summary['succeeded']} of {summary['files']} files relabeled in {summary['seconds']:.1f} s "
+             f"({summary['points_per_second'] / 1e6:.2f} M points/s, {summary['workers']} workers)"]
+    if summary.get("throttled"):
+        lines.append(f"Memory limit {summary['memory_limit'] / 1024 ** 2:,.0f} MB: {summary['workers']} workers, "
+                     f"{summary['chunk_size']:,} points per chunk.")
+    if summary.get("skipped"):
+        lines.append(f"{summary['skipped']} files outside the rule regions were skipped.")
+    if summary.get("unchanged"):
+        lines.append(f"{summary['unchanged']} files hold none of the changed labels "
+                     f"({summary['copied']} copied without re-encoding).")
+    if summary.get("resumed"):
+        lines.append(f"{summary['resumed']} files finished by an earlier run were not processed again.")
+    if summary.get("pending"):
+        lines.append(f"{summary['pending']} files not processed yet ({summary['leased']} in progress).")
+    if summary["cancelled"]:
+        lines.append("Batch cancelled before all files were processed.")
+    for result in summary["results"]:
+        if result["error"] is not None:
+            lines.append(f"Failed: {os.path.basename(result['input'])}: {result['error']}")
+    return "\n".join(lines)
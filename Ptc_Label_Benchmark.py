@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+Kernel micro-benchmarks for the Point Cloud Label Changer.
+
+Generates a synthetic point cloud and times the hot kernels (label discovery,
+Ext_Class remap, read, write and end-to-end relabel). Writes are timed for
+LAS and for LAZ at each of ``--laz-chunk-sizes``, with the resulting file
+sizes, to weigh compression cost against disk use. Results are printed as
+JSON so runs can be compared over time, e.g.:
+
+    python Ptc_Label_Benchmark.py --points 5000000 --labels 40 --skew 1.2 --output bench.json
+
+@author: kenneyke
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+import laspy
+import numpy as np
+
+from Ptc_Label_Engine import (LabelRemapper, DEFAULT_CHUNK_SIZE, laz_backend, laz_backend_self_test,
+                              open_point_writer, relabel_file_streaming, scan_label_histogram)
+
+DEFAULT_LAZ_CHUNK_SIZES = (10_000, 50_000, 250_000)
+
+
+def synthetic_labels(point_count, label_count, skew=0.0, dtype=np.uint8, seed=0):
+    """Random labels drawn from ``label_count`` ids.
+
+    ``skew`` is a Zipf-like exponent: 0 gives uniform labels, larger values
+    concentrate the points on a few dominant labels like real classifications.
+    """
+    rng = np.random.default_rng(seed)
+    max_label = np.iinfo(dtype).max if np.issubdtype(dtype, np.integer) else 1 << 16
+    label_count = min(label_count, max_label + 1)
+    ids = np.sort(rng.choice(max_label + 1, size=label_count, replace=False)).astype(dtype)
+    weights = 1.0 / np.arange(1, label_count + 1) ** skew
+    return ids[rng.choice(label_count, size=point_count, p=weights / weights.sum())]
+
+
+def make_synthetic_point_cloud(file_path, point_count, label_count=20, skew=0.0, point_format=7,
+                               label_dtype=np.uint8, seed=0):
+    # Writes a LAS/LAZ file (by extension) with an Ext_Class extra bytes dimension
+    rng = np.random.default_rng(seed)
+    header = laspy.LasHeader(point_format=point_format, version="1.4" if point_format >= 6 else "1.2")
+    header.add_extra_dim(laspy.ExtraBytesParams(name="Ext_Class", type=label_dtype))
+    header.offsets = [0.0, 0.0, 0.0]
+    header.scales = [0.001, 0.001, 0.001]
+    las = laspy.LasData(header)
+    las.x = rng.uniform(0, 1000, point_count)
+    las.y = rng.uniform(0, 1000, point_count)
+    las.z = rng.uniform(0, 50, point_count)
+    las.intensity = rng.integers(0, 65535, point_count)
+    las.classification = rng.integers(0, 20, point_count)
+    if "gps_time" in las.point_format.dimension_names:
+        las.gps_time = np.sort(rng.uniform(0, 3600, point_count))
+    if "red" in las.point_format.dimension_names:
+        las.red = rng.integers(0, 65535, point_count)
+        las.green = rng.integers(0, 65535, point_count)
+        las.blue = rng.integers(0, 65535, point_count)
+    las.Ext_Class = synthetic_labels(point_count, label_count, skew, label_dtype, seed)
+    las.write(file_path)
+    return file_path
+
+
+def synthetic_mapping(labels, mapping_size, seed=0):
+    # (old, new) pairs over the labels present in the data plus unused ids
+    rng = np.random.default_rng(seed)
+    present = np.unique(labels)
+    info = np.iinfo(labels.dtype) if np.issubdtype(labels.dtype, np.integer) else np.iinfo(np.uint16)
+    olds = rng.choice(present, size=min(mapping_size, present.size), replace=False).tolist()
+    olds += rng.integers(info.min, info.max + 1, size=max(0, mapping_size - len(olds))).tolist()
+    news = rng.integers(info.min, info.max + 1, size=len(olds)).tolist()
+    return list(zip(olds, news))
+
+
+def remap_per_pair_mask(labels, label_changes):
+    # The pre-remapper kernel (one full mask per pair), kept as the baseline
+    for old_label, new_label in label_changes:
+        labels[labels == old_label] = new_label
+    return labels
+
+
+def change_label_in_memory(input_path, output_path, remapper, backend_value=None):
+    # What write_las does: full read, remap, full write
+    las = laspy.read(input_path, laz_backend=backend_value)
+    las.Ext_Class = remapper.apply(las.Ext_Class)
+    las.write(output_path, laz_backend=backend_value)
+
+
+def write_points(las, output_path, backend=None, laz_chunk_size=None):
+    with open_point_writer(output_path, las.header, backend, laz_chunk_size) as writer:
+        writer.write_points(las.points)
+
+
+def time_kernel(function, repeat):
+    # Best and median wall time over ``repeat`` runs
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return {"best_s": min(timings), "median_s": statistics.median(timings), "runs": repeat}
+
+
+def run_benchmarks(point_count=1_000_000, label_count=20, skew=0.0, point_format=7, label_dtype="uint8",
+                   mapping_size=50, repeat=3, backend=None, chunk_size=DEFAULT_CHUNK_SIZE, workdir=None, seed=0,
+                   laz_chunk_sizes=DEFAULT_LAZ_CHUNK_SIZES):
+    dtype = np.dtype(label_dtype)
+    with tempfile.TemporaryDirectory(dir=workdir) as tmp:
+        laz_path = make_synthetic_point_cloud(os.path.join(tmp, "synthetic.laz"), point_count, label_count,
+                                              skew, point_format, dtype, seed)
+        las_path = os.path.join(tmp, "synthetic.las")
+        las = laspy.read(laz_path)
+        las.write(las_path)
+
+        labels = np.asarray(las.Ext_Class).copy()
+        label_changes = synthetic_mapping(labels, mapping_size, seed)
+        remapper = LabelRemapper(label_changes)
+        backend_value = laz_backend(backend)
+
+        kernels = {
+            "label_discovery_laz": lambda: scan_label_histogram(laz_path, chunk_size=chunk_size, backend=backend),
+            "label_discovery_las": lambda: scan_label_histogram(las_path, chunk_size=chunk_size, backend=backend),
+            "remap_lookup_table": lambda: remapper.apply(labels),
+            "remap_per_pair_mask": lambda: remap_per_pair_mask(labels.copy(), label_changes),
+            "read_laz": lambda: laspy.read(laz_path, laz_backend=backend_value),
+            "read_las": lambda: laspy.read(las_path),
+            "write_laz": lambda: las.write(os.path.join(tmp, "write.laz"), laz_backend=backend_value),
+            "write_las": lambda: las.write(os.path.join(tmp, "write.las")),
+            "change_label_in_memory": lambda: change_label_in_memory(laz_path, os.path.join(tmp, "e2e.laz"),
+                                                                     remapper, backend_value),
+            "change_label_streaming": lambda: relabel_file_streaming(laz_path, os.path.join(tmp, "stream.laz"),
+                                                                     remapper, chunk_size=chunk_size,
+                                                                     backend=backend),
+            "change_label_streaming_to_las": lambda: relabel_file_streaming(laz_path, os.path.join(tmp, "stream.las"),
+                                                                            remapper, chunk_size=chunk_size,
+                                                                            backend=backend),
+        }
+        # Output options: uncompressed LAS and LAZ at each chunk size
+        output_paths = {"write_output_las": os.path.join(tmp, "output.las")}
+        for laz_chunk_size in laz_chunk_sizes:
+            output_paths[f"write_output_laz_chunk_{laz_chunk_size}"] = os.path.join(tmp, f"output_{laz_chunk_size}.laz")
+        for name, output_path in output_paths.items():
+            laz_chunk_size = int(name.rsplit("_", 1)[1]) if output_path.endswith(".laz") else None
+            kernels[name] = (lambda output_path=output_path, laz_chunk_size=laz_chunk_size:
+                             write_points(las, output_path, backend, laz_chunk_size))
+        results = {}
+        for name, kernel in kernels.items():
+            results[name] = time_kernel(kernel, repeat)
+            results[name]["points_per_s"] = point_count / results[name]["best_s"] if results[name]["best_s"] else None
+            print(f"{name}: {results[name]['best_s']:.4f} s", file=sys.stderr)
+
+        file_sizes = {"laz_bytes": os.path.getsize(laz_path), "las_bytes": os.path.getsize(las_path)}
+        for name, output_path in output_paths.items():
+            file_sizes[name[len("write_"):] + "_bytes"] = os.path.getsize(output_path)
+
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "parameters": {"points": point_count, "labels": label_count, "skew": skew, "point_format": point_format,
+                       "label_dtype": dtype.name, "mapping_size": mapping_size, "repeat": repeat,
+                       "laz_backend": backend or "auto", "chunk_size": chunk_size, "seed": seed,
+                       "laz_chunk_sizes": list(laz_chunk_sizes)},
+        "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                        "cpu_count": os.cpu_count(), "numpy": np.__version__, "laspy": laspy.__version__,
+                        "laz_backends": laz_backend_self_test()},
+        "files": file_sizes,
+        "results": results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the label changer kernels on synthetic data.")
+    parser.add_argument("--points", type=int, default=1_000_000, help="Number of synthetic points")
+    parser.add_argument("--labels", type=int, default=20, help="Number of distinct Ext_Class labels")
+    parser.add_argument("--skew", type=float, default=0.0, help="Label skew (0 = uniform, >1 = few dominant labels)")
+    parser.add_argument("--point-format", type=int, default=7, help="LAS point format id")
+    parser.add_argument("--dtype", default="uint8", help="Ext_Class numpy dtype (uint8, uint16, int32, ...)")
+    parser.add_argument("--mapping-size", type=int, default=50, help="Number of (old, new) pairs in the mapping")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per kernel")
+    parser.add_argument("--laz-backend", default="auto", help="LAZ backend name")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="Points per streamed chunk")
+    parser.add_argument("--laz-chunk-sizes", type=int, nargs="+", default=list(DEFAULT_LAZ_CHUNK_SIZES),
+                        help="LAZ chunk sizes to time compressed writes with")
+    parser.add_argument("--workdir", default=None, help="Directory for the temporary synthetic files")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="Write the JSON results here instead of stdout")
+    args = parser.parse_args(argv)
+
+    report = run_benchmarks(args.points, args.labels, args.skew, args.point_format, args.dtype, args.mapping_size,
+                            args.repeat, args.laz_backend, args.chunk_size, args.workdir, args.seed,
+                            args.laz_chunk_sizes)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent per-file label histogram cache for the Point Cloud Label Changer.
+
+@author: kenneyke
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from Ptc_Label_Engine import OperationCancelled, DEFAULT_CHUNK_SIZE, scan_label_histogram
+from Ptc_Label_Profiler import timed
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".ptc_label_changer", "label_histograms.sqlite")
+
+# Least recently used entries beyond this are dropped
+DEFAULT_MAX_ENTRIES = 100_000
+
+# Bytes hashed from the start of the file (the LAS 1.4 public header is 375 bytes)
+HEADER_HASH_BYTES = 375
+
+
+def header_hash(file_path):
+    # Cheap fingerprint of the public header (point counts, bounds, scales, ...)
+    with open(file_path, "rb") as f:
+        return hashlib.sha1(f.read(HEADER_HASH_BYTES)).hexdigest()
+
+
+class LabelHistogramCache:
+    """SQLite store of ``{label: count}`` histograms keyed by file path.
+
+    An entry is only used while the file's size, mtime and header hash are
+    unchanged, so edited or replaced tiles are rescanned automatically. Cache
+    errors (read-only home, locked database) never fail a scan, the histogram
+    is simply recomputed.
+
+    One connection is kept open for the life of the cache. Hits only note
+    their use time in memory; ``flush`` writes them in one transaction (as
+    does every eviction, which needs them), so a cached lookup costs no disk
+    write.
+    """
+
+    def __init__(self, cache_path=DEFAULT_CACHE_PATH, max_entries=DEFAULT_MAX_ENTRIES):
+        self.cache_path = cache_path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.db = None
+        # (path, dimension) -> last use not yet written
+        self.touched = {}
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+            self.db = sqlite3.connect(cache_path, timeout=30, check_same_thread=False)
+            with self._transaction() as db:
+                db.execute("""CREATE TABLE IF NOT EXISTS histograms (
+                                  path TEXT NOT NULL,
+                                  dimension TEXT NOT NULL,
+                                  size INTEGER NOT NULL,
+                                  mtime_ns INTEGER NOT NULL,
+                                  header_hash TEXT NOT NULL,
+                                  histogram TEXT NOT NULL,
+                                  last_used REAL NOT NULL,
+                                  PRIMARY KEY (path, dimension))""")
+                db.execute("CREATE INDEX IF NOT EXISTS histograms_last_used ON histograms (last_used)")
+        except (OSError, sqlite3.Error) as e:
+            print(f"Label cache disabled: {e}")
+            self.close()
+            self.cache_path = None
+
+    @contextmanager
+    def _transaction(self):
+        # The connection is shared between threads, one transaction at a time
+        with self.lock:
+            with self.db:
+                yield self.db
+
+    @staticmethod
+    def _key(file_path):
+        return os.path.normcase(os.path.abspath(file_path))
+
+    def get(self, file_path, dimension="Ext_Class"):
+        # Cached histogram, or None when missing or out of date
+        if self.cache_path is None:
+            return None
+        stat = os.stat(file_path)
+        key = self._key(file_path)
+        try:
+            with self._transaction() as db:
+                row = db.execute("SELECT size, mtime_ns, header_hash, histogram FROM histograms "
+                                 "WHERE path = ? AND dimension = ?", (key, dimension)).fetchone()
+        except sqlite3.Error as e:
+            print(f"Label cache read failed: {e}")
+            return None
+        if row is None or row[0] != stat.st_size or row[1] != stat.st_mtime_ns:
+            return None
+        if row[2] != header_hash(file_path):
+            return None
+        self.touched[key, dimension] = time.time()
+        return {int(label): count for label, count in json.loads(row[3]).items()}
+
+    def put(self, file_path, histogram, dimension="Ext_Class"):
+        if self.cache_path is None:
+            return
+        stat = os.stat(file_path)
+        try:
+            with self._transaction() as db:
+                db.execute("INSERT OR REPLACE INTO histograms VALUES (?, ?, ?, ?, ?, ?, ?)",
+                           (self._key(file_path), dimension, stat.st_size, stat.st_mtime_ns,
+                            header_hash(file_path), json.dumps({str(k): v for k, v in histogram.items()}),
+                            time.time()))
+                self._prune(db)
+        except sqlite3.Error as e:
+            print(f"Label cache write failed: {e}")
+
+    def _write_touched(self, db):
+        touched, self.touched = self.touched, {}
+        db.executemany("UPDATE histograms SET last_used = ? WHERE path = ? AND dimension = ?",
+                       [(used, path, dimension) for (path, dimension), used in touched.items()])
+
+    def flush(self):
+        # Write the use times of cache hits, one transaction for all of them
+        if self.cache_path is None or not self.touched:
+            return
+        try:
+            with self._transaction() as db:
+                self._write_touched(db)
+        except sqlite3.Error as e:
+            print(f"Label cache write failed: {e}")
+
+    def close(self):
+        if self.db is not None:
+            self.flush()
+            self.db.close()
+            self.db = None
+
+    def _prune(self, db):
+        # LRU size limit, on up-to-date use times
+        (count,) = db.execute("SELECT COUNT(*) FROM histograms").fetchone()
+        if count > self.max_entries:
+            self._write_touched(db)
+            db.execute("DELETE FROM histograms WHERE rowid IN "
+                       "(SELECT rowid FROM histograms ORDER BY last_used LIMIT ?)", (count - self.max_entries,))
+
+    def histogram(self, file_path, dimension="Ext_Class", chunk_size=DEFAULT_CHUNK_SIZE, backend=None, timer=None):
+        # Cached histogram, scanning (and caching) the file on a miss
+        with timed(timer, "label_cache", file_path):
+            histogram = self.get(file_path, dimension)
+        if histogram is None:
+            histogram = scan_label_histogram(file_path, dimension, chunk_size, backend, timer)
+            self.put(file_path, histogram, dimension)
+        return histogram
+
+    def invalidate(self, file_path=None):
+        # Drop one file's entries, or the whole cache when no path is given
+        if self.cache_path is None:
+            return
+        with self._transaction() as db:
+            if file_path is None:
+                db.execute("DELETE FROM histograms")
+            else:
+                db.execute("DELETE FROM histograms WHERE path = ?", (self._key(file_path),))
+
+
+class FolderLabelIndex:
+    """Label union over a set of files, kept up to date incrementally.
+
+    Per-file histograms and their running per-label point totals are held in
+    memory. ``refresh`` stats the current file list and only rescans files
+    that were added or whose size or mtime changed (through the histogram
+    cache when one is given); removed and changed files have their old counts
+    subtracted first. A label stays available while any file still holds it.
+    """
+
+    def __init__(self, cache=None, dimension="Ext_Class"):
+        self.cache = cache
+        self.dimension = dimension
+        # path -> (size, mtime_ns, histogram)
+        self.files = {}
+        # label -> points over all indexed files
+        self.totals = {}
+
+    def _add(self, histogram, sign):
+        for label, count in histogram.items():
+            total = self.totals.get(label, 0) + sign * count
+            if total:
+                self.totals[label] = total
+            else:
+                self.totals.pop(label, None)
+
+    def refresh(self, files, chunk_size=DEFAULT_CHUNK_SIZE, backend=None, timer=None, progress=None,
+                cancel_event=None):
+        # Bring the index in line with ``files``, returns the number of files rescanned
+        current = {}
+        with timed(timer, "label_index_stat"):
+            for file_path in files:
+                stat = os.stat(file_path)
+                current[file_path] = (stat.st_size, stat.st_mtime_ns)
+        for file_path in [f for f in self.files if f not in current]:
+            self._add(self.files.pop(file_path)[2], -1)
+
+        changed = [f for f, stamp in current.items() if self.files.get(f, (None, None))[:2] != stamp]
+        for i, file_path in enumerate(changed, start=1):
+            if cancel_event is not None and cancel_event.is_set():
+                raise OperationCancelled()
+            if self.cache is not None:
+                histogram = self.cache.histogram(file_path, self.dimension, chunk_size, backend, timer)
+            else:
+                histogram = scan_label_histogram(file_path, self.dimension, chunk_size, backend, timer)
+            previous = self.files.get(file_path)
+            if previous is not None:
+                self._add(previous[2], -1)
+            self.files[file_path] = current[file_path] + (histogram,)
+            self._add(histogram, 1)
+            if progress:
+                progress(i, len(changed))
+        if self.cache is not None:
+            self.cache.flush()
+        return len(changed)
+
+    def labels(self):
+        return sorted(self.totals)
+
+    def clear(self):
+        self.files = {}
+        self.totals = {}
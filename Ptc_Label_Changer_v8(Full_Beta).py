@@ -6,12 +6,24 @@ Created on Wed Jan 10 16:18:47 2024
 """
 
 import tkinter as tk
-from tkinter import filedialog, messagebox
-import laspy
-import numpy as np
-import pandas as pd
+from tkinter import filedialog, messagebox, simpledialog, ttk
 import os
-import glob
+import queue
+import threading
+import time
+from Ptc_Label_Engine import LabelRemapper, OperationCancelled, DEFAULT_CHUNK_SIZE, LAZ_BACKENDS, label_histogram, laz_backend_self_test, output_extension, patch_las_file, relabel_file_streaming
+from Ptc_Label_Batch import DEFAULT_WORKERS, BatchOptions, is_las_file, run_batch, format_batch_summary, preview_batch, format_preview
+from Ptc_Label_Cache import FolderLabelIndex, LabelHistogramCache
+from Ptc_Label_Discovery import iter_point_clouds
+from Ptc_Label_Governor import DEFAULT_MEMORY_FRACTION, default_memory_limit
+from Ptc_Label_Mapping import load_mapping
+from Ptc_Label_Journal import JOURNAL_NAME, BatchJournal
+from Ptc_Label_Pipeline import DEFAULT_PIPELINE_MEMORY
+from Ptc_Label_Queue import job_summary, run_worker, submit_job
+from Ptc_Label_Rules import RuleSet, load_rules
+from Ptc_Label_Session import EditSession
+from Ptc_Label_Spatial import load_region
+from Ptc_Label_Profiler import StageTimer, profiled, timed
 
 class PointCloudLabelChanger:
     def __init__(self, root):
@@ -28,19 +40,112 @@ class PointCloudLabelChanger:
         menubar.add_cascade(label="File", menu=file_menu)
         file_menu.add_command(label="Open Point Cloud", command=self.open_point_cloud)
         file_menu.add_command(label="Load Excel Sheet", command=self.load_excel_sheet)  # Added for Excel loading
+        file_menu.add_command(label="Load Rules...", command=self.load_rules_file)
+        file_menu.add_command(label="Load Region...", command=self.load_region_file)
+        file_menu.add_command(label="Clear Label Cache", command=self.clear_label_cache)
         
         # Create a processing method menu
         processing_method_menu = tk.Menu(menubar, tearoff=0)
         menubar.add_cascade(label="Processing Method", menu=processing_method_menu)
         processing_method_menu.add_command(label="Single", command=self.set_single_process)
         processing_method_menu.add_command(label="Batch", command=self.set_batch_process)
+        processing_method_menu.add_separator()
+        
+        # Streaming mode reads/writes the point cloud in chunks with bounded memory
+        self.streaming_var = tk.BooleanVar(value=False)
+        self.streaming = False
+        self.chunk_size = DEFAULT_CHUNK_SIZE
+        processing_method_menu.add_checkbutton(label="Streaming (Low Memory)", variable=self.streaming_var, command=self.set_streaming)
+        processing_method_menu.add_command(label="Set Chunk Size...", command=self.set_chunk_size)
+        
+        # Uncompressed .las inputs can be patched through a memory map instead of rewritten
+        self.patch_las_var = tk.BooleanVar(value=False)
+        self.patch_las = False
+        processing_method_menu.add_checkbutton(label="Patch LAS Files (No Rewrite)", variable=self.patch_las_var)
+        
+        # Batch mode farms files out to a pool of worker processes
+        self.workers = DEFAULT_WORKERS
+        processing_method_menu.add_command(label="Set Batch Workers...", command=self.set_workers)
+        
+        # With one worker, batch files overlap reading, remapping and writing within a memory budget
+        self.pipeline_var = tk.BooleanVar(value=True)
+        self.pipeline = True
+        self.pipeline_memory = DEFAULT_PIPELINE_MEMORY
+        processing_method_menu.add_checkbutton(label="Pipelined Batch (Overlap Read/Write)", variable=self.pipeline_var)
+        processing_method_menu.add_command(label="Set Pipeline Memory...", command=self.set_pipeline_memory)
+        
+        # Batches lower their chunk size and workers to stay under a memory ceiling (None: a share of the free memory)
+        self.memory_limit = None
+        processing_method_menu.add_command(label="Set Memory Limit...", command=self.set_memory_limit)
+        
+        # Finished files are journaled in the batch folder so a rerun skips them
+        self.resume_var = tk.BooleanVar(value=True)
+        self.resume = True
+        processing_method_menu.add_checkbutton(label="Resume Batches (Skip Finished Files)", variable=self.resume_var)
+        # Verified journals also hash every output and only skip files whose output still matches
+        self.verify_journal_var = tk.BooleanVar(value=False)
+        self.verify_journal = False
+        processing_method_menu.add_checkbutton(label="Verify Finished Outputs (Checksums)", variable=self.verify_journal_var)
+        
+        # Batch folders can include their subfolders and be narrowed down by file name patterns
+        self.recursive_var = tk.BooleanVar(value=False)
+        self.recursive = False
+        self.include_patterns = []
+        self.exclude_patterns = []
+        processing_method_menu.add_checkbutton(label="Include Subfolders", variable=self.recursive_var, command=self.set_recursive)
+        processing_method_menu.add_command(label="Set File Filters...", command=self.set_file_filters)
+        
+        # Multi-node runs: a job folder on shared storage that workers on any machine drain together
+        processing_method_menu.add_command(label="Submit Folder to Shared Queue...", command=self.submit_queue_job)
+        processing_method_menu.add_command(label="Work on Shared Queue...", command=self.work_on_queue)
+        processing_method_menu.add_separator()
+        
+        # Timing traces (JSON) and cProfile dumps are written next to the opened point cloud
+        self.timing_var = tk.BooleanVar(value=False)
+        self.profile_var = tk.BooleanVar(value=False)
+        self.timer = None
+        processing_method_menu.add_checkbutton(label="Record Timing Trace", variable=self.timing_var)
+        processing_method_menu.add_checkbutton(label="Write cProfile Dump", variable=self.profile_var)
+        
+        # Create a LAZ backend menu, used for both decompression and compression
+        self.laz_backend_var = tk.StringVar(value="auto")
+        self.laz_backend = "auto"
+        laz_backend_menu = tk.Menu(menubar, tearoff=0)
+        menubar.add_cascade(label="LAZ Backend", menu=laz_backend_menu)
+        for backend_name in LAZ_BACKENDS:
+            laz_backend_menu.add_radiobutton(label=backend_name, value=backend_name, variable=self.laz_backend_var, command=self.set_laz_backend)
+        laz_backend_menu.add_separator()
+        laz_backend_menu.add_command(label="Backend Self-Test", command=self.run_laz_backend_self_test)
+        
+        # Create an output format menu: LAS skips the compression cost for intermediate results
+        self.output_format_var = tk.StringVar(value="laz")
+        self.output_format = "laz"
+        self.laz_chunk_size = None
+        output_format_menu = tk.Menu(menubar, tearoff=0)
+        menubar.add_cascade(label="Output Format", menu=output_format_menu)
+        for format_name, format_label in (("laz", "LAZ (Compressed)"), ("las", "LAS (Uncompressed, Fastest)"), ("keep", "Same as Input")):
+            output_format_menu.add_radiobutton(label=format_label, value=format_name, variable=self.output_format_var, command=self.set_output_format)
+        output_format_menu.add_separator()
+        output_format_menu.add_command(label="Set LAZ Chunk Size...", command=self.set_laz_chunk_size)
+        
+        # Batch files holding none of the changed labels are copied (or skipped) instead of re-encoded
+        self.unaffected_var = tk.StringVar(value="copy")
+        self.unaffected = "copy"
+        output_format_menu.add_separator()
+        for mode, mode_label in (("copy", "Unchanged Files: Copy"), ("skip", "Unchanged Files: Skip"), ("rewrite", "Unchanged Files: Rewrite")):
+            output_format_menu.add_radiobutton(label=mode_label, value=mode, variable=self.unaffected_var, command=self.set_unaffected)
         
         # Initialize variables
-        self.point_cloud = None
+        self.session = None
         self.old_label_var = tk.StringVar()
         self.new_label_var = tk.StringVar()
         self.excel_file_path_var = tk.StringVar()  # Add this line to initialize the variable
         self.file_path = None
+        
+        # Per-file label histograms are cached on disk so folders are not rescanned
+        self.label_cache = LabelHistogramCache()
+        # Folder label union for Batch mode, only new or changed files are rescanned
+        self.folder_labels = FolderLabelIndex(self.label_cache)
        
         
         # Create frame for process selection
@@ -104,6 +209,10 @@ class PointCloudLabelChanger:
         change_labels_button = tk.Button(root, text="Change Labels", command=self.change_label)
         change_labels_button.pack()
         
+        # Button to preview the impact of the label changes without writing anything
+        preview_button = tk.Button(root, text="Preview Changes (Dry Run)", command=self.preview_label_changes)
+        preview_button.pack()
+        
         # Create a button to switch between Manual and Excel Entry methods
         switch_method_button = tk.Button(self.label_frame, text="Switch Entry Method", command=self.switch_label_entry_method)
         switch_method_button.grid(row=4, column=0, columnspan=2, pady=5)
@@ -112,8 +221,138 @@ class PointCloudLabelChanger:
         reset_button = tk.Button(root, text="Reset", command=self.reset)
         reset_button.pack()
         
+        # Create progress frame for operations running in the background
+        progress_frame = tk.Frame(root, padx=10, pady=10)
+        progress_frame.pack(fill=tk.X)
+
+        self.progress_bar = ttk.Progressbar(progress_frame, orient=tk.HORIZONTAL, length=300, mode="determinate")
+        self.progress_bar.grid(row=0, column=0, padx=5)
+
+        self.cancel_button = tk.Button(progress_frame, text="Cancel", command=self.cancel_task, state="disabled")
+        self.cancel_button.grid(row=0, column=1, padx=5)
+
+        self.status_var = tk.StringVar(value="Ready")
+        status_label = tk.Label(progress_frame, textvariable=self.status_var, justify=tk.LEFT)
+        status_label.grid(row=1, column=0, columnspan=2, sticky="w")
+        
+        # Heavy I/O and compute run on a worker thread, results come back through this queue
+        self.task_queue = queue.Queue()
+        self.worker_thread = None
+        self.cancel_event = threading.Event()
+        self.task_started = None
+        
         # Initialize a list to store label change inputs
         self.label_changes = []
+        # Conditional rules, applied after the label changes in the streaming pass
+        self.rules = RuleSet()
+        
+#%% Background tasks
+    def run_task(self, description, task, on_done=None, on_error=None):
+        # Runs task(report, cancel_event) on a worker thread; on_done/on_error run on the Tk thread
+        if self.worker_thread is not None and self.worker_thread.is_alive():
+            messagebox.showwarning("Busy", "Please wait for the current operation to finish or cancel it.")
+            return
+    
+        self.cancel_event = threading.Event()
+        self.task_started = time.perf_counter()
+        self.status_var.set(description)
+        self.progress_bar.config(mode="indeterminate", value=0)
+        self.progress_bar.start(10)
+        self.cancel_button.config(state="normal")
+        
+        # Tk variables must not be read from the worker thread
+        trace_path = self.trace_path(".json") if self.timing_var.get() else None
+        profile_path = self.trace_path(".prof") if self.profile_var.get() else None
+        timer = self.timer = StageTimer(description) if trace_path else None
+    
+        def worker():
+            try:
+                with profiled(profile_path):
+                    result = task(self.report_progress, self.cancel_event)
+                self.task_queue.put(("done", on_done, result))
+            except OperationCancelled:
+                self.task_queue.put(("cancelled", None, None))
+            except Exception as e:
+                self.task_queue.put(("error", on_error, e))
+            finally:
+                if timer is not None:
+                    print(f"Timing trace written to {timer.write_trace(trace_path)}")
+                if profile_path:
+                    print(f"Profile written to {profile_path}")
+    
+        self.worker_thread = threading.Thread(target=worker, daemon=True)
+        self.worker_thread.start()
+        self.root.after(100, self.poll_task_queue)
+
+    def trace_path(self, extension):
+        directory = os.path.dirname(self.file_path) if self.file_path else os.getcwd()
+        stamp = time.strftime("%Y%m%d_%H%M%S") + f"_{int(time.time() * 1000) % 1000:03d}"
+        return os.path.join(directory, f"ptc_label_trace_{stamp}{extension}")
+
+    def report_progress(self, files_done=0, files_total=0, points_done=0, points_total=0):
+        # Called from the worker thread, the Tk thread picks it up in poll_task_queue
+        self.task_queue.put(("progress", None, (files_done, files_total, points_done, points_total)))
+
+    def poll_task_queue(self):
+        while True:
+            try:
+                kind, callback, payload = self.task_queue.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "progress":
+                self.show_progress(*payload)
+                continue
+    
+            # The task finished, restore the idle state before running its callback; the worker
+            # is past its last put, wait for it so the callback can start the next task
+            self.worker_thread.join()
+            self.progress_bar.stop()
+            self.progress_bar.config(mode="determinate", value=0)
+            self.cancel_button.config(state="disabled")
+            elapsed = time.perf_counter() - self.task_started
+            if kind == "done":
+                self.status_var.set(f"Done in {elapsed:.1f} s")
+                if callback:
+                    callback(payload)
+            elif kind == "cancelled":
+                self.status_var.set("Cancelled")
+                messagebox.showwarning("Cancelled", "Operation cancelled.")
+            else:
+                self.status_var.set("Failed")
+                if callback:
+                    callback(payload)
+                else:
+                    messagebox.showerror("Error", f"{payload}")
+            return
+        self.root.after(100, self.poll_task_queue)
+
+    def show_progress(self, files_done, files_total, points_done, points_total):
+        elapsed = max(time.perf_counter() - self.task_started, 1e-6)
+        rate = points_done / elapsed
+        if points_total:
+            fraction = points_done / points_total
+        elif files_total:
+            fraction = files_done / files_total
+        else:
+            fraction = 0
+    
+        if str(self.progress_bar["mode"]) != "determinate":
+            self.progress_bar.stop()
+            self.progress_bar.config(mode="determinate")
+        self.progress_bar.config(value=100 * fraction)
+    
+        status = []
+        if files_total:
+            status.append(f"{files_done}/{files_total} files")
+        if points_done:
+            status.append(f"{rate / 1e6:.2f} M points/s")
+        if 0 < fraction < 1:
+            status.append(f"ETA {time.strftime('%H:%M:%S', time.gmtime(elapsed * (1 - fraction) / fraction))}")
+        self.status_var.set(", ".join(status))
+
+    def cancel_task(self):
+        self.cancel_event.set()
+        self.status_var.set("Cancelling...")
         
     # Add a method to update the selected processing method
     def update_processing_method(self, method):
@@ -130,14 +369,184 @@ class PointCloudLabelChanger:
         # Add your logic for the "Batch" processing method here
         print("Batch processing method selected")
     
+    def set_streaming(self):
+        self.streaming = self.streaming_var.get()
+        state = "enabled" if self.streaming else "disabled"
+        messagebox.showinfo("Streaming Mode", f"Streaming mode {state}. Chunk size: {self.chunk_size} points")
+        print(f"Streaming mode {state}")
+
+    def set_chunk_size(self):
+        chunk_size = simpledialog.askinteger("Chunk Size", "Points per chunk for streaming mode:",
+                                             initialvalue=self.chunk_size, minvalue=1000)
+        if chunk_size:
+            self.chunk_size = chunk_size
+    
+    def set_workers(self):
+        workers = simpledialog.askinteger("Batch Workers", "Number of files processed in parallel:",
+                                          initialvalue=self.workers, minvalue=1, maxvalue=os.cpu_count() or 1)
+        if workers:
+            self.workers = workers
+    
+    def set_laz_backend(self):
+        self.laz_backend = self.laz_backend_var.get()
+        print(f"LAZ backend set to: {self.laz_backend}")
+
+    def set_pipeline_memory(self):
+        memory_mb = simpledialog.askinteger("Pipeline Memory", "MB of point records read ahead of the writer:",
+                                            initialvalue=self.pipeline_memory // 1024 ** 2, minvalue=16)
+        if memory_mb:
+            self.pipeline_memory = memory_mb * 1024 ** 2
+
+    def set_memory_limit(self):
+        memory_mb = simpledialog.askinteger("Memory Limit", f"MB a batch may use (0 for {DEFAULT_MEMORY_FRACTION:.0%} of the available memory):",
+                                            initialvalue=(self.memory_limit or 0) // 1024 ** 2, minvalue=0)
+        if memory_mb is not None:
+            self.memory_limit = memory_mb * 1024 ** 2 or None
+
+    def submit_queue_job(self):
+        # Write the batch folder as a job that workers on any node can claim files from
+        if not self.file_path or not (self.label_changes or self.rules):
+            messagebox.showwarning("Shared Queue", "Open a point cloud in the batch folder and add label changes or rules first.")
+            return
+        try:
+            remapper = LabelRemapper(self.label_changes)
+        except ValueError:
+            messagebox.showerror("Error", "Invalid label format. Please enter valid labels.")
+            return
+        job_dir = filedialog.askdirectory(title="Select an empty job folder on shared storage")
+        if not job_dir:
+            return
+        files = self.batch_files()
+        try:
+            submit_job(job_dir, files, remapper, chunk_size=self.chunk_size, backend=self.laz_backend, rules=self.rules,
+                       output_format=self.output_format, laz_chunk_size=self.laz_chunk_size,
+                       input_root=os.path.dirname(self.file_path))
+        except OSError as e:
+            messagebox.showerror("Shared Queue", f"Could not write the job: {e}")
+            return
+        messagebox.showinfo("Shared Queue", f"Queued {len(files)} files in {job_dir}.\n"
+                                            f"Start workers on each node with:\npython relabel.py --queue \"{job_dir}\"")
+
+    def work_on_queue(self):
+        # Claim and relabel files of a shared job from this machine until none are left
+        job_dir = filedialog.askdirectory(title="Select a job folder on shared storage")
+        if not job_dir:
+            return
+        if not os.path.exists(os.path.join(job_dir, "manifest.json")):
+            messagebox.showerror("Shared Queue", f"No job found in {job_dir}.")
+            return
+
+        def task(report, cancel_event):
+            files_total = job_summary(job_dir)["pending"]
+            done = []
+
+            def file_finished(result):
+                done.append(result)
+                print(f"Finished {result['input']} ({result['points']} points)")
+                report(files_done=len(done), files_total=files_total)
+            run_worker(job_dir, progress=file_finished, stop_event=cancel_event)
+            return job_summary(job_dir)
+
+        def done(summary):
+            if summary["failed"] or summary["pending"]:
+                messagebox.showwarning("Shared Queue", format_batch_summary(summary))
+            else:
+                messagebox.showinfo("Shared Queue", format_batch_summary(summary))
+
+        self.run_task("Working on shared queue...", task, done)
+
+    def set_recursive(self):
+        self.recursive = self.recursive_var.get()
+        print(f"Include subfolders: {self.recursive}")
+
+    def set_file_filters(self):
+        # Comma separated patterns on the file name or the path below the batch folder, e.g. tile_*, archive/*
+        include = simpledialog.askstring("File Filters", "Only batch files matching (comma separated, empty for all):",
+                                         initialvalue=", ".join(self.include_patterns))
+        if include is None:
+            return
+        exclude = simpledialog.askstring("File Filters", "Leave out batch files matching (comma separated):",
+                                         initialvalue=", ".join(self.exclude_patterns))
+        if exclude is None:
+            return
+        self.include_patterns = [pattern.strip() for pattern in include.split(",") if pattern.strip()]
+        self.exclude_patterns = [pattern.strip() for pattern in exclude.split(",") if pattern.strip()]
+        print(f"File filters: include {self.include_patterns or 'all'}, exclude {self.exclude_patterns or 'none'}")
+
+    def batch_files(self):
+        # Point clouds in the folder of the opened file, without the outputs of earlier runs
+        return list(iter_point_clouds(os.path.dirname(self.file_path), self.recursive, self.include_patterns,
+                                      self.exclude_patterns))
+
+    def set_unaffected(self):
+        self.unaffected = self.unaffected_var.get()
+        print(f"Unchanged batch files: {self.unaffected}")
+
+    def set_output_format(self):
+        self.output_format = self.output_format_var.get()
+        print(f"Output format set to: {self.output_format}")
+
+    def set_laz_chunk_size(self):
+        laz_chunk_size = simpledialog.askinteger("LAZ Chunk Size", "Points per LAZ chunk in compressed outputs:",
+                                                 initialvalue=self.laz_chunk_size or 50000, minvalue=1000)
+        if laz_chunk_size:
+            self.laz_chunk_size = laz_chunk_size
+
+    def ask_save_path(self):
+        # Save dialog defaulting to <name>_updated in the selected output format
+        extension = output_extension(self.file_path, self.output_format)
+        file_types = [("LAZ Files", "*.laz"), ("LAS Files", "*.las")]
+        if extension == ".las":
+            file_types.reverse()
+        file_path, _ = os.path.splitext(self.file_path)
+        return filedialog.asksaveasfilename(defaultextension=extension, filetypes=file_types,
+                                            initialfile=f"{file_path}_updated{extension}")
+
+    def run_laz_backend_self_test(self):
+        report = laz_backend_self_test()
+        messagebox.showinfo("LAZ Backends", "\n".join(f"{name}: {status}" for name, status in report.items()))
+    
+    def load_rules_file(self):
+        file_path = filedialog.askopenfilename(filetypes=[("Rule Files", "*.txt;*.json")])
+        if file_path:
+            try:
+                rules = load_rules(file_path)
+            except (OSError, ValueError) as e:
+                messagebox.showerror("Error", f"Error reading rules: {e}")
+                return
+            # Regions loaded earlier stay available to the new rules
+            rules.regions = self.rules.regions
+            self.rules = rules
+            rules_str = "\n".join(rule.text for rule in self.rules.rules)
+            messagebox.showinfo("Rules Loaded", f"{len(self.rules)} rules loaded:\n{rules_str}")
+
+    def load_region_file(self):
+        # Polygons for inside("name") in rules, named after the file
+        file_path = filedialog.askopenfilename(filetypes=[("Region Files", "*.geojson;*.json;*.wkt;*.txt")])
+        if file_path:
+            try:
+                region = load_region(file_path)
+            except (OSError, ValueError, KeyError) as e:
+                messagebox.showerror("Error", f"Error reading region: {e}")
+                return
+            self.rules.add_region(region)
+            messagebox.showinfo("Region Loaded", f'Region "{region.name}" loaded with {len(region.polygons)} polygons. '
+                                                 f'Use inside("{region.name}") in rules.')
+
+    def clear_label_cache(self):
+        self.label_cache.invalidate()
+        self.folder_labels.clear()
+        messagebox.showinfo("Label Cache", "Cached label histograms cleared.")
+    
     def reset(self):
         # Reset all variables and clear GUI components
-        self.point_cloud = None
+        self.session = None
         self.old_label_var.set("")
         self.new_label_var.set("")
         self.excel_file_path_var.set("")
         self.file_path = None
         self.label_changes = []
+        self.rules = RuleSet()
 
         # Reset the label selection frame
         self.old_label_var.set("")
@@ -193,22 +602,26 @@ class PointCloudLabelChanger:
 
     
     def load_excel_sheet(self):
-        file_path = filedialog.askopenfilename(filetypes=[("Excel Files", "*.xlsx;*.xls")])
+        file_path = filedialog.askopenfilename(filetypes=[("Mapping Files", "*.xlsx;*.xls;*.csv;*.json;*.parquet"),
+                                                           ("Excel Files", "*.xlsx;*.xls"), ("CSV Files", "*.csv"),
+                                                           ("JSON Files", "*.json"), ("Parquet Files", "*.parquet")])
         if file_path:
             self.excel_file_path_var.set(file_path)
             messagebox.showinfo("Excel Sheet Loaded", f"Excel sheet loaded:\n{file_path}")
-            messagebox.showinfo("Loading Label Changes", "Please wait for label changes mapping to show")
     
-            try:
-                excel_data = pd.read_excel(file_path)
-                old_labels = excel_data.iloc[:, 0].astype(int)
-                new_labels = excel_data.iloc[:, 1].astype(int)
+            def task(report, cancel_event):
+                # Parsed and compiled once per file content, later loads hit the mapping cache
+                mapping = load_mapping(file_path)
     
                 # Get cumulative unique labels across all loaded point clouds
-                cumulative_available_labels = self.get_unique_labels_cumulative()
+                cumulative_available_labels = self.get_unique_labels_cumulative(report, cancel_event)
     
                 # Filter label changes to include only those that match cumulative available labels
-                valid_label_changes = [(old, new) for old, new in zip(old_labels, new_labels) if old in cumulative_available_labels]
+                valid_label_changes = mapping.filter(cumulative_available_labels).label_changes
+                return cumulative_available_labels, valid_label_changes
+    
+            def done(result):
+                cumulative_available_labels, valid_label_changes = result
     
                 # Display only valid label changes in the GUI
                 changes_str = "\n".join([f"Change {i+1}: Old Label {old} to New Label {new}"
@@ -224,72 +637,95 @@ class PointCloudLabelChanger:
                 for label in cumulative_available_labels:
                     menu.add_command(label=label, command=lambda l=label: self.old_label_var.set(l))
     
-            except Exception as e:
-                messagebox.showerror("Error", f"Error reading Excel file: {e}")
+            self.run_task("Loading label changes mapping...", task, done,
+                          lambda e: messagebox.showerror("Error", f"Error reading Excel file: {e}"))
 
     
     def open_point_cloud(self):
         file_path = filedialog.askopenfilename(filetypes=[("Point Cloud Files", "*.las;*.laz")])
         if file_path:
             self.file_path = file_path
-            self.point_cloud = self.read_point_cloud(file_path)
-
-            # Check the selected processing method
-            if self.processing_method == "Single":
-                # Show available labels for the single selected file
-                messagebox.showinfo("Loading Available Labels", "Please wait for the Availabel Labels to be loaded")
-                labels = self.get_unique_labels_single_file()
-            elif self.processing_method == "Batch":
-                # Show the cumulative available labels for all files
-                messagebox.showinfo("Loading Available Labels", "Please wait for the Availabel Labels across all files to be loaded")
-                labels = self.get_unique_labels_cumulative()
-
-            label_str = '\n'.join(map(str, labels))
-            self.available_labels_var.set(label_str)
-
-            # Update the dropdown menu with available labels
-            menu = self.old_label_dropdown["menu"]
-            menu.delete(0, "end")
-            for label in labels:
-                menu.add_command(label=label, command=lambda l=label: self.old_label_var.set(l))
-
-            messagebox.showinfo("Available Labels", f"Available labels:\n{label_str}") 
+            streaming = self.streaming
+            processing_method = self.processing_method
+    
+            def task(report, cancel_event):
+                # In streaming mode the point cloud is never held in memory, otherwise
+                # it is loaded once and kept for editing and saving
+                session = None if streaming else self.read_point_cloud(file_path)
+    
+                # Check the selected processing method
+                labels = []
+                if processing_method == "Single":
+                    # Show available labels for the single selected file
+                    if session is not None:
+                        with timed(self.timer, "label_scan", file_path, points=session.point_count):
+                            labels = session.unique_labels()
+                    else:
+                        labels = sorted(self.label_cache.histogram(file_path, chunk_size=self.chunk_size, backend=self.laz_backend, timer=self.timer))
+                elif processing_method == "Batch":
+                    # Show the cumulative available labels for all files
+                    labels = self.get_unique_labels_cumulative(report, cancel_event)
+                return session, labels
+    
+            def done(result):
+                self.session, labels = result
+                label_str = '\n'.join(map(str, labels))
+                self.available_labels_var.set(label_str)
+    
+                # Update the dropdown menu with available labels
+                menu = self.old_label_dropdown["menu"]
+                menu.delete(0, "end")
+                for label in labels:
+                    menu.add_command(label=label, command=lambda l=label: self.old_label_var.set(l))
+    
+                messagebox.showinfo("Available Labels", f"Available labels:\n{label_str}") 
+    
+            self.run_task("Loading available labels...", task, done)
             
     def get_unique_labels_single_file(self):
-            if self.point_cloud is not None:
-                return np.unique(self.point_cloud[:, -1]).astype(int)
+            if self.session is not None:
+                return self.session.unique_labels()
+            elif self.streaming and self.file_path:
+                return sorted(self.label_cache.histogram(self.file_path, chunk_size=self.chunk_size, backend=self.laz_backend, timer=self.timer))
             else:
                 return []
             
-    def get_unique_labels_cumulative(self):
-            # Get unique labels across all loaded point clouds
-            unique_labels_set = set()
-            for original_ptcloud_path in self.get_loaded_files():
-                original_ptcloud = laspy.read(original_ptcloud_path)
-                current_labels = np.unique(original_ptcloud.Ext_Class).astype(int)
-                unique_labels_set.update(current_labels)
-            return sorted(list(unique_labels_set))
+    def get_unique_labels_cumulative(self, report=None, cancel_event=None):
+            # Get unique labels across all loaded point clouds. Only files added or
+            # modified since the last refresh are rescanned, removed files are subtracted
+            files = self.get_loaded_files()
+            rescanned = self.folder_labels.refresh(files, chunk_size=self.chunk_size, backend=self.laz_backend, timer=self.timer,
+                                                   progress=lambda done, total: report(files_done=done, files_total=total) if report else None,
+                                                   cancel_event=cancel_event)
+            print(f"Label index refreshed: {rescanned} of {len(files)} files rescanned")
+            return self.folder_labels.labels()
 
     def get_loaded_files(self):
             # Returns the list of loaded point cloud files (used for batch processing)
-            return [self.file_path] if self.processing_method == "Single" else glob.glob(os.path.join(os.path.dirname(self.file_path), '*.laz'))
+            return [self.file_path] if self.processing_method == "Single" else self.batch_files()
 
     def update_available_labels(self):
-        if self.processing_method == "Single":
-            labels = self.get_unique_labels_single_file()
-        elif self.processing_method == "Batch":
-            labels = self.get_unique_labels_cumulative()
-        else:
-            labels = []
+        processing_method = self.processing_method
+    
+        def task(report, cancel_event):
+            # Label scans and the folder index refresh read the files, so they stay off the Tk thread
+            if processing_method == "Single":
+                return self.get_unique_labels_single_file()
+            elif processing_method == "Batch":
+                return self.get_unique_labels_cumulative(report, cancel_event)
+            return []
+    
+        def done(labels):
+            label_str = '\n'.join(map(str, labels))
+            self.available_labels_var.set(label_str)
     
-        label_str = '\n'.join(map(str, labels))
-        self.available_labels_var.set(label_str)
+            # Update the dropdown menu with available labels
+            menu = self.old_label_dropdown["menu"]
+            menu.delete(0, "end")
+            for label in labels:
+                menu.add_command(label=label, command=lambda l=label: self.old_label_var.set(l))
     
-        # Update the dropdown menu with available labels
-        menu = self.old_label_dropdown["menu"]
-        menu.delete(0, "end")
-        for label in labels:
-            menu.add_command(label=label, command=lambda l=label: self.old_label_var.set(l))
+        self.run_task("Updating available labels...", task, done)
 
     def add_label_change(self):
         method = self.label_change_method_var.get()
@@ -304,16 +740,17 @@ class PointCloudLabelChanger:
                 messagebox.showerror("Error", "Please provide an Excel file.")
                 return
     
-            # Read the Excel file and extract label changes
-            try:
-                excel_data = pd.read_excel(file_path)
-                old_labels = excel_data.iloc[:, 0].astype(int)
-                new_labels = excel_data.iloc[:, 1].astype(int)
+            def task(report, cancel_event):
+                # Read the Excel file and extract label changes; parsing a workbook and
+                # scanning the labels can take a while, so both run off the Tk thread
+                mapping = load_mapping(file_path)
+                if self.session is not None:
+                    mapping.check_range(self.session.labels.dtype)
     
                 # Filter label changes to include only available labels
-                available_labels = self.get_unique_labels()
-                valid_label_changes = [(old, new) for old, new in zip(old_labels, new_labels) if old in available_labels]
+                return mapping.filter(self.get_unique_labels()).label_changes
     
+            def done(valid_label_changes):
                 # Display label changes in the GUI
                 changes_str = "\n".join([f"Change {i+1}: Old Label {old} to New Label {new}"
                                         for i, (old, new) in enumerate(valid_label_changes)])
@@ -322,9 +759,9 @@ class PointCloudLabelChanger:
                 # Update the label_changes list with valid label changes
                 self.label_changes = valid_label_changes
     
-            except Exception as e:
-                messagebox.showerror("Error", f"Error reading Excel file: {e}")
-                return
+            self.run_task("Reading label changes...", task, done,
+                          lambda e: messagebox.showerror("Error", f"Error reading Excel file: {e}"))
+            return
     
         # Add new label change mapping to the list
         old_label = self.old_label_var.get()
@@ -343,64 +780,123 @@ class PointCloudLabelChanger:
             self.new_label_var.set("")
     
     def read_point_cloud(self, file_path):
-        return self.readPtcloud(file_path)
-
-    def readPtcloud(self, file_path):
-        L = laspy.read(file_path)
-        # Extracting X, Y, Z, Intensity, and Ext_Class
-        ptcloud = np.array((L.x, L.y, L.z, L.intensity, L.Ext_Class)).transpose()
-        return ptcloud
-
-    def read_Original_Ptcloud(self, file_path):
-        LL = laspy.read(file_path)
-        originalptcloud = np.array((LL.x, LL.y, LL.z, LL.intensity, LL.return_number, LL.number_of_returns, LL.scan_direction_flag, LL.edge_of_flight_line, LL.classification, LL.user_data, LL.point_source_id, LL.gps_time, LL.red, LL.green, LL.blue)).transpose()
-        return originalptcloud
+        # Only the label column is loaded, other dimensions are read on demand
+        return EditSession(file_path, backend=self.laz_backend, chunk_size=self.chunk_size, timer=self.timer)
 
     def get_unique_labels(self):
-        if self.point_cloud is not None:
-            return np.unique(self.point_cloud[:, -1]).astype(int)
+        if self.session is not None:
+            return self.session.unique_labels()
+        elif self.streaming and self.file_path:
+            return sorted(self.label_cache.histogram(self.file_path, chunk_size=self.chunk_size, backend=self.laz_backend, timer=self.timer))
         else:
             return []
         
+    def apply_label_changes(self, on_applied):
+        # Validate the label changes and apply them to the loaded point cloud in one pass,
+        # then call on_applied on the Tk thread
+        try:
+            remapper = LabelRemapper(self.label_changes)
+        except ValueError:
+            messagebox.showerror("Error", "Invalid label format. Please enter valid integers.")
+            return
+    
+        def task(report, cancel_event):
+            # The unique labels scan every loaded point, so it runs off the Tk thread too
+            available_labels = set(self.get_unique_labels())
+            # Pairs are applied in order, so track which labels exist after each one
+            for old_label, new_label in remapper.label_changes:
+                if old_label not in available_labels:
+                    raise ValueError(f"Selected label {old_label} does not exist.")
+                available_labels.discard(old_label)
+                available_labels.add(new_label)
+            self.session.apply(remapper, timer=self.timer)
+    
+        self.run_task("Applying label changes...", task, lambda _: on_applied())
+
+    def change_label_streaming(self):
+        # Streaming mode: remap chunk by chunk straight from the input file(s)
+        if not self.label_changes and not self.rules:
+            messagebox.showerror("Error", "Please add label changes first.")
+            return
+        try:
+            remapper = LabelRemapper(self.label_changes)
+        except ValueError:
+            messagebox.showerror("Error", "Invalid label format. Please enter valid integers.")
+            return
+    
+        if self.processing_method == "Batch":
+            self.run_batch_task()
+            return
+    
+        save_path = self.ask_save_path()
+        if save_path:
+            input_path = self.file_path
+    
+            def task(report, cancel_event):
+                relabel_file_streaming(input_path, save_path, remapper, chunk_size=self.chunk_size, backend=self.laz_backend, timer=self.timer, rules=self.rules,
+                                       laz_chunk_size=self.laz_chunk_size, progress=lambda done, total: report(points_done=done, points_total=total),
+                                       cancel_event=cancel_event)
+    
+            self.run_task("Saving point cloud...", task,
+                          lambda _: messagebox.showinfo("Label Change", f"{len(self.label_changes)} label changes applied. Point cloud saved."))
+        else:
+            messagebox.showwarning("Warning", "Save operation canceled. Point cloud reverted.")
+
+    def change_label_patch(self):
+        # Copy the .las file and patch only the changed label bytes of the copy
+        try:
+            remapper = LabelRemapper(self.label_changes)
+        except ValueError:
+            messagebox.showerror("Error", "Invalid label format. Please enter valid integers.")
+            return
+    
+        file_path, _ = os.path.splitext(self.file_path)
+        save_path = filedialog.asksaveasfilename(defaultextension=".las",
+                                                    filetypes=[("LAS Files", "*.las")],
+                                                    initialfile=f"{file_path}_updated.las")
+        if save_path:
+            input_path = self.file_path
+            self.run_task("Patching point cloud...",
+                          lambda report, cancel_event: patch_las_file(input_path, save_path, remapper, chunk_size=self.chunk_size, timer=self.timer),
+                          lambda _: messagebox.showinfo("Label Change", f"{len(self.label_changes)} label changes applied. Point cloud saved."))
+        else:
+            messagebox.showwarning("Warning", "Save operation canceled. Point cloud reverted.")
+
+    def save_applied_changes(self):
+        # Save the updated point cloud
+        save_path = self.ask_save_path()
+        if save_path:
+            self.run_task("Saving point cloud...", lambda report, cancel_event: self.write_las(save_path, report, cancel_event),
+                          lambda _: messagebox.showinfo("Label Change", f"{len(self.label_changes)} label changes applied. Point cloud saved."))
+        else:
+            self.session.revert()
+            messagebox.showwarning("Warning", "Save operation canceled. Point cloud reverted.")
+
     def change_label(self):
-        if self.point_cloud is not None:
+        if self.patch_las_var.get() and self.file_path and self.label_changes and not self.rules \
+                and self.processing_method == "Single" and is_las_file(self.file_path):
+            self.change_label_patch()
+            return
+    
+        if (self.streaming or self.rules) and self.file_path:
+            # Rules need every dimension, so they always run in the streaming pass
+            self.change_label_streaming()
+            return
+    
+        if self.session is not None:
             try:
                 if self.label_changes:
                     if self.processing_method == "Single":
                         self.process_single_method()
                     elif self.processing_method == "Batch":
-                        self.process_batch_method()
-                        messagebox.showinfo("Label Change", f"{len(self.label_changes)} label changes applied to all files. Point cloud saved.")
+                        self.run_batch_task()
                         return  # Stop further execution after processing batch method
                     else:
                         print("Processing method not selected")
     
-                    for i, (old_label, new_label) in enumerate(self.label_changes, start=1):
-                        try:
-                            old_label = int(old_label)
-                            new_label = int(new_label)
-                        except ValueError:
-                            messagebox.showerror("Error", "Invalid label format. Please enter valid integers.")
-                            return
-    
-                        if old_label not in self.get_unique_labels():
-                            messagebox.showerror("Error", f"Selected label {old_label} does not exist.")
-                            return
-    
-                        mask = self.point_cloud[:, -1] == old_label
-                        self.point_cloud[mask, -1] = new_label
-    
-                
-                # Save the updated point cloud
-                file_path, _ = os.path.splitext(self.file_path)  # Get the file path without extension
-                save_path = filedialog.asksaveasfilename(defaultextension=".laz",
-                                                            filetypes=[("LAS Files", "*.laz")],
-                                                            initialfile=f"{file_path}_updated.laz")
-                if save_path:
-                    self.write_las(save_path, self.point_cloud)
-                    messagebox.showinfo("Label Change", f"{len(self.label_changes)} label changes applied. Point cloud saved.")
+                    self.apply_label_changes(self.save_applied_changes)
                 else:
-                    messagebox.showwarning("Warning", "Save operation canceled. Point cloud reverted.")
+                    self.save_applied_changes()
             except ValueError:
                 messagebox.showerror("Error", "Invalid input. Please enter valid labels.")
     
@@ -408,82 +904,45 @@ class PointCloudLabelChanger:
                 self.update_available_labels()
     
         elif self.label_changes:
-            for i, (old_label, new_label) in enumerate(self.label_changes, start=1):
-                try:
-                    old_label = int(old_label)
-                    new_label = int(new_label)
-                except ValueError:
-                    messagebox.showerror("Error", "Invalid label format. Please enter valid integers.")
-                    return
-    
-                if old_label not in self.get_unique_labels():
-                    messagebox.showerror("Error", f"Selected label {old_label} does not exist.")
-                    return
-    
-                mask = self.point_cloud[:, -1] == old_label
-                self.point_cloud[mask, -1] = new_label
-    
             # Update available labels after label changes
-            self.update_available_labels()
+            self.apply_label_changes(self.update_available_labels)
     
         # except ValueError:
         #     messagebox.showerror("Error", "Invalid input. Please enter valid labels.")
 
 
-    def write_las(self, file_path, point_cloud):
-        # Read the original LAS file
-        original_ptcloud_path = self.file_path  
-        original_ptcloud = laspy.read(original_ptcloud_path)
-    
-        # Iterate through the list of label changes
-        for old_label, new_label in self.label_changes:
-            print(f"Attempting to change label: {old_label} to {new_label}")
-    
-            try:
-                old_label = int(old_label)
-                new_label = int(new_label)
-            except ValueError:
-                print("Invalid label format.")
-                messagebox.showerror("Error", "Invalid label format. Please enter valid labels.")
-                return
-    
-            print(f"Converted labels to int: {old_label} to {new_label}")
-    
-            # Check if the old label exists
-            available_labels = self.get_unique_labels()
-            print(f"Available labels: {available_labels}")
-    
-            # Modify the Ext_Class field
-            mask = original_ptcloud.Ext_Class == old_label  
-            original_ptcloud.Ext_Class[mask] = new_label
-            
-            
-        # Save the updated point cloud with new labels
-        file_path, _ = os.path.splitext(self.file_path)
-        updated_file_path = f"{file_path}_updated.laz"
-        original_ptcloud.write(updated_file_path)
-    
-        # Writing out the new point cloud
-        out_las = laspy.create(file_version="1.4", point_format=7)
-        out_las.header.offset = [original_ptcloud.x.min(), original_ptcloud.y.min(), original_ptcloud.z.min()]
-        out_las.header.scale = [0.1, 0.1, 0.1]
-        out_las.x = original_ptcloud.x
-        out_las.y = original_ptcloud.y
-        out_las.z = original_ptcloud.z
-        out_las.intensity = original_ptcloud.intensity
-        out_las.red = original_ptcloud.red
-        out_las.green = original_ptcloud.green
-        out_las.blue = original_ptcloud.blue
-        out_las.gps_time = original_ptcloud.gps_time
-        out_las.classification = original_ptcloud.classification
-        out_las.Ext_Class = original_ptcloud.Ext_Class  
-        
-    
-        # Ensure that 'Ext_Class' attribute is available in 'point_cloud'
-        if 'Ext_Class' in original_ptcloud.point_format.dimension_names:
-            ext_class_index = list(original_ptcloud.point_format.dimension_names).index('Ext_Class')
-            if ext_class_index < point_cloud.shape[1]:
-                out_las.Ext_Class = point_cloud[:, ext_class_index]
+    def preview_label_changes(self):
+        # Dry run: predicted points per rule and per file from the label histograms
+        if not self.file_path or not self.label_changes:
+            messagebox.showerror("Error", "Please open a point cloud and add label changes first.")
+            return
+        try:
+            remapper = LabelRemapper(self.label_changes)
+        except ValueError:
+            messagebox.showerror("Error", "Invalid label format. Please enter valid integers.")
+            return
+    
+        files = self.get_loaded_files()
+        session = self.session if self.processing_method == "Single" else None
+    
+        def histogram(file_path):
+            # The loaded labels in Single mode, otherwise the cached per-file histogram
+            if session is not None:
+                return label_histogram(session.labels)
+            return self.label_cache.histogram(file_path, chunk_size=self.chunk_size, backend=self.laz_backend, timer=self.timer)
+    
+        def task(report, cancel_event):
+            return preview_batch(files, remapper, histogram, progress=lambda done, total: report(files_done=done, files_total=total),
+                                 cancel_event=cancel_event)
+    
+        self.run_task("Previewing label changes...", task,
+                      lambda preview: messagebox.showinfo("Label Change Preview", format_preview(preview)))
+
+    def write_las(self, file_path, report=None, cancel_event=None):
+        # Stream the input once and write it with the session's edited labels
+        print(f"Saving label changes: {self.session.edits}")
+        return self.session.save(file_path, cancel_event=cancel_event, timer=self.timer, laz_chunk_size=self.laz_chunk_size,
+                                 progress=lambda done, total: report(points_done=done, points_total=total) if report else None)
 #%% Function for Single / Batch Process
     #Single Processing
     def process_single_method(self):
@@ -491,83 +950,58 @@ class PointCloudLabelChanger:
         # Logic for the "Single" processing method
     
     ########Batch Processing #######
-    def process_batch_method(self):
+    def run_batch_task(self):
+        # Validate on the Tk thread, then run the whole batch in the background
+        try:
+            LabelRemapper(self.label_changes)
+        except ValueError:
+            messagebox.showerror("Error", "Invalid label format. Please enter valid labels.")
+            return
+    
+        def done(summary):
+            if summary is not None and (summary["failed"] or summary["cancelled"]):
+                messagebox.showwarning("Batch Errors", format_batch_summary(summary))
+            else:
+                messagebox.showinfo("Label Change", f"{len(self.label_changes)} label changes applied to all files. Point cloud saved.")
+    
+        self.patch_las = self.patch_las_var.get()
+        self.pipeline = self.pipeline_var.get()
+        self.resume = self.resume_var.get()
+        self.verify_journal = self.verify_journal_var.get()
+        self.run_task("Processing batch...", self.process_batch_method, done)
+
+    def process_batch_method(self, report=None, cancel_event=None):
        print("Processing Batch method")
        # Logic for the "Batch" processing method
        directory = os.path.dirname(self.file_path)
-       file_pattern = os.path.join(directory, '*.laz')
-       files = glob.glob(file_pattern)
-       
-       # # Initialize a set to store unique labels across all files
-       # unique_labels_set = set()
-
-       for original_ptcloud_path in files:
-           #Read each point cloud file
-           original_ptcloud = laspy.read(original_ptcloud_path)
-           # # Get unique labels in the current point cloud file
-           # current_labels = np.unique(original_ptcloud.Ext_Class).astype(int)
-           
-           # # Add unique labels to the set
-           # unique_labels_set.update(current_labels)
-
-           # Apply label changes to each point cloud
-           self.batch_label_change_save(original_ptcloud, original_ptcloud_path)
-
-       # # Convert the set of unique labels to a sorted list
-       # unique_labels_list = sorted(list(unique_labels_set))
-
-       # # Update the available labels in the GUI
-       # self.available_labels_var.set("\n".join(map(str, unique_labels_list)))           
-                
-    def batch_label_change_save(self, original_ptcloud, file_path):            
-        # Iterate through the list of label changes
-        
-        for old_label, new_label in self.label_changes:
-            print(f"Attempting to change label: {old_label} to {new_label}")
-    
-            try:
-                old_label = int(old_label)
-                new_label = int(new_label)
-            except ValueError:
-                print("Invalid label format.")
-                messagebox.showerror("Error", "Invalid label format. Please enter valid labels.")
-                return
-    
-            print(f"Converted labels to int: {old_label} to {new_label}")
-    
-            # Check if the old label exists
-            available_labels = self.get_unique_labels()
-            print(f"Available labels: {available_labels}")
-    
-            # Modify the Ext_Class field
-            mask = original_ptcloud.Ext_Class == old_label  
-            original_ptcloud.Ext_Class[mask] = new_label
-    
-        # Save the updated point cloud with new labels
-        file_path, _ = os.path.splitext(file_path)
-        updated_file_path = f"{file_path}_updated.laz"
-        original_ptcloud.write(updated_file_path)
-    
-        # Writing out the new point cloud
-        out_las = laspy.create(file_version="1.4", point_format=7)
-        out_las.header.offset = [original_ptcloud.x.min(), original_ptcloud.y.min(), original_ptcloud.z.min()]
-        out_las.header.scale = [0.1, 0.1, 0.1]
-        out_las.x = original_ptcloud.x
-        out_las.y = original_ptcloud.y
-        out_las.z = original_ptcloud.z
-        out_las.intensity = original_ptcloud.intensity
-        out_las.red = original_ptcloud.red
-        out_las.green = original_ptcloud.green
-        out_las.blue = original_ptcloud.blue
-        out_las.gps_time = original_ptcloud.gps_time
-        out_las.classification = original_ptcloud.classification
-        out_las.Ext_Class = original_ptcloud.Ext_Class
-        
-        
-        
+       files = self.batch_files()
+       memory_limit = self.memory_limit or default_memory_limit()
+
+       def file_finished(result, files_done, files_total, points_done, points_total):
+           print(f"Finished {result['input']} ({result['points']} points)")
+           if report:
+               report(files_done, files_total, points_done, points_total)
+
+       # Farm the files out to the worker pool (largest files first), or stream them through
+       # the read/remap/write pipeline when only one worker is set; either way finished files
+       # are journaled and outputs only appear under their final name once complete
+       options = BatchOptions(workers=self.workers, input_root=directory, chunk_size=self.chunk_size,
+                              patch_las=self.patch_las, backend=self.laz_backend,
+                              laz_chunk_size=self.laz_chunk_size, output_format=self.output_format,
+                              rules=self.rules, pipeline=self.pipeline, memory_budget=self.pipeline_memory,
+                              unaffected=self.unaffected, memory_limit=memory_limit)
+       journal = BatchJournal(os.path.join(directory, JOURNAL_NAME), verify=self.verify_journal) \
+           if self.resume else None
+       summary = run_batch(files, self.label_changes, options, progress=file_finished, cancel_event=cancel_event,
+                           timer=self.timer, journal=journal, label_cache=self.label_cache)
+       print(format_batch_summary(summary))
+       return summary
+
+
 #%% 
 
 if __name__ == "__main__":
     root = tk.Tk()
     app = PointCloudLabelChanger(root)
     root.mainloop()
+    app.label_cache.close()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Point cloud file discovery for the Point Cloud Label Changer.
+
+Folders are walked with ``os.scandir``, which returns the file type with
+each entry, so a folder of hundreds of thousands of tiles costs one listing
+per directory and no extra stat calls. Files are yielded as they are found.
+Outputs of earlier runs (``*_updated.las/.laz`` and unfinished ``.partial``
+files) are recognized and left out, so a rerun never relabels its own
+results. Header summaries (point count, bounds, point record length and
+point format) are parsed straight from the fixed-layout public header
+instead of opening the file with laspy.
+
+@author: kenneyke
+"""
+
+import fnmatch
+import os
+import struct
+
+POINT_CLOUD_EXTENSIONS = (".las", ".laz")
+
+# Files written by this tool: final outputs, then unfinished outputs and queue temporaries
+OUTPUT_PATTERNS = ("*_updated.las", "*_updated.laz", "*.partial.las", "*.partial.laz", "*.tmp.las", "*.tmp.laz")
+
+# Public header: point format at byte 104 (the top two bits flag compression), point
+# record length at 105, legacy point count at 107, bounds
+# (max x, min x, max y, min y, max z, min z) at 179 and, from LAS 1.4 on, the 64-bit
+# point count at 247
+RECORD_LENGTH = struct.Struct("<H")
+LEGACY_COUNT = struct.Struct("<I")
+BOUNDS = struct.Struct("<6d")
+POINT_COUNT = struct.Struct("<Q")
+HEADER_BYTES = 375
+
+
+def is_output_file(file_path):
+    name = os.path.basename(file_path).lower()
+    return any(fnmatch.fnmatchcase(name, pattern) for pattern in OUTPUT_PATTERNS)
+
+
+def matches(relative_path, patterns):
+    # fnmatch on the path relative to the root (with / separators) or on the file name alone
+    relative_path = relative_path.replace(os.sep, "/").lower()
+    name = relative_path.rsplit("/", 1)[-1]
+    return any(fnmatch.fnmatchcase(relative_path, pattern.lower()) or fnmatch.fnmatchcase(name, pattern.lower())
+               for pattern in patterns)
+
+
+def iter_point_clouds(root, recursive=False, include=(), exclude=(), include_outputs=False):
+    """Yield the .las/.laz files under ``root`` as they are found.
+
+    ``include`` / ``exclude`` are fnmatch patterns (e.g. ``"tile_*"``,
+    ``"raw/*.laz"``) matched case-insensitively against the file name or the
+    path relative to ``root``; with ``include`` only matching files are
+    returned. Outputs of earlier runs are skipped unless ``include_outputs``
+    is set. Subfolders are walked depth first in name order when
+    ``recursive`` is set, without following directory symlinks. Files within
+    a folder come in directory listing order, each as soon as the listing
+    reaches it; callers that need a stable order sort the result. A single
+    file as ``root`` is yielded as is.
+    """
+    if os.path.isfile(root):
+        yield root
+        return
+    pending = [root]
+    while pending:
+        directory = pending.pop()
+        subfolders = []
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        if recursive:
+                            subfolders.append(entry.path)
+                        continue
+                    if os.path.splitext(entry.name)[1].lower() not in POINT_CLOUD_EXTENSIONS or not entry.is_file():
+                        continue
+                    if not include_outputs and is_output_file(entry.name):
+                        continue
+                    relative_path = os.path.relpath(entry.path, root)
+                    if include and not matches(relative_path, include):
+                        continue
+                    if exclude and matches(relative_path, exclude):
+                        continue
+                    yield entry.path
+        except OSError as e:
+            print(f"Skipping {directory}: {e}")
+        # Reversed so the stack visits subfolders in name order
+        pending.extend(sorted(subfolders, reverse=True))
+
+
+def read_header_summary(file_path):
+    """Point count, (mins, maxs) bounds, point record length and format id.
+
+    Only the first 375 bytes of the public header are read, nothing is
+    decompressed.
+    """
+    with open(file_path, "rb") as f:
+        header = f.read(HEADER_BYTES)
+    if len(header) < 227 or header[:4] != b"LASF":
+        raise ValueError(f"{file_path} is not a LAS/LAZ file")
+    (point_count,) = LEGACY_COUNT.unpack_from(header, 107)
+    if header[25] >= 4 and len(header) >= HEADER_BYTES:
+        point_count = POINT_COUNT.unpack_from(header, 247)[0] or point_count
+    max_x, min_x, max_y, min_y, max_z, min_z = BOUNDS.unpack_from(header, 179)
+    (record_length,) = RECORD_LENGTH.unpack_from(header, 105)
+    return point_count, (min_x, min_y, min_z), (max_x, max_y, max_z), record_length, header[104] & 0x3F
+
+
+def discover_point_clouds(root, recursive=False, include=(), exclude=(), include_outputs=False):
+    """Yield ``(file_path, point_count, mins, maxs, record_length, point_format_id)``.
+
+    Unreadable headers give a point count of 0 and no bounds, so the file is
+    still returned and fails with its own error when it is processed.
+    """
+    for file_path in iter_point_clouds(root, recursive, include, exclude, include_outputs):
+        try:
+            yield (file_path, *read_header_summary(file_path))
+        except (OSError, ValueError, struct.error):
+            yield file_path, 0, None, None, 0, None
@@ -0,0 +1,540 @@
+# -*- coding: utf-8 -*-
+"""
+Core (GUI independent) label changing engine used by the Point Cloud Label Changer.
+
+@author: kenneyke
+"""
+
+import os
+import shutil
+import struct
+import time
+
+import laspy
+import numpy as np
+
+from Ptc_Label_Profiler import file_size, timed
+
+# Number of points decoded/encoded at a time in streaming mode. Peak memory is
+# roughly chunk size x point record length, independent of the file size.
+DEFAULT_CHUNK_SIZE = 1_000_000
+
+# Largest label id for which a dense lookup table is built. Above this the
+# remapper falls back to a sorted-key search so huge/sparse ids stay cheap.
+DENSE_LUT_LIMIT = 1 << 16
+
+
+# LAZ layers (point formats 6-10) holding each standard dimension. Anything not
+# listed here is an extra bytes dimension such as Ext_Class.
+DIMENSION_LAYERS = {
+    "x": laspy.DecompressionSelection.XY_RETURNS_CHANNEL,
+    "y": laspy.DecompressionSelection.XY_RETURNS_CHANNEL,
+    "X": laspy.DecompressionSelection.XY_RETURNS_CHANNEL,
+    "Y": laspy.DecompressionSelection.XY_RETURNS_CHANNEL,
+    "return_number": laspy.DecompressionSelection.XY_RETURNS_CHANNEL,
+    "number_of_returns": laspy.DecompressionSelection.XY_RETURNS_CHANNEL,
+    "scanner_channel": laspy.DecompressionSelection.XY_RETURNS_CHANNEL,
+    "z": laspy.DecompressionSelection.Z,
+    "Z": laspy.DecompressionSelection.Z,
+    "classification": laspy.DecompressionSelection.CLASSIFICATION,
+    "synthetic": laspy.DecompressionSelection.FLAGS,
+    "key_point": laspy.DecompressionSelection.FLAGS,
+    "withheld": laspy.DecompressionSelection.FLAGS,
+    "overlap": laspy.DecompressionSelection.FLAGS,
+    "scan_direction_flag": laspy.DecompressionSelection.FLAGS,
+    "edge_of_flight_line": laspy.DecompressionSelection.FLAGS,
+    "intensity": laspy.DecompressionSelection.INTENSITY,
+    "scan_angle": laspy.DecompressionSelection.SCAN_ANGLE,
+    "user_data": laspy.DecompressionSelection.USER_DATA,
+    "point_source_id": laspy.DecompressionSelection.POINT_SOURCE_ID,
+    "gps_time": laspy.DecompressionSelection.GPS_TIME,
+    "red": laspy.DecompressionSelection.RGB,
+    "green": laspy.DecompressionSelection.RGB,
+    "blue": laspy.DecompressionSelection.RGB,
+    "nir": laspy.DecompressionSelection.NIR,
+}
+
+
+def decompression_selection(dimensions):
+    """LAZ layers needed to read ``dimensions`` (a name or list of names).
+
+    Only point formats 6-10 store dimensions in separate layers; for older
+    formats the LAZ backend ignores the selection and decodes everything.
+    """
+    if isinstance(dimensions, str):
+        dimensions = [dimensions]
+    selection = laspy.DecompressionSelection.base()
+    for dimension in dimensions:
+        selection |= DIMENSION_LAYERS.get(dimension, laspy.DecompressionSelection.ALL_EXTRA_BYTES)
+    return selection
+
+
+# LAZ codec backends by the names used in the GUI and on the command line.
+# "auto" lets laspy pick the first available (lazrs parallel, then lazrs).
+LAZ_BACKENDS = {
+    "auto": None,
+    "lazrs-parallel": laspy.LazBackend.LazrsParallel,
+    "lazrs": laspy.LazBackend.Lazrs,
+    "laszip": laspy.LazBackend.Laszip,
+}
+
+
+def laz_backend(name):
+    # laspy laz_backend argument for a backend name (None for auto)
+    if name is None:
+        return None
+    if name not in LAZ_BACKENDS:
+        raise ValueError(f"Unknown LAZ backend {name!r}, expected one of {', '.join(LAZ_BACKENDS)}.")
+    return LAZ_BACKENDS[name]
+
+
+def laz_backend_self_test():
+    """Report which LAZ backends are installed and can round-trip a small file.
+
+    Returns ``{name: "ok" | "not installed" | error message}``.
+    """
+    import io
+
+    header = laspy.LasHeader(point_format=7, version="1.4")
+    header.add_extra_dim(laspy.ExtraBytesParams(name="Ext_Class", type=np.uint8))
+    las = laspy.LasData(header)
+    las.x = np.arange(1000, dtype=np.float64)
+    las.y = las.x
+    las.z = las.x
+    las.Ext_Class = np.arange(1000) % 256
+
+    report = {}
+    for name, backend in LAZ_BACKENDS.items():
+        if backend is None:
+            continue
+        if not backend.is_available():
+            report[name] = "not installed"
+            continue
+        try:
+            buffer = io.BytesIO()
+            las.write(buffer, do_compress=True, laz_backend=backend)
+            buffer.seek(0)
+            check = laspy.read(buffer, laz_backend=backend)
+            if not np.array_equal(check.Ext_Class, las.Ext_Class):
+                raise ValueError("round trip changed the data")
+            report[name] = "ok"
+        except Exception as e:
+            report[name] = f"{type(e).__name__}: {e}"
+    return report
+
+
+# Output formats by the names used in the GUI and on the command line. "keep"
+# writes each output in the format of its input.
+OUTPUT_FORMATS = {
+    "laz": ".laz",
+    "las": ".las",
+    "keep": None,
+}
+
+
+def output_extension(input_path, output_format="laz"):
+    # Extension of the relabeled copy of ``input_path``
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format {output_format!r}, expected one of {', '.join(OUTPUT_FORMATS)}.")
+    return OUTPUT_FORMATS[output_format] or os.path.splitext(input_path)[1].lower()
+
+
+class ChunkedLazWriter(laspy.LasWriter):
+    """LasWriter that compresses with a chosen LAZ chunk size.
+
+    laspy always uses the LASzip default of 50,000 points per chunk. Smaller
+    chunks give finer random access and better parallel decompression, larger
+    ones slightly smaller files. Only the lazrs backends honor the setting,
+    with laszip the default is kept.
+    """
+
+    def __init__(self, dest, header, laz_chunk_size=None, **kwargs):
+        self.laz_chunk_size = laz_chunk_size
+        super().__init__(dest, header, **kwargs)
+
+    def _create_laz_backend(self, laz_backends):
+        point_writer = super()._create_laz_backend(laz_backends)
+        vlr = getattr(point_writer, "vlr", None)
+        if self.laz_chunk_size and vlr is not None and hasattr(vlr, "chunk_size"):
+            import lazrs
+
+            # chunk_size is the u32 at byte 12 of the LASzip VLR record
+            record = bytearray(vlr.record_data())
+            struct.pack_into("<I", record, 12, int(self.laz_chunk_size))
+            point_writer.vlr = lazrs.LazVlr(bytes(record))
+        return point_writer
+
+
+def partial_output_path(output_path):
+    # Outputs are written here and renamed into place once complete, so a
+    # crash never leaves a finished-looking file behind
+    base_path, extension = os.path.splitext(output_path)
+    return f"{base_path}.partial{extension}"
+
+
+def open_point_writer(output_path, header, backend=None, laz_chunk_size=None):
+    # LAS or LAZ writer chosen from the extension of ``output_path``
+    compress = os.path.splitext(output_path)[1].lower() == ".laz"
+    return ChunkedLazWriter(open(output_path, "wb"), header, laz_chunk_size=laz_chunk_size, do_compress=compress,
+                            laz_backend=laz_backend(backend) if compress else None)
+
+
+class OperationCancelled(Exception):
+    """Raised between chunks/files when the user cancels a long operation."""
+
+
+class LabelRemapper:
+    """Compiles a list of (old, new) label changes into a single pass remap.
+
+    The changes are applied in order exactly like the original per-pair mask
+    loop, so (1 -> 2) followed by (2 -> 3) sends both 1 and 2 to 3.
+    """
+
+    def __init__(self, label_changes, dense_limit=DENSE_LUT_LIMIT):
+        # int() raises ValueError on bad input, same as the GUI loops expect
+        self.label_changes = [(int(old), int(new)) for old, new in label_changes]
+        self.dense_limit = dense_limit
+
+        # Resolve the sequential pairs once on the distinct old labels only. Each
+        # current value holds the group of old labels that now carry it, so a
+        # pair moves a whole group at once (smaller group merged into larger).
+        groups = {}
+        for old_label, new_label in self.label_changes:
+            groups.setdefault(old_label, [old_label])
+        olds = np.array(sorted(groups), dtype=np.int64)
+        for old_label, new_label in self.label_changes:
+            if old_label == new_label or old_label not in groups:
+                continue
+            moved = groups.pop(old_label)
+            target = groups.get(new_label)
+            if target is None:
+                groups[new_label] = moved
+            elif len(target) >= len(moved):
+                target.extend(moved)
+            else:
+                moved.extend(target)
+                groups[new_label] = moved
+        final_of = {old: value for value, members in groups.items() for old in members}
+        finals = np.array([final_of[old] for old in olds.tolist()], dtype=np.int64)
+
+        # Keep only the labels that actually change value
+        changed = finals != olds
+        self.keys = olds[changed]
+        self.values = finals[changed]
+        self._lut_cache = {}
+
+    @classmethod
+    def from_compiled(cls, label_changes, keys, values, dense_limit=DENSE_LUT_LIMIT):
+        # Remapper from already resolved keys/values (e.g. a cached mapping table)
+        remapper = cls.__new__(cls)
+        remapper.label_changes = [(int(old), int(new)) for old, new in label_changes]
+        remapper.dense_limit = dense_limit
+        remapper.keys = np.asarray(keys, dtype=np.int64)
+        remapper.values = np.asarray(values, dtype=np.int64)
+        remapper._lut_cache = {}
+        return remapper
+
+    def __bool__(self):
+        return self.keys.size > 0
+
+    def affects(self, labels):
+        # True when any of ``labels`` (e.g. the keys of a histogram) changes value
+        return bool(np.isin(self.keys, np.fromiter(labels, dtype=np.int64)).any())
+
+    @property
+    def mapping(self):
+        # Final {old: new} mapping after the sequential pairs are resolved
+        return dict(zip(self.keys.tolist(), self.values.tolist()))
+
+    def check_fits(self, dtype):
+        # ValueError when a new label is outside the range of a ``dtype`` label field
+        if self.values.size and np.issubdtype(dtype, np.integer):
+            info = np.iinfo(dtype)
+            bad = self.values[(self.values < info.min) | (self.values > info.max)]
+            if bad.size:
+                raise ValueError(f"New label {bad[0]} does not fit in the {np.dtype(dtype)} label field.")
+
+    def _dense_lut(self, dtype, size):
+        key = (dtype.str, size)
+        lut = self._lut_cache.get(key)
+        if lut is None:
+            lut = np.arange(size, dtype=dtype)
+            # Negative keys would index the table from its end
+            keep = (self.keys >= 0) & (self.keys < size)
+            lut[self.keys[keep]] = self.values[keep]
+            self._lut_cache[key] = lut
+        return lut
+
+    def apply(self, labels, out=None):
+        """Return ``labels`` with every change applied in one pass.
+
+        Pass ``out=labels`` to remap in place. Float label arrays (e.g. the
+        stacked N x 5 point cloud column) are remapped on an integer copy.
+        """
+        labels = np.asarray(labels)
+        if out is None:
+            out = labels.copy()
+        elif out is not labels:
+            out[...] = labels
+        if not self or labels.size == 0:
+            return out
+
+        if not np.issubdtype(labels.dtype, np.integer):
+            int_labels = labels.astype(np.int64)
+            out[...] = self.apply(int_labels, out=int_labels)
+            return out
+
+        self.check_fits(labels.dtype)
+        dtype = labels.dtype
+        if dtype.itemsize <= 2 and np.issubdtype(dtype, np.unsignedinteger):
+            # uint8/uint16 labels: a full table covers every possible value
+            np.take(self._dense_lut(dtype, 1 << (8 * dtype.itemsize)), labels, out=out, mode="clip")
+        elif self.keys.min() >= 0 and self.keys.max() < self.dense_limit:
+            size = int(self.keys.max()) + 1
+            lut = self._dense_lut(dtype, size)
+            in_range = (labels >= 0) & (labels < size)
+            out[in_range] = lut[labels[in_range]]
+        else:
+            # Sparse / huge ids: binary search against the sorted keys
+            idx = np.searchsorted(self.keys, labels)
+            idx[idx == self.keys.size] = 0
+            hit = self.keys[idx] == labels
+            out[hit] = self.values[idx[hit]]
+        return out
+
+
+def load_label_changes(file_path):
+    """Read (old, new) label pairs from the first two columns of a sheet.
+
+    Same layout the GUI expects: old labels in the first column, new labels in
+    the second, with a heading row. See ``Ptc_Label_Mapping.load_mapping``
+    for the supported formats.
+    """
+    from Ptc_Label_Mapping import load_mapping
+
+    return load_mapping(file_path).label_changes
+
+
+def iter_label_chunks(file_path, dimension="Ext_Class", chunk_size=DEFAULT_CHUNK_SIZE, backend=None):
+    # Yields the label column of a point cloud chunk by chunk, decompressing only its layer
+    with laspy.open(file_path, laz_backend=laz_backend(backend),
+                    decompression_selection=decompression_selection(dimension)) as reader:
+        for points in reader.chunk_iterator(chunk_size):
+            yield np.asarray(points[dimension])
+
+
+def scan_unique_labels(file_path, dimension="Ext_Class", chunk_size=DEFAULT_CHUNK_SIZE, backend=None):
+    # Unique labels of a file without holding the whole point cloud in memory
+    unique_labels = set()
+    for labels in iter_label_chunks(file_path, dimension, chunk_size, backend):
+        unique_labels.update(np.unique(labels).tolist())
+    return sorted(unique_labels)
+
+
+def label_histogram(labels):
+    # {label: count} of one label array; bincount for small unsigned labels
+    labels = np.asarray(labels)
+    if labels.dtype.kind == "u" and labels.dtype.itemsize <= 2:
+        counts = np.bincount(labels)
+        present = np.flatnonzero(counts)
+        return dict(zip(present.tolist(), counts[present].tolist()))
+    values, counts = np.unique(labels, return_counts=True)
+    return dict(zip(values.tolist(), counts.tolist()))
+
+
+def scan_label_histogram(file_path, dimension="Ext_Class", chunk_size=DEFAULT_CHUNK_SIZE, backend=None, timer=None):
+    # Per label point counts of a file, accumulated chunk by chunk
+    start = time.perf_counter()
+    histogram = {}
+    for labels in iter_label_chunks(file_path, dimension, chunk_size, backend):
+        for label, count in label_histogram(labels).items():
+            histogram[label] = histogram.get(label, 0) + count
+    if timer is not None:
+        timer.add("label_scan", time.perf_counter() - start, file_path, sum(histogram.values()), file_size(file_path))
+    return histogram
+
+
+def preview_histogram(histogram, label_changes):
+    """Predicted effect of ``label_changes`` on a ``{label: count}`` histogram.
+
+    The pairs are replayed in order on the counts, so nothing is read or
+    written. Returns the histogram after the changes and the number of points
+    each pair moves (a later pair also moves points an earlier one produced).
+    """
+    after = dict(histogram)
+    rule_points = []
+    for old_label, new_label in label_changes:
+        moved = after.get(old_label, 0)
+        if moved and old_label != new_label:
+            del after[old_label]
+            after[new_label] = after.get(new_label, 0) + moved
+        rule_points.append(moved if old_label != new_label else 0)
+    return after, rule_points
+
+
+def relabel_file_streaming(input_path, output_path, remapper, dimension="Ext_Class",
+                           chunk_size=DEFAULT_CHUNK_SIZE, progress=None, cancel_event=None, backend=None,
+                           timer=None, rules=None, laz_chunk_size=None):
+    """Read, remap and write a point cloud one chunk at a time.
+
+    The output keeps the input header (point format, scales, offsets, VLRs);
+    LAZ or LAS output is chosen from the extension of ``output_path``.
+    ``progress(points_done, points_total)`` is called after every chunk and
+    setting ``cancel_event`` stops between chunks (the partial output is
+    removed). ``backend`` names the LAZ codec used for both decompression
+    and compression. With a ``timer`` the read, remap and write time of every
+    chunk is recorded, plus the per-file total. ``rules`` (a
+    ``Ptc_Label_Rules.RuleSet``) are applied to each chunk after the label
+    remap. ``laz_chunk_size`` sets the points per LAZ chunk of a compressed
+    output. The output is written under a ``.partial`` name and renamed to
+    ``output_path`` when complete (which may be ``input_path`` itself).
+    Returns the number of points written.
+    """
+    point_count = 0
+    file_start = time.perf_counter()
+    target = partial_output_path(output_path)
+    try:
+        with laspy.open(input_path, laz_backend=laz_backend(backend)) as reader:
+            points_total = reader.header.point_count
+            if rules:
+                rules.validate(reader.header.point_format)
+            with open_point_writer(target, reader.header, backend, laz_chunk_size) as writer:
+                tick = time.perf_counter()
+                for points in reader.chunk_iterator(chunk_size):
+                    if cancel_event is not None and cancel_event.is_set():
+                        raise OperationCancelled()
+                    read_done = time.perf_counter()
+                    labels = np.asarray(points[dimension])
+                    points[dimension] = remapper.apply(labels, out=labels)
+                    if rules:
+                        rules.apply(points)
+                    remap_done = time.perf_counter()
+                    writer.write_points(points)
+                    write_done = time.perf_counter()
+                    point_count += len(points)
+                    if timer is not None:
+                        timer.add("read", read_done - tick, input_path, len(points))
+                        timer.add("remap", remap_done - read_done, input_path, len(points))
+                        timer.add("write", write_done - remap_done, output_path, len(points))
+                    if progress:
+                        progress(point_count, points_total)
+                    tick = time.perf_counter()
+    except BaseException:
+        if os.path.exists(target):
+            os.remove(target)
+        raise
+    os.replace(target, output_path)
+    if timer is not None:
+        timer.add("file", time.perf_counter() - file_start, input_path, point_count, file_size(input_path))
+    return point_count
+
+
+# Linux ioctl that clones a file's extents (reflink) on copy-on-write filesystems
+FICLONE = 0x40049409
+
+
+def clone_file(source, destination):
+    # Copy between open files inside the kernel; the method used, or None when unsupported
+    try:
+        import fcntl
+
+        fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+        return "reflink"
+    except (ImportError, OSError):
+        pass
+    if hasattr(os, "copy_file_range"):
+        try:
+            remaining = os.fstat(source.fileno()).st_size
+            while remaining > 0:
+                copied = os.copy_file_range(source.fileno(), destination.fileno(), remaining)
+                if copied == 0:
+                    return None
+                remaining -= copied
+            return "copy_file_range"
+        except OSError:
+            return None
+    return None
+
+
+def copy_file_fast(input_path, output_path):
+    """Copy a point cloud unchanged, without decoding it.
+
+    Tries a reflink clone (instant on copy-on-write filesystems such as
+    Btrfs and XFS), then ``copy_file_range`` (done by the kernel, and by the
+    server on NFS 4.2 / SMB shares), then a plain ``shutil.copyfile``. Like
+    the other writers the copy goes to a ``.partial`` name first. Returns
+    the method used.
+    """
+    target = partial_output_path(output_path)
+    try:
+        with open(input_path, "rb") as source, open(target, "wb") as destination:
+            method = clone_file(source, destination)
+        if method is None:
+            shutil.copyfile(input_path, target)
+            method = "copy"
+    except BaseException:
+        if os.path.exists(target):
+            os.remove(target)
+        raise
+    os.replace(target, output_path)
+    return method
+
+
+def patch_las_file(input_path, output_path, remapper, dimension="Ext_Class", chunk_size=DEFAULT_CHUNK_SIZE,
+                   timer=None):
+    """Remap the labels of an uncompressed LAS file by patching its bytes.
+
+    The point records are memory-mapped and the label field is accessed as a
+    strided view, so only the bytes of points whose label changes are written.
+    With ``output_path`` None (or equal to ``input_path``) the file is patched
+    in place, otherwise it is copied to a ``.partial`` name, patched and then
+    renamed to ``output_path``. Returns the number of points in the file.
+    """
+    file_start = time.perf_counter()
+    if output_path is None or os.path.abspath(output_path) == os.path.abspath(input_path):
+        output_path = target = input_path
+    else:
+        target = partial_output_path(output_path)
+        with timed(timer, "copy", input_path, nbytes=file_size(input_path)):
+            shutil.copyfile(input_path, target)
+
+    try:
+        with laspy.open(target) as reader:
+            header = reader.header
+        if header.are_points_compressed:
+            raise ValueError(f"{input_path} is compressed, only uncompressed LAS files can be patched.")
+        field = header.point_format.dtype().fields.get(dimension)
+        if field is None:
+            raise ValueError(f"{dimension} is not a whole field of point format {header.point_format.id}, "
+                             "it cannot be patched in place.")
+        field_dtype, field_offset = field[0], field[1]
+        record_length = header.point_format.size
+        point_count = header.point_count
+        if point_count == 0:
+            if target != output_path:
+                os.replace(target, output_path)
+            return 0
+
+        records = np.memmap(target, dtype=np.uint8, mode="r+", offset=header.offset_to_point_data,
+                            shape=(point_count * record_length,))
+        labels = np.ndarray(shape=(point_count,), dtype=field_dtype, buffer=records,
+                            offset=field_offset, strides=(record_length,))
+        with timed(timer, "patch", output_path, points=point_count):
+            for start in range(0, point_count, chunk_size):
+                block = labels[start:start + chunk_size]
+                new_block = remapper.apply(block)
+                # Write only the changed labels so untouched pages stay clean
+                changed = new_block != block
+                if changed.any():
+                    block[changed] = new_block[changed]
+            records.flush()
+        del labels, block, records
+    except Exception:
+        if target != input_path and os.path.exists(target):
+            os.remove(target)
+        raise
+    if target != output_path:
+        os.replace(target, output_path)
+    if timer is not None:
+        timer.add("file", time.perf_counter() - file_start, input_path, point_count, file_size(input_path))
+    return point_count
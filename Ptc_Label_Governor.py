@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Memory governor for batch runs of the Point Cloud Label Changer.
+
+How much memory a batch needs depends on the files (point count and point
+record length, both in the header), the mode each file runs in and how many
+files run at once. The governor estimates the peak of every file from its
+header, then picks the chunk size and the number of worker processes so the
+largest file can run next to files of typical size under a memory ceiling:
+chunks shrink first, down to ``MIN_CHUNK_SIZE``, and only then are workers
+dropped, so as many cores as possible stay busy. While the batch runs, a
+file starts only when its estimate fits next to the files already running;
+a second large file waits for memory to free up while smaller ones go
+ahead, and a file larger than the whole ceiling runs alone.
+
+The estimates are calibrated on laspy 2 with the lazrs backend (peak RSS
+over the process baseline).
+
+@author: kenneyke
+"""
+
+import os
+
+import numpy as np
+
+from Ptc_Label_Engine import DEFAULT_CHUNK_SIZE
+
+# Copies of a chunk's point records alive while it is streamed: the decompressed
+# records, the parsed points and the encoder's input (measured 2.1x for LAS, 2.6x for LAZ)
+STREAM_COPIES = 3
+
+# A whole file loaded with laspy.read, plus the copy written back out
+LOAD_COPIES = 2
+
+# Interpreter, numpy, laspy and the LAZ backend in every worker process
+WORKER_OVERHEAD = 64 * 1024 ** 2
+
+# Share of the memory available at the start of a run it may use when no ceiling is set
+DEFAULT_MEMORY_FRACTION = 0.75
+
+# Chunks are not shrunk below this, fewer workers run instead
+MIN_CHUNK_SIZE = 50_000
+
+MODES = ("stream", "patch", "load", "copy")
+
+
+def available_memory():
+    # Physical memory free for new allocations (including reclaimable cache), or None when unknown
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    if os.name == "nt":
+        import ctypes
+
+        class MemoryStatus(ctypes.Structure):
+            _fields_ = [("length", ctypes.c_ulong), ("memory_load", ctypes.c_ulong),
+                        ("total_physical", ctypes.c_ulonglong), ("available_physical", ctypes.c_ulonglong),
+                        ("total_page_file", ctypes.c_ulonglong), ("available_page_file", ctypes.c_ulonglong),
+                        ("total_virtual", ctypes.c_ulonglong), ("available_virtual", ctypes.c_ulonglong),
+                        ("available_extended_virtual", ctypes.c_ulonglong)]
+
+        status = MemoryStatus()
+        status.length = ctypes.sizeof(MemoryStatus)
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return status.available_physical
+        return None
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def default_memory_limit(fraction=DEFAULT_MEMORY_FRACTION):
+    # Ceiling for a run started now, or None (no ceiling) when the available memory is unknown
+    available = available_memory()
+    return int(available * fraction) if available else None
+
+
+def file_memory(point_count, record_length, mode="stream", chunk_size=DEFAULT_CHUNK_SIZE):
+    """Estimated peak bytes one file needs in ``mode``, without the process overhead.
+
+    "stream" reads, remaps and writes ``chunk_size`` points at a time,
+    "patch" memory-maps an uncompressed file and touches a chunk of records
+    at a time, "load" reads the whole file at once (``laspy.read``) and
+    "copy" byte-copies an unchanged file.
+    """
+    if mode == "copy":
+        return 0
+    if mode == "load":
+        return point_count * record_length * LOAD_COPIES
+    chunk_bytes = min(chunk_size, point_count) * record_length
+    if mode == "patch":
+        return chunk_bytes
+    if mode == "stream":
+        return chunk_bytes * STREAM_COPIES
+    raise ValueError(f"Unknown mode {mode!r}, expected one of {', '.join(MODES)}.")
+
+
+class MemoryGovernor:
+    """Chunk size, worker count and file admission under a memory ceiling.
+
+    With ``limit`` None every request is granted unchanged.
+    """
+
+    def __init__(self, limit=None, worker_overhead=WORKER_OVERHEAD, min_chunk_size=MIN_CHUNK_SIZE):
+        self.limit = limit
+        self.worker_overhead = worker_overhead
+        self.min_chunk_size = min_chunk_size
+
+    def plan(self, layouts, workers, chunk_size=DEFAULT_CHUNK_SIZE):
+        """The (workers, chunk_size) to run files of ``layouts`` with.
+
+        ``layouts`` holds a (point_count, record_length) pair per streamed
+        file. The plan fits the largest file streaming next to files of
+        median size on every other worker; requested values are never raised.
+        """
+        layouts = np.array([(count, length) for count, length in layouts if count and length], dtype=np.int64)
+        if self.limit is None or not len(layouts):
+            return workers, chunk_size
+        counts, lengths = layouts[:, 0], layouts[:, 1]
+
+        def fits(workers, chunk_points):
+            needs = np.minimum(counts, chunk_points) * lengths * STREAM_COPIES
+            return workers * self.worker_overhead + needs.max() + (workers - 1) * np.median(needs) <= self.limit
+
+        workers = max(1, min(workers, len(layouts)))
+        smallest_chunk = min(chunk_size, self.min_chunk_size)
+        while workers > 1 and not fits(workers, smallest_chunk):
+            workers -= 1
+        if fits(workers, chunk_size):
+            return workers, chunk_size
+        # Largest chunk size that fits, by bisection
+        low, high = smallest_chunk, chunk_size
+        while high - low > 1:
+            middle = (low + high) // 2
+            low, high = (middle, high) if fits(workers, middle) else (low, middle)
+        return workers, low
+
+    def pipeline_budget(self, memory_budget, chunk_bytes):
+        # Read-ahead budget of the single-process pipeline: what is left under the ceiling
+        # next to the chunk being encoded, at least one chunk (which runs it in lockstep)
+        if self.limit is None:
+            return memory_budget
+        spare = self.limit - self.worker_overhead - chunk_bytes * STREAM_COPIES
+        return max(chunk_bytes, min(memory_budget, spare))
+
+    def admit(self, estimates, running, workers):
+        """Index of the first of ``estimates`` that fits next to ``running``, or None.
+
+        ``estimates`` are the pending files' ``file_memory`` in the order they
+        should start, ``running`` those of the files in progress and
+        ``workers`` the size of the process pool, whose overhead is held
+        whether a worker is busy or not. Nothing running admits the first file
+        whatever its size, so an oversized file runs alone instead of never.
+        """
+        if not estimates:
+            return None
+        if self.limit is None or not running:
+            return 0
+        free = self.limit - workers * self.worker_overhead - sum(running)
+        for index, estimate in enumerate(estimates):
+            if estimate <= free:
+                return index
+        return None
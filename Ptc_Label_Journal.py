@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Completion journal for resumable batch runs of the Point Cloud Label Changer.
+
+Every file a batch finishes is appended to a JSON-lines journal with the
+fingerprint (size and modification time) of its input, the digest of the
+settings that decide its labels (label changes, rules and regions, label
+dimension) and the fingerprint of its output. A rerun of the same batch
+skips the files whose entry still matches, so only files that failed, never
+ran, or whose input or mapping changed are processed again.
+
+Outputs are only hashed (SHA-1) by a journal opened with ``verify``: hashing
+re-reads every output in the parent process, one file at a time, which would
+stall a pool of workers behind it and undo cheap reflink copies.
+
+Lines are appended and synced one at a time, and outputs only appear under
+their final name once complete (see ``partial_output_path``), so a crash at
+any point leaves at most one unreadable last line, which is ignored.
+
+@author: kenneyke
+"""
+
+import hashlib
+import json
+import os
+import time
+
+from Ptc_Label_Mapping import file_digest
+
+JOURNAL_NAME = "relabel_journal.jsonl"
+
+
+def file_fingerprint(file_path):
+    stat = os.stat(file_path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def settings_digest(label_changes, rules=None, dimension="Ext_Class"):
+    # SHA-1 of everything that decides the output labels of a file
+    data = {
+        "label_changes": [[int(old), int(new)] for old, new in label_changes],
+        "dimension": dimension,
+        "rules": [rule.text for rule in rules.rules] if rules else [],
+        "regions": {name: [[ring.tolist() for ring in polygon] for polygon in region.polygons]
+                    for name, region in rules.regions.items()} if rules else {},
+    }
+    return hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+class BatchJournal:
+    """Append-only journal of finished files, loaded once per batch.
+
+    Only the last entry of each (input, output) pair counts. With ``verify``
+    finished outputs are hashed when they are recorded, and a file is only
+    skipped when its output still has that SHA-1 (entries recorded without
+    a hash are redone), instead of trusting the output's size and
+    modification time.
+    """
+
+    def __init__(self, path, verify=False):
+        self.path = path
+        self.verify = verify
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A line cut short by a crash
+                        continue
+                    self.entries[entry["input"], entry["output"]] = entry
+
+    def completed(self, input_path, output_path, settings, fingerprint=None):
+        """The journal entry when ``input_path`` needs no work, else None.
+
+        The entry for this input and output must have the same settings, the
+        output must be unchanged since it was written, and the input must be
+        unchanged since it was read (for in-place patches, where the input is
+        the output, unchanged since it was written).
+        """
+        entry = self.entries.get((os.path.abspath(input_path), os.path.abspath(output_path)))
+        if entry is None or entry["settings"] != settings:
+            return None
+        try:
+            if file_fingerprint(output_path) != entry["output_fingerprint"]:
+                return None
+            expected = entry["output_fingerprint"] if entry["output"] == entry["input"] else entry["input_fingerprint"]
+            if (fingerprint or file_fingerprint(input_path)) != expected:
+                return None
+            if self.verify and (entry.get("output_sha1") is None
+                                or file_digest(output_path) != entry["output_sha1"]):
+                return None
+        except OSError:
+            return None
+        return entry
+
+    def record(self, result, settings, fingerprint):
+        # Append a finished file; ``fingerprint`` is its input as it was before the run
+        output_path = os.path.abspath(result["output"])
+        entry = {
+            "input": os.path.abspath(result["input"]),
+            "output": output_path,
+            "input_fingerprint": fingerprint,
+            "settings": settings,
+            "output_fingerprint": file_fingerprint(output_path),
+            "output_sha1": file_digest(output_path) if self.verify else None,
+            "points": result["points"],
+            "finished": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.entries[entry["input"], entry["output"]] = entry
+        return entry
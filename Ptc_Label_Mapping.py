@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+Label mapping tables for the Point Cloud Label Changer.
+
+Mappings hold old labels in the first column and new labels in the second,
+with an optional heading row, and can be read from .xlsx, .xls, .csv, .json
+and .parquet files. Parsed tables are cached by the SHA-1 of the source file,
+so reloading an unchanged mapping skips parsing (and Excel) entirely.
+
+@author: kenneyke
+"""
+
+import csv
+import hashlib
+import json
+import os
+import zipfile
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+from Ptc_Label_Engine import LabelRemapper
+
+DEFAULT_MAPPING_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".ptc_label_changer", "mappings")
+
+MAPPING_EXTENSIONS = (".xlsx", ".xls", ".csv", ".json", ".parquet")
+
+# SpreadsheetML namespaces used by the built-in .xlsx reader
+XLSX_MAIN = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+XLSX_REL = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+XLSX_PACKAGE_REL = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+
+
+class MappingTable:
+    """Ordered (old, new) label pairs held as two int64 arrays.
+
+    ``remapper()`` compiles the pairs into a ``LabelRemapper`` once and keeps
+    it, so the lookup table is built a single time however often the mapping
+    is applied.
+    """
+
+    def __init__(self, old_labels, new_labels, source=None, digest=None, compiled=None):
+        self.old_labels = np.asarray(old_labels, dtype=np.int64)
+        self.new_labels = np.asarray(new_labels, dtype=np.int64)
+        self.source = source
+        self.digest = digest
+        # (keys, values) of an already resolved remapper, e.g. from the cache
+        self.compiled = compiled
+        self._remapper = None
+
+    def __len__(self):
+        return self.old_labels.size
+
+    @property
+    def label_changes(self):
+        return list(zip(self.old_labels.tolist(), self.new_labels.tolist()))
+
+    def remapper(self):
+        if self._remapper is None:
+            if self.compiled is not None:
+                self._remapper = LabelRemapper.from_compiled(self.label_changes, *self.compiled)
+            else:
+                self._remapper = LabelRemapper(self.label_changes)
+                self.compiled = (self._remapper.keys, self._remapper.values)
+        return self._remapper
+
+    def filter(self, available_labels):
+        # Pairs whose old label is among ``available_labels``
+        keep = np.isin(self.old_labels, np.asarray(list(available_labels), dtype=np.int64))
+        return MappingTable(self.old_labels[keep], self.new_labels[keep], self.source)
+
+    def check_range(self, dtype):
+        # ValueError naming the rows whose labels do not fit the label field
+        dtype = np.dtype(dtype)
+        if not np.issubdtype(dtype, np.integer) or not len(self):
+            return
+        info = np.iinfo(dtype)
+        bad = np.flatnonzero((self.old_labels < info.min) | (self.old_labels > info.max)
+                             | (self.new_labels < info.min) | (self.new_labels > info.max))
+        if bad.size:
+            raise ValueError(f"{bad.size} mapping rows do not fit the {dtype} label field "
+                             f"(first: pair {bad[0] + 1}, {self.old_labels[bad[0]]} -> {self.new_labels[bad[0]]}).")
+
+
+def file_digest(file_path):
+    sha1 = hashlib.sha1()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def to_label_arrays(old_values, new_values):
+    """Validate two columns of raw cell values and return them as int64 arrays.
+
+    A leading heading row is dropped. Every remaining cell must be a whole
+    number; the check is done on the whole column at once and the error names
+    the first offending row.
+    """
+    old_values = np.asarray(old_values, dtype=object)
+    new_values = np.asarray(new_values, dtype=object)
+    if old_values.size and (is_heading(old_values[0]) or is_heading(new_values[0])):
+        old_values, new_values = old_values[1:], new_values[1:]
+        first_row = 2
+    else:
+        first_row = 1
+    old_numbers, new_numbers = to_numbers(old_values), to_numbers(new_values)
+    bad = ~(np.isfinite(old_numbers) & np.isfinite(new_numbers)
+            & (old_numbers == np.trunc(old_numbers)) & (new_numbers == np.trunc(new_numbers))
+            & (np.abs(old_numbers) < 2 ** 63) & (np.abs(new_numbers) < 2 ** 63))
+    if bad.any():
+        row = int(np.flatnonzero(bad)[0])
+        raise ValueError(f"Row {row + first_row}: labels must be whole numbers, got "
+                         f"{old_values[row]!r} -> {new_values[row]!r}.")
+    return old_numbers.astype(np.int64), new_numbers.astype(np.int64)
+
+
+def to_numbers(values):
+    # float64 column, NaN where a cell is empty or not a number
+    try:
+        return np.asarray(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        numbers = np.full(values.size, np.nan)
+        for i, value in enumerate(values.tolist()):
+            try:
+                numbers[i] = float(value)
+            except (TypeError, ValueError):
+                pass
+        return numbers
+
+
+def is_heading(value):
+    try:
+        float(value)
+        return False
+    except (TypeError, ValueError):
+        return value is not None and str(value).strip() != ""
+
+
+def read_csv_columns(file_path):
+    with open(file_path, newline="", encoding="utf-8-sig") as f:
+        rows = [row for row in csv.reader(f) if any(cell.strip() for cell in row)]
+    if any(len(row) < 2 for row in rows):
+        raise ValueError(f"{file_path}: every row needs an old and a new label.")
+    return [row[0] for row in rows], [row[1] for row in rows]
+
+
+def read_json_columns(file_path):
+    # {"old": new, ...}, [[old, new], ...] or [{"old": .., "new": ..}, ...]
+    with open(file_path) as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        return list(data.keys()), list(data.values())
+    if all(isinstance(item, dict) for item in data):
+        return [item.get("old") for item in data], [item.get("new") for item in data]
+    return [item[0] for item in data], [item[1] for item in data]
+
+
+def read_parquet_columns(file_path):
+    import pyarrow.parquet as pq
+
+    table = pq.read_table(file_path)
+    if table.num_columns < 2:
+        raise ValueError(f"{file_path}: expected old and new label columns.")
+    return table.column(0).to_numpy(zero_copy_only=False), table.column(1).to_numpy(zero_copy_only=False)
+
+
+def read_xlsx_columns(file_path):
+    """Columns A and B of the first worksheet, read straight from the XML.
+
+    .xlsx workbooks are zipped SpreadsheetML, so the two label columns can be
+    read with the standard library instead of openpyxl.
+    """
+    with zipfile.ZipFile(file_path) as workbook:
+        names = set(workbook.namelist())
+        shared = []
+        if "xl/sharedStrings.xml" in names:
+            for item in ET.fromstring(workbook.read("xl/sharedStrings.xml")).iter(f"{XLSX_MAIN}si"):
+                shared.append("".join(t.text or "" for t in item.iter(f"{XLSX_MAIN}t")))
+
+        # First sheet in workbook order, resolved through the relationships
+        sheet = ET.fromstring(workbook.read("xl/workbook.xml")).find(f"{XLSX_MAIN}sheets")[0]
+        rel_id = sheet.get(f"{XLSX_REL}id")
+        sheet_path = "xl/worksheets/sheet1.xml"
+        for rel in ET.fromstring(workbook.read("xl/_rels/workbook.xml.rels")).iter(f"{XLSX_PACKAGE_REL}Relationship"):
+            if rel.get("Id") == rel_id:
+                target = rel.get("Target")
+                sheet_path = target.lstrip("/") if target.startswith("/") else "xl/" + target
+                break
+
+        old_values, new_values = [], []
+        with workbook.open(sheet_path) as f:
+            for _, row in ET.iterparse(f):
+                if row.tag != f"{XLSX_MAIN}row":
+                    continue
+                cells = {}
+                for cell in row.iter(f"{XLSX_MAIN}c"):
+                    column = "".join(ch for ch in cell.get("r", "") if ch.isalpha())
+                    if column not in ("A", "B"):
+                        continue
+                    kind = cell.get("t")
+                    if kind == "inlineStr":
+                        value = "".join(t.text or "" for t in cell.iter(f"{XLSX_MAIN}t"))
+                    else:
+                        v = cell.find(f"{XLSX_MAIN}v")
+                        value = None if v is None else v.text
+                        if kind == "s" and value is not None:
+                            value = shared[int(value)]
+                    cells[column] = value
+                row.clear()
+                if cells.get("A") is not None or cells.get("B") is not None:
+                    old_values.append(cells.get("A"))
+                    new_values.append(cells.get("B"))
+    return old_values, new_values
+
+
+def read_excel_columns(file_path):
+    # Legacy .xls workbooks still need pandas and an Excel engine
+    import pandas as pd
+
+    data = pd.read_excel(file_path, header=None)
+    return data.iloc[:, 0].tolist(), data.iloc[:, 1].tolist()
+
+
+MAPPING_READERS = {
+    ".xlsx": read_xlsx_columns,
+    ".xls": read_excel_columns,
+    ".csv": read_csv_columns,
+    ".json": read_json_columns,
+    ".parquet": read_parquet_columns,
+}
+
+
+def parse_mapping(file_path):
+    extension = os.path.splitext(file_path)[1].lower()
+    reader = MAPPING_READERS.get(extension)
+    if reader is None:
+        raise ValueError(f"Unsupported mapping file {file_path}, expected one of {', '.join(MAPPING_EXTENSIONS)}.")
+    old_values, new_values = reader(file_path)
+    return to_label_arrays(old_values, new_values)
+
+
+def load_mapping(file_path, cache_dir=DEFAULT_MAPPING_CACHE_DIR):
+    """Load a mapping file as a ``MappingTable``.
+
+    The parsed pairs and the compiled remap table are stored in ``cache_dir``
+    under the SHA-1 of the file contents, so an unchanged file (even renamed
+    or copied) is never parsed or compiled twice. Pass ``cache_dir=None`` to always parse. Cache errors are ignored.
+    """
+    digest = file_digest(file_path)
+    cache_path = os.path.join(cache_dir, f"{digest}.npz") if cache_dir else None
+    if cache_path and os.path.exists(cache_path):
+        try:
+            with np.load(cache_path) as cached:
+                return MappingTable(cached["old"], cached["new"], file_path, digest,
+                                    (cached["keys"], cached["values"]))
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Mapping cache read failed: {e}")
+
+    table = MappingTable(*parse_mapping(file_path), file_path, digest)
+    if cache_path:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            # Write then rename so a concurrent reader never sees a partial file
+            temp_path = f"{cache_path}.{os.getpid()}.tmp.npz"
+            remapper = table.remapper()
+            np.savez(temp_path, old=table.old_labels, new=table.new_labels, keys=remapper.keys, values=remapper.values)
+            os.replace(temp_path, cache_path)
+        except OSError as e:
+            print(f"Mapping cache write failed: {e}")
+    return table
@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+"""
+Pipelined batch relabeling for the Point Cloud Label Changer.
+
+Run one after the other, every file goes read -> remap -> write in lockstep,
+so the CPU waits while a chunk is decompressed and the disk idles while it
+is remapped. The pipeline runs the three stages on their own threads joined
+by bounded queues: while file N is remapped, the reader is already
+decompressing file N+1 and the writer is still compressing and writing
+file N-1. The stages overlap wherever they wait on the disk or run outside
+the GIL.
+
+Every chunk in flight holds its share of a ``MemoryBudget`` from the moment
+it is read until it is written; the reader blocks when the budget is spent,
+so read-ahead never holds more point records than the budget however far
+it gets ahead of the writer.
+
+@author: kenneyke
+"""
+
+import os
+import queue
+import threading
+import time
+
+import laspy
+import numpy as np
+
+from Ptc_Label_Engine import DEFAULT_CHUNK_SIZE, laz_backend, open_point_writer, partial_output_path
+from Ptc_Label_Profiler import file_size
+
+# Point records held between reading and writing, across all stages
+DEFAULT_PIPELINE_MEMORY = 512 * 1024 ** 2
+
+# Chunks waiting in each hand-off queue (prefetch and write-behind)
+PIPELINE_QUEUE_SIZE = 8
+
+
+class MemoryBudget:
+    """Bytes of point records in flight; ``acquire`` blocks past ``limit``.
+
+    A request larger than the whole budget is still granted when nothing
+    else is held, so an oversized chunk slows the pipeline down to lockstep
+    instead of stalling it.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, nbytes, abort=None):
+        # False when ``abort`` is set while waiting
+        with self.condition:
+            while self.used and self.used + nbytes > self.limit:
+                if abort is not None and abort.is_set():
+                    return False
+                self.condition.wait(0.1)
+            self.used += nbytes
+            self.peak = max(self.peak, self.used)
+            return True
+
+    def release(self, nbytes):
+        with self.condition:
+            self.used -= nbytes
+            self.condition.notify_all()
+
+
+class RelabelPipeline:
+    """Relabel (input, output) jobs with overlapped read, remap and write.
+
+    Chunks are relabeled exactly like ``relabel_file_streaming`` (label
+    remap, then ``rules``) and the outputs are the same, written under a
+    ``.partial`` name until complete; a file that fails at any stage is
+    reported with its error and its partial output removed, without stopping
+    the files around it.
+    """
+
+    def __init__(self, remapper, dimension="Ext_Class", chunk_size=DEFAULT_CHUNK_SIZE, backend=None, timer=None,
+                 rules=None, laz_chunk_size=None, memory_budget=DEFAULT_PIPELINE_MEMORY,
+                 queue_size=PIPELINE_QUEUE_SIZE):
+        self.remapper = remapper
+        self.dimension = dimension
+        self.chunk_size = chunk_size
+        self.backend = backend
+        self.timer = timer
+        self.rules = rules
+        self.laz_chunk_size = laz_chunk_size
+        self.budget = MemoryBudget(memory_budget)
+        self.queue_size = queue_size
+
+    def run(self, jobs, cancel_event=None):
+        """Yield a result dict per job as its output is complete.
+
+        Setting ``cancel_event`` stops the reader before its next chunk; the
+        file it was reading gets no result and its partial output is removed,
+        files already fully read are finished. Results are yielded in the
+        calling thread, so callers can update progress from the loop.
+        """
+        jobs = list(jobs)
+        prefetch = queue.Queue(self.queue_size)
+        write_behind = queue.Queue(self.queue_size)
+        results = queue.Queue()
+        abort = threading.Event()
+        errors = []
+
+        def put(target, item):
+            while not abort.is_set():
+                try:
+                    target.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def get(source):
+            while not abort.is_set():
+                try:
+                    return source.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            return None
+
+        def stage(function, *args):
+            # An unexpected error in one stage stops the others instead of hanging them
+            def target():
+                try:
+                    function(*args)
+                except BaseException as e:
+                    errors.append(e)
+                    abort.set()
+            return threading.Thread(target=target, name=f"relabel-{function.__name__}", daemon=True)
+
+        threads = [stage(self.read_stage, jobs, put, cancel_event, prefetch, abort),
+                   stage(self.remap_stage, jobs, put, get, prefetch, write_behind),
+                   stage(self.write_stage, jobs, put, get, write_behind, results)]
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                result = get(results)
+                if result is None:
+                    break
+                yield result
+        finally:
+            abort.set()
+            for thread in threads:
+                thread.join()
+        if errors:
+            raise errors[0]
+
+    def read_stage(self, jobs, put, cancel_event, prefetch, abort):
+        timer = self.timer
+        cancelled = False
+        for index, (input_path, output_path) in enumerate(jobs):
+            if cancel_event is not None and cancel_event.is_set():
+                break
+            if abort.is_set():
+                return
+            started = time.perf_counter()
+            held = 0
+            try:
+                with laspy.open(input_path, laz_backend=laz_backend(self.backend)) as reader:
+                    header = reader.header
+                    put(prefetch, ("start", index, (header, started)))
+                    remaining = header.point_count
+                    chunks = reader.chunk_iterator(self.chunk_size)
+                    while remaining > 0:
+                        if cancel_event is not None and cancel_event.is_set():
+                            # No "end" for this file, the writer drops its output
+                            cancelled = True
+                            break
+                        # Reserve the chunk before decompressing it
+                        held = min(self.chunk_size, remaining) * header.point_format.size
+                        if not self.budget.acquire(held, abort):
+                            held = 0
+                            return
+                        tick = time.perf_counter()
+                        points = next(chunks, None)
+                        if points is None or not len(points):
+                            break
+                        remaining -= len(points)
+                        if timer is not None:
+                            timer.add("read", time.perf_counter() - tick, input_path, len(points))
+                        put(prefetch, ("chunk", index, (points, held)))
+                        held = 0
+                if cancelled:
+                    break
+                put(prefetch, ("end", index, None))
+            except Exception as e:
+                put(prefetch, ("error", index, f"{type(e).__name__}: {e}"))
+            finally:
+                if held:
+                    self.budget.release(held)
+        put(prefetch, None)
+
+    def remap_stage(self, jobs, put, get, prefetch, write_behind):
+        timer = self.timer
+        failed = set()
+        while True:
+            item = get(prefetch)
+            if item is None:
+                put(write_behind, None)
+                return
+            kind, index, payload = item
+            if index in failed:
+                # The error was passed on already, drop the rest of the file
+                if kind == "chunk":
+                    self.budget.release(payload[1])
+                continue
+            try:
+                if kind == "start" and self.rules:
+                    self.rules.validate(payload[0].point_format)
+                elif kind == "chunk":
+                    points = payload[0]
+                    tick = time.perf_counter()
+                    labels = np.asarray(points[self.dimension])
+                    points[self.dimension] = self.remapper.apply(labels, out=labels)
+                    if self.rules:
+                        self.rules.apply(points)
+                    if timer is not None:
+                        timer.add("remap", time.perf_counter() - tick, jobs[index][0], len(points))
+            except Exception as e:
+                failed.add(index)
+                if kind == "chunk":
+                    self.budget.release(payload[1])
+                item = ("error", index, f"{type(e).__name__}: {e}")
+            put(write_behind, item)
+
+    def write_stage(self, jobs, put, get, write_behind, results):
+        timer = self.timer
+        open_files = {}
+        failed = set()
+
+        def finish(index, error=None):
+            writer, started, point_count = open_files.pop(index, (None, None, 0))
+            input_path, output_path = jobs[index]
+            if writer is not None:
+                try:
+                    writer.close()
+                except Exception as e:
+                    error = error or f"{type(e).__name__}: {e}"
+            if error is not None:
+                failed.add(index)
+                if os.path.exists(partial_output_path(output_path)):
+                    os.remove(partial_output_path(output_path))
+            elif writer is not None:
+                os.replace(partial_output_path(output_path), output_path)
+            seconds = time.perf_counter() - started if started is not None else 0.0
+            if timer is not None and error is None:
+                timer.add("file", seconds, input_path, point_count, file_size(input_path))
+            put(results, {"input": input_path, "output": output_path, "points": point_count if error is None else 0,
+                          "seconds": seconds, "error": error})
+
+        try:
+            while True:
+                item = get(write_behind)
+                if item is None:
+                    break
+                kind, index, payload = item
+                if index in failed:
+                    if kind == "chunk":
+                        self.budget.release(payload[1])
+                    continue
+                if kind == "error":
+                    finish(index, payload)
+                    continue
+                try:
+                    if kind == "start":
+                        header, started = payload
+                        writer = open_point_writer(partial_output_path(jobs[index][1]), header, self.backend,
+                                                   self.laz_chunk_size)
+                        open_files[index] = [writer, started, 0]
+                    elif kind == "chunk":
+                        points, held = payload
+                        tick = time.perf_counter()
+                        try:
+                            open_files[index][0].write_points(points)
+                        finally:
+                            self.budget.release(held)
+                        open_files[index][2] += len(points)
+                        if timer is not None:
+                            timer.add("write", time.perf_counter() - tick, jobs[index][1], len(points))
+                    elif kind == "end":
+                        finish(index)
+                except Exception as e:
+                    finish(index, f"{type(e).__name__}: {e}")
+        finally:
+            # Outputs left open by an abort or a cancel are incomplete
+            for index in list(open_files):
+                try:
+                    open_files.pop(index)[0].close()
+                except Exception:
+                    pass
+                if os.path.exists(partial_output_path(jobs[index][1])):
+                    os.remove(partial_output_path(jobs[index][1]))
+        put(results, None)
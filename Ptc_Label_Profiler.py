@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Per-stage timing and profiling hooks for the Point Cloud Label Changer.
+
+@author: kenneyke
+"""
+
+import cProfile
+import json
+import os
+import platform
+import time
+from contextlib import contextmanager, nullcontext
+
+
+class StageTimer:
+    """Accumulates wall time, points and bytes per (stage, file).
+
+    Repeated stages of the same file (e.g. one read per chunk) are merged into
+    a single record so traces of large batches stay small. Records from worker
+    processes are merged in with ``merge``.
+    """
+
+    def __init__(self, name="run"):
+        self.name = name
+        self.started = time.time()
+        self.records = {}
+
+    @contextmanager
+    def stage(self, stage, file_path=None, points=0, nbytes=0):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start, file_path, points, nbytes)
+
+    def add(self, stage, seconds, file_path=None, points=0, nbytes=0, count=1):
+        record = self.records.get((stage, file_path))
+        if record is None:
+            record = self.records[(stage, file_path)] = {"stage": stage, "file": file_path, "count": 0,
+                                                         "seconds": 0.0, "points": 0, "bytes": 0}
+        record["count"] += count
+        record["seconds"] += seconds
+        record["points"] += points
+        record["bytes"] += nbytes
+
+    def merge(self, records):
+        # Records from another timer (e.g. returned by a worker process)
+        for record in records:
+            self.add(record["stage"], record["seconds"], record["file"], record["points"], record["bytes"],
+                     record["count"])
+
+    def summary(self):
+        # Totals per stage with points/s and bytes/s
+        totals = {}
+        for record in self.records.values():
+            total = totals.setdefault(record["stage"], {"count": 0, "seconds": 0.0, "points": 0, "bytes": 0})
+            for key in ("count", "seconds", "points", "bytes"):
+                total[key] += record[key]
+        for total in totals.values():
+            seconds = total["seconds"]
+            total["points_per_s"] = total["points"] / seconds if seconds > 0 and total["points"] else None
+            total["bytes_per_s"] = total["bytes"] / seconds if seconds > 0 and total["bytes"] else None
+        return totals
+
+    def trace(self):
+        return {
+            "name": self.name,
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+            "wall_seconds": time.time() - self.started,
+            "host": platform.node(),
+            "pid": os.getpid(),
+            "summary": self.summary(),
+            "records": list(self.records.values()),
+        }
+
+    def write_trace(self, trace_path):
+        with open(trace_path, "w") as f:
+            json.dump(self.trace(), f, indent=2)
+        return trace_path
+
+
+def timed(timer, stage, file_path=None, points=0, nbytes=0):
+    # timer.stage(...) when timing is on, a no-op context otherwise
+    if timer is None:
+        return nullcontext()
+    return timer.stage(stage, file_path, points, nbytes)
+
+
+@contextmanager
+def profiled(profile_path=None):
+    # cProfile the enclosed block (current thread only) and dump the stats
+    if not profile_path:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(profile_path)
+
+
+def file_size(file_path):
+    try:
+        return os.path.getsize(file_path)
+    except OSError:
+        return 0
@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+"""
+Shared-filesystem work queue for multi-node batch runs.
+
+A batch is submitted as a job folder on storage every node mounts (e.g. a
+NAS share):
+
+    manifest.json      files, output paths, label changes, rules and settings
+    leases/<task>.lease  held by the worker relabeling that file
+    done/<task>.json     result of a finished file (written once)
+
+Any number of worker processes on any node run ``run_worker`` on the same
+folder. A worker claims a file by creating its lease with O_CREAT | O_EXCL,
+so exactly one worker wins it, and touches the lease every ``heartbeat``
+seconds while it works. A lease whose modification time has not moved for
+``lease_timeout`` seconds, measured on the observing node's own clock so
+clock skew between nodes does not matter, belongs to a dead worker: it is
+renamed away (only one reclaimer can succeed) and the file is claimed
+again. Outputs are written to a temporary name and renamed into place, so
+a reclaimed file never leaves a half-written output behind.
+
+Input and output paths are stored as given and must resolve to the same
+files on every node (same mount point).
+
+@author: kenneyke
+"""
+
+import json
+import multiprocessing
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from Ptc_Label_Batch import updated_output_path
+from Ptc_Label_Engine import (LabelRemapper, OperationCancelled, DEFAULT_CHUNK_SIZE, output_extension,
+                              relabel_file_streaming)
+from Ptc_Label_Rules import Rule, RuleSet
+from Ptc_Label_Spatial import Region
+
+MANIFEST_NAME = "manifest.json"
+DEFAULT_HEARTBEAT = 10.0
+DEFAULT_LEASE_TIMEOUT = 120.0
+DEFAULT_POLL_INTERVAL = 5.0
+
+
+def write_json_atomic(file_path, data):
+    # Write then rename so readers on other nodes never see a partial file
+    temp_path = f"{file_path}.{uuid.uuid4().hex}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(temp_path, file_path)
+
+
+def read_json(file_path):
+    with open(file_path) as f:
+        return json.load(f)
+
+
+def task_id(index):
+    return f"{index:06d}"
+
+
+def submit_job(job_dir, files, label_changes, output_dir=None, dimension="Ext_Class", chunk_size=DEFAULT_CHUNK_SIZE,
+               backend=None, rules=None, output_format="laz", laz_chunk_size=None,
+               lease_timeout=DEFAULT_LEASE_TIMEOUT, input_root=None):
+    """Write the manifest of a queued batch to ``job_dir``.
+
+    ``label_changes`` is a list of (old, new) pairs or a ``LabelRemapper``
+    and ``rules`` a ``RuleSet``; its rules are stored as text and its regions
+    as polygon coordinates, so workers need no other files. Outputs follow
+    the ``run_batch`` naming (``<name>_updated`` in ``output_dir``, below the
+    inputs' subfolders relative to ``input_root`` when given, or next to each
+    input). Returns the manifest path.
+    """
+    if isinstance(label_changes, LabelRemapper):
+        label_changes = label_changes.label_changes
+    manifest_path = os.path.join(job_dir, MANIFEST_NAME)
+    if os.path.exists(manifest_path):
+        raise FileExistsError(f"{job_dir} already holds a job, use a new folder")
+    for name in ("leases", "done"):
+        os.makedirs(os.path.join(job_dir, name), exist_ok=True)
+    files = [os.path.abspath(f) for f in files]
+    outputs = [os.path.abspath(updated_output_path(f, output_dir, output_extension(f, output_format),
+                                                   input_root and os.path.abspath(input_root))) for f in files]
+    for directory in {os.path.dirname(output_path) for output_path in outputs}:
+        os.makedirs(directory, exist_ok=True)
+    rules = rules or RuleSet()
+    write_json_atomic(manifest_path, {
+        "created": time.time(),
+        "files": files,
+        "outputs": outputs,
+        "label_changes": [[int(old), int(new)] for old, new in label_changes],
+        "dimension": dimension,
+        "chunk_size": chunk_size,
+        "laz_backend": backend,
+        "output_format": output_format,
+        "laz_chunk_size": laz_chunk_size,
+        "rules": [rule.text for rule in rules.rules],
+        "regions": {name: [[ring.tolist() for ring in polygon] for polygon in region.polygons]
+                    for name, region in rules.regions.items()},
+        "lease_timeout": lease_timeout,
+    })
+    return manifest_path
+
+
+def load_job(job_dir):
+    # Manifest plus the remapper and rule set it describes
+    manifest = read_json(os.path.join(job_dir, MANIFEST_NAME))
+    remapper = LabelRemapper(manifest["label_changes"])
+    rules = RuleSet([Rule.parse(text) for text in manifest["rules"]],
+                    [Region(name, polygons) for name, polygons in manifest["regions"].items()])
+    return manifest, remapper, rules
+
+
+class Lease:
+    """A claimed task, kept alive by a heartbeat thread.
+
+    ``lost`` is set when the lease file disappears or is taken over by
+    another worker, which cancels the file being relabeled.
+    """
+
+    def __init__(self, path, worker_id, heartbeat):
+        self.path = path
+        self.worker_id = worker_id
+        self.heartbeat = heartbeat
+        self.lost = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.beat, daemon=True)
+
+    @classmethod
+    def claim(cls, path, worker_id, heartbeat=DEFAULT_HEARTBEAT):
+        # None when another worker holds the task
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return None
+        with os.fdopen(fd, "w") as f:
+            json.dump({"worker": worker_id, "host": socket.gethostname(), "pid": os.getpid(),
+                       "claimed": time.time()}, f)
+        lease = cls(path, worker_id, heartbeat)
+        lease.thread.start()
+        return lease
+
+    def held(self):
+        try:
+            return read_json(self.path).get("worker") == self.worker_id
+        except (OSError, ValueError):
+            return False
+
+    def beat(self):
+        while not self.stopped.wait(self.heartbeat):
+            if not self.held():
+                self.lost.set()
+                return
+            try:
+                os.utime(self.path)
+            except OSError:
+                self.lost.set()
+                return
+
+    def release(self):
+        self.stopped.set()
+        self.thread.join()
+        if self.held():
+            os.remove(self.path)
+
+
+def run_task(manifest, index, remapper, rules, lease, worker_id):
+    # Relabel one file into a temporary output that is renamed into place while the lease is held
+    input_path, output_path = manifest["files"][index], manifest["outputs"][index]
+    base_path, extension = os.path.splitext(output_path)
+    temp_path = f"{base_path}.{uuid.uuid4().hex[:8]}.tmp{extension}"
+    start = time.perf_counter()
+    result = {"input": input_path, "output": output_path, "points": 0, "seconds": 0.0, "error": None,
+              "worker": worker_id}
+    try:
+        result["points"] = relabel_file_streaming(input_path, temp_path, remapper, manifest["dimension"],
+                                                  manifest["chunk_size"], cancel_event=lease.lost,
+                                                  backend=manifest["laz_backend"], rules=rules,
+                                                  laz_chunk_size=manifest["laz_chunk_size"])
+        if not lease.held():
+            raise OperationCancelled()
+        os.replace(temp_path, output_path)
+    except OperationCancelled:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return None
+    except Exception as e:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        result["error"] = f"{type(e).__name__}: {e}"
+    result["seconds"] = time.perf_counter() - start
+    result["finished"] = time.time()
+    return result
+
+
+def run_worker(job_dir, worker_id=None, heartbeat=DEFAULT_HEARTBEAT, lease_timeout=None,
+               poll_interval=DEFAULT_POLL_INTERVAL, progress=None, stop_event=None):
+    """Claim and relabel files of the job in ``job_dir`` until none are left.
+
+    Pending files are tried in a per-worker random order so concurrent
+    workers rarely race for the same lease. When every remaining file is
+    leased the worker waits ``poll_interval`` seconds and looks again,
+    reclaiming leases that went stale. A file that fails is recorded with
+    its error and not retried. ``progress(result)`` is called after each
+    file this worker finishes; setting ``stop_event`` stops it between
+    files. Returns the number of files this worker relabeled.
+    """
+    manifest, remapper, rules = load_job(job_dir)
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+    lease_timeout = lease_timeout or manifest["lease_timeout"]
+    lease_dir, done_dir = os.path.join(job_dir, "leases"), os.path.join(job_dir, "done")
+    order = list(range(len(manifest["files"])))
+    random.Random(worker_id).shuffle(order)
+    # Lease modification times as first seen on this node's clock
+    observed = {}
+    processed = 0
+
+    while stop_event is None or not stop_event.is_set():
+        done = {name[:-5] for name in os.listdir(done_dir) if name.endswith(".json")}
+        pending = [index for index in order if task_id(index) not in done]
+        if not pending:
+            break
+        claimed_any = False
+        for index in pending:
+            if stop_event is not None and stop_event.is_set():
+                break
+            task = task_id(index)
+            lease_path = os.path.join(lease_dir, f"{task}.lease")
+            if os.path.exists(os.path.join(done_dir, f"{task}.json")):
+                continue
+            lease = Lease.claim(lease_path, worker_id, heartbeat)
+            if lease is None:
+                if not reclaim_stale(lease_path, observed, lease_timeout):
+                    continue
+                lease = Lease.claim(lease_path, worker_id, heartbeat)
+                if lease is None:
+                    continue
+            claimed_any = True
+            try:
+                if os.path.exists(os.path.join(done_dir, f"{task}.json")):
+                    continue
+                result = run_task(manifest, index, remapper, rules, lease, worker_id)
+                if result is not None:
+                    write_json_atomic(os.path.join(done_dir, f"{task}.json"), result)
+                    processed += 1
+                    if progress:
+                        progress(result)
+            finally:
+                lease.release()
+        if not claimed_any:
+            time.sleep(poll_interval)
+    return processed
+
+
+def reclaim_stale(lease_path, observed, lease_timeout):
+    # True when the lease was stale and this worker removed it
+    try:
+        mtime = os.stat(lease_path).st_mtime_ns
+    except FileNotFoundError:
+        return True
+    seen = observed.get(lease_path)
+    now = time.monotonic()
+    if seen is None or seen[0] != mtime:
+        observed[lease_path] = (mtime, now)
+        return False
+    if now - seen[1] < lease_timeout:
+        return False
+    stale_path = f"{lease_path}.{uuid.uuid4().hex}.stale"
+    try:
+        os.rename(lease_path, stale_path)
+    except FileNotFoundError:
+        return True
+    os.remove(stale_path)
+    observed.pop(lease_path, None)
+    print(f"Reclaimed stale lease {os.path.basename(lease_path)}")
+    return True
+
+
+def run_queue_workers(job_dir, workers=1, heartbeat=DEFAULT_HEARTBEAT, lease_timeout=None,
+                      poll_interval=DEFAULT_POLL_INTERVAL):
+    # ``workers`` local worker processes on one job (one node's share of a multi-node run)
+    if workers <= 1:
+        return run_worker(job_dir, heartbeat=heartbeat, lease_timeout=lease_timeout, poll_interval=poll_interval)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = [executor.submit(run_worker, job_dir, None, heartbeat, lease_timeout, poll_interval)
+                   for _ in range(workers)]
+        return sum(future.result() for future in as_completed(futures))
+
+
+def job_summary(job_dir):
+    """Summary of a queued job in the ``run_batch`` format, plus pending files.
+
+    Built from the manifest and the result files, so it can be read from
+    any node at any time, including while workers are still running.
+    """
+    manifest = read_json(os.path.join(job_dir, MANIFEST_NAME))
+    done_dir, lease_dir = os.path.join(job_dir, "done"), os.path.join(job_dir, "leases")
+    results = [read_json(os.path.join(done_dir, name)) for name in sorted(os.listdir(done_dir))
+               if name.endswith(".json")]
+    leased = sum(1 for name in os.listdir(lease_dir) if name.endswith(".lease"))
+    elapsed = max((r["finished"] for r in results), default=manifest["created"]) - manifest["created"]
+    total_points = sum(r["points"] for r in results if r["error"] is None)
+    return {
+        "files": len(results),
+        "succeeded": sum(1 for r in results if r["error"] is None),
+        "skipped": 0,
+        "failed": sum(1 for r in results if r["error"] is not None),
+        "pending": len(manifest["files"]) - len(results),
+        "leased": leased,
+        "points": total_points,
+        "seconds": elapsed,
+        "points_per_second": total_points / elapsed if elapsed > 0 else 0.0,
+        "workers": len({r["worker"] for r in results}),
+        "laz_backend": manifest["laz_backend"] or "auto",
+        "output_format": manifest["output_format"],
+        "cancelled": False,
+        "results": results,
+    }
@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+"""
+Conditional rules for the Point Cloud Label Changer.
+
+A rule sets one or more dimensions to a constant where a condition on any
+point dimensions holds, e.g.
+
+    Ext_Class = 17 where classification == 2 and intensity < 300 and return_number == number_of_returns
+    classification = 7, user_data = 1 where Ext_Class in (3, 4) and not z > 120.5
+
+Conditions support ==, !=, <, <=, >, >= (chained too), in / not in with a
+tuple of numbers, and / or / not and parentheses. x, y and z compare in real
+coordinates, every other dimension in its stored value. Rules are compiled
+once to numpy expressions and evaluated chunk by chunk in the streaming
+relabel pass, after the label mapping and in the order given, so a later
+rule sees the values set by an earlier one.
+
+Rules can be limited to an area with bbox(xmin, ymin, xmax, ymax) or
+inside("name"), where name is a polygon region (see Ptc_Label_Spatial) added
+to the rule set:
+
+    Ext_Class = 40 where inside("construction_zone") and Ext_Class == 2
+
+@author: kenneyke
+"""
+
+import ast
+import json
+import os
+
+import numpy as np
+from laspy import DimensionKind
+
+from Ptc_Label_Spatial import boxes_intersect, union_box
+
+COMPARISONS = {
+    ast.Eq: np.equal,
+    ast.NotEq: np.not_equal,
+    ast.Lt: np.less,
+    ast.LtE: np.less_equal,
+    ast.Gt: np.greater,
+    ast.GtE: np.greater_equal,
+}
+
+
+class RuleError(ValueError):
+    pass
+
+
+def literal_number(node, text):
+    # int/float constant, with an optional leading minus
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+        value = literal_number(node.operand, text)
+        return -value if isinstance(node.op, ast.USub) else value
+    if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+        return node.value
+    raise RuleError(f"Expected a number in rule {text!r}")
+
+
+class ChunkColumns:
+    # Dimension arrays of one chunk, converted on first use, plus the named regions
+    def __init__(self, points, regions):
+        self.points = points
+        self.regions = regions
+        self.cache = {}
+
+    def __call__(self, name):
+        if name not in self.cache:
+            self.cache[name] = np.asarray(self.points[name])
+        return self.cache[name]
+
+    def changed(self, name):
+        self.cache.pop(name, None)
+
+
+def compile_condition(text):
+    """Compile a condition to ``(evaluate, dimensions, regions, extent)``.
+
+    ``evaluate(column)`` returns a boolean mask, where ``column(name)`` gives
+    the values of one dimension for the current chunk (a ``ChunkColumns``).
+    Masks are combined in place so a condition allocates one buffer per
+    comparison, not per operator. ``extent(regions)`` is the box outside of
+    which the condition can never hold, or None when it is not spatially
+    limited.
+    """
+    try:
+        tree = ast.parse(text.strip(), mode="eval").body
+    except SyntaxError as e:
+        raise RuleError(f"Invalid condition {text!r}: {e.msg}") from None
+    dimensions = set()
+    region_names = set()
+
+    def operand(node):
+        if isinstance(node, ast.Name):
+            dimensions.add(node.id)
+            return lambda column: column(node.id)
+        value = literal_number(node, text)
+        return lambda column: value
+
+    def compare(node):
+        parts = []
+        left = operand(node.left)
+        left_node = node.left
+        for op, right_node in zip(node.ops, node.comparators):
+            # A comparison of two numbers is one value, not a mask over the chunk's points
+            if not isinstance(left_node, ast.Name) and not isinstance(right_node, ast.Name):
+                raise RuleError(f"Comparison without a dimension in rule {text!r}")
+            if isinstance(op, (ast.In, ast.NotIn)):
+                if not isinstance(right_node, (ast.Tuple, ast.List, ast.Set)):
+                    raise RuleError(f"'in' needs a tuple of numbers in rule {text!r}")
+                values = np.array([literal_number(item, text) for item in right_node.elts])
+                invert = isinstance(op, ast.NotIn)
+                parts.append(lambda column, left=left, values=values, invert=invert:
+                             np.isin(left(column), values, invert=invert))
+                left = None
+                continue
+            if type(op) not in COMPARISONS or left is None:
+                raise RuleError(f"Unsupported comparison in rule {text!r}")
+            right = operand(right_node)
+            parts.append(lambda column, f=COMPARISONS[type(op)], left=left, right=right:
+                         np.asarray(f(left(column), right(column))))
+            left, left_node = right, right_node
+        return combine(parts, np.logical_and)
+
+    def combine(parts, function):
+        if len(parts) == 1:
+            return parts[0]
+
+        def evaluate(column):
+            mask = parts[0](column)
+            for part in parts[1:]:
+                function(mask, part(column), out=mask)
+            return mask
+        return evaluate
+
+    def spatial(node):
+        # bbox(xmin, ymin, xmax, ymax) or inside("region")
+        name = node.func.id if isinstance(node.func, ast.Name) else None
+        dimensions.update(("x", "y"))
+        if name == "bbox" and len(node.args) == 4:
+            box = tuple(float(literal_number(arg, text)) for arg in node.args)
+            return (lambda column: (column("x") >= box[0]) & (column("x") <= box[2])
+                    & (column("y") >= box[1]) & (column("y") <= box[3])), (lambda regions: box)
+        if name == "inside" and len(node.args) == 1 and isinstance(node.args[0], ast.Constant) \
+                and isinstance(node.args[0].value, str):
+            region = node.args[0].value
+            region_names.add(region)
+            return (lambda column: column.regions[region].contains(column("x"), column("y"))), \
+                (lambda regions: regions[region].bounds)
+        raise RuleError(f"Unsupported function in rule {text!r}, expected bbox(...) or inside(\"name\")")
+
+    def extent(node):
+        # Spatial limit of a sub-expression as a function of the regions (None: unlimited)
+        if isinstance(node, ast.Call):
+            return spatial(node)[1]
+        if isinstance(node, ast.BoolOp):
+            parts = [extent(value) for value in node.values]
+            bounded = [part for part in parts if part is not None]
+            if isinstance(node.op, ast.And) and bounded:
+                def intersection(regions):
+                    boxes = np.array([part(regions) for part in bounded])
+                    return (boxes[:, 0].max(), boxes[:, 1].max(), boxes[:, 2].min(), boxes[:, 3].min())
+                return intersection
+            if isinstance(node.op, ast.Or) and bounded and len(bounded) == len(parts):
+                return lambda regions: union_box([part(regions) for part in bounded])
+        return None
+
+    def build(node):
+        if isinstance(node, ast.Call):
+            return spatial(node)[0]
+        if isinstance(node, ast.BoolOp):
+            function = np.logical_and if isinstance(node.op, ast.And) else np.logical_or
+            return combine([build(value) for value in node.values], function)
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            inner = build(node.operand)
+
+            def negate(column):
+                mask = inner(column)
+                return np.logical_not(mask, out=mask)
+            return negate
+        if isinstance(node, ast.Compare):
+            return compare(node)
+        raise RuleError(f"Unsupported expression in rule {text!r}")
+
+    return build(tree), dimensions, region_names, extent(tree)
+
+
+class Rule:
+    """``assignments`` ({dimension: value}) applied where ``condition`` holds."""
+
+    def __init__(self, assignments, condition=None, text=None):
+        if not assignments:
+            raise RuleError("A rule needs at least one assignment")
+        self.assignments = {name: value for name, value in assignments.items()}
+        self.condition = condition.strip() if condition and condition.strip() else None
+        self.text = text or self.describe()
+        self._compiled = None
+
+    def describe(self):
+        sets = ", ".join(f"{name} = {value}" for name, value in self.assignments.items())
+        return f"{sets} where {self.condition}" if self.condition else sets
+
+    @classmethod
+    def parse(cls, text):
+        # "dim = value[, dim = value] [where condition]"
+        body, _, condition = text.partition(" where ")
+        assignments = {}
+        for part in body.split(","):
+            name, sep, value = part.partition("=")
+            if not sep or not name.strip().isidentifier():
+                raise RuleError(f"Invalid assignment {part.strip()!r} in rule {text!r}")
+            try:
+                assignments[name.strip()] = literal_number(ast.parse(value.strip(), mode="eval").body, text)
+            except SyntaxError:
+                raise RuleError(f"Invalid value {value.strip()!r} in rule {text!r}") from None
+        return cls(assignments, condition, text)
+
+    def compiled(self):
+        if self._compiled is None:
+            self._compiled = compile_condition(self.condition) if self.condition else (None, set(), set(), None)
+        return self._compiled
+
+    @property
+    def dimensions(self):
+        return self.compiled()[1] | set(self.assignments)
+
+    def __getstate__(self):
+        # The compiled closures are rebuilt in worker processes
+        state = dict(self.__dict__)
+        state["_compiled"] = None
+        return state
+
+
+class RuleSet:
+    """Ordered rules applied to point chunks, with the regions they refer to."""
+
+    def __init__(self, rules=(), regions=()):
+        self.rules = list(rules)
+        self.regions = {region.name: region for region in regions}
+
+    def add_region(self, region):
+        self.regions[region.name] = region
+
+    def __len__(self):
+        return len(self.rules)
+
+    def __bool__(self):
+        return bool(self.rules)
+
+    @property
+    def dimensions(self):
+        names = set()
+        for rule in self.rules:
+            names |= rule.dimensions
+        return names
+
+    def validate(self, point_format):
+        """RuleError unless the rules can run on points of ``point_format``.
+
+        ``point_format`` is a laspy ``PointFormat`` (extra bytes included).
+        Every dimension used must exist, every region be loaded and every
+        assigned value fit the range of the field it sets, so a bad rule
+        fails before any point is written instead of on the first chunk it
+        matches.
+        """
+        available = set(point_format.dimension_names) | {"x", "y", "z"}
+        missing = sorted(self.dimensions - available)
+        if missing:
+            raise RuleError(f"Unknown dimensions in rules: {', '.join(missing)}")
+        unknown = self.missing_regions()
+        if unknown:
+            raise RuleError(f"Unknown regions in rules: {', '.join(unknown)}")
+        for rule in self.rules:
+            for name, value in rule.assignments.items():
+                if name in ("x", "y", "z"):
+                    continue
+                info = point_format.dimension_by_name(name)
+                whole = info.kind == DimensionKind.FloatingPoint or value == int(value)
+                if not whole or not info.min <= value <= info.max:
+                    raise RuleError(f"{value} does not fit the {name} field of point format {point_format.id} "
+                                    f"({info.min} to {info.max}) in rule {rule.text!r}")
+
+    def missing_regions(self):
+        return sorted(set().union(*(rule.compiled()[2] for rule in self.rules)) - set(self.regions))
+
+    def extents(self):
+        # One box per rule outside of which it changes nothing, None when any rule is unlimited
+        if self.missing_regions():
+            return None
+        boxes = []
+        for rule in self.rules:
+            extent = rule.compiled()[3]
+            if extent is None:
+                return None
+            boxes.append(extent(self.regions))
+        return boxes or None
+
+    def bounds(self):
+        extents = self.extents()
+        return union_box(extents) if extents else None
+
+    def touches(self, mins, maxs):
+        # False only when the box (e.g. a file's header bounds) is outside every rule's area
+        extents = self.extents()
+        box = (mins[0], mins[1], maxs[0], maxs[1])
+        return extents is None or any(boxes_intersect(extent, box) for extent in extents)
+
+    def apply(self, points):
+        """Apply every rule to a chunk of points in place.
+
+        Returns the number of points changed by each rule.
+        """
+        column = ChunkColumns(points, self.regions)
+        changed = []
+        for rule in self.rules:
+            evaluate = rule.compiled()[0]
+            mask = evaluate(column) if evaluate is not None else np.ones(len(points), dtype=bool)
+            count = int(np.count_nonzero(mask))
+            changed.append(count)
+            if not count:
+                continue
+            for name, value in rule.assignments.items():
+                # Values are checked against the fields by ``validate``
+                values = np.array(column(name))
+                values[mask] = value
+                points[name] = values
+                column.changed(name)
+        return changed
+
+
+def load_rules(file_path):
+    """Read rules from a text file (one rule per line, # comments) or JSON.
+
+    JSON holds a list of rule strings or of ``{"set": {dimension: value},
+    "where": "condition"}`` objects.
+    """
+    if os.path.splitext(file_path)[1].lower() == ".json":
+        with open(file_path) as f:
+            data = json.load(f)
+        rules = [Rule.parse(item) if isinstance(item, str) else Rule(item["set"], item.get("where"))
+                 for item in data]
+    else:
+        with open(file_path) as f:
+            lines = [line.split("#", 1)[0].strip() for line in f]
+        rules = [Rule.parse(line) for line in lines if line]
+    for rule in rules:
+        rule.compiled()
+    return RuleSet(rules)
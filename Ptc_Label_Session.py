@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+Load-once editing session for the Point Cloud Label Changer.
+
+@author: kenneyke
+"""
+
+import os
+
+import laspy
+import numpy as np
+
+from Ptc_Label_Engine import (LabelRemapper, OperationCancelled, DEFAULT_CHUNK_SIZE, copy_file_fast,
+                              decompression_selection, laz_backend, open_point_writer, partial_output_path,
+                              patch_las_file, relabel_file_streaming)
+from Ptc_Label_Governor import default_memory_limit, file_memory
+from Ptc_Label_Profiler import timed
+
+# Point formats from which LAZ stores every dimension in a layer of its own
+FIRST_LAYERED_FORMAT = 6
+
+
+class EditSession:
+    """Labels of one point cloud held in memory while they are edited.
+
+    Dimensions are loaded lazily as separate, natively typed columns (uint8 /
+    uint16 labels, raw int32 X/Y/Z, ...), decompressing only the LAZ layers a
+    column needs. Opening a session loads just the label column, about one
+    to two bytes per point instead of the 40 bytes of the old stacked float64
+    array. Label changes are remapped in place on that column; ``save``
+    streams the input once and writes the edited labels, so an edit cycle
+    never holds the full point record in memory. The labels as of the last
+    load or save are kept on the first edit so unsaved edits can be reverted.
+
+    LAZ point formats 0-5 have no layers, so reading just the labels decodes
+    every record anyway. For those files the decoded records are kept from
+    the open (``keep_records``, by default when twice the records fit under
+    ``default_memory_limit``), further columns are taken from them and
+    ``save`` writes them back with the edited labels, so an open-edit-save
+    cycle decodes the file once. When they do not fit, save decodes the file
+    a second time.
+    """
+
+    def __init__(self, file_path, dimension="Ext_Class", backend=None, chunk_size=DEFAULT_CHUNK_SIZE, timer=None,
+                 keep_records=None):
+        self.file_path = file_path
+        self.dimension = dimension
+        self.backend = backend
+        self.chunk_size = chunk_size
+        with laspy.open(file_path) as reader:
+            self.header = reader.header
+        if dimension not in self.header.point_format.dimension_names:
+            raise ValueError(f"{file_path} has no {dimension} dimension")
+        if keep_records is None:
+            limit = default_memory_limit()
+            keep_records = self.header.are_points_compressed \
+                and self.header.point_format.id < FIRST_LAYERED_FORMAT \
+                and (limit is None or file_memory(self.point_count, self.header.point_format.size, "load") <= limit)
+        self.keep_records = keep_records
+        # Raw point records of the whole file, when kept
+        self.records = None
+        self.columns = {}
+        self.load([dimension], timer)
+        self.saved_labels = None
+        # All (old, new) pairs applied since the file was loaded, and how many were saved
+        self.edits = []
+        self.saved_edits = 0
+
+    def load(self, names, timer=None):
+        # Materialize the requested columns in one pass over the file
+        names = [name for name in names if name not in self.columns]
+        if not names:
+            return
+        if self.records is not None:
+            points = self.point_record()
+            for name in names:
+                self.columns[name] = np.array(points[name])
+            return
+        point_count = self.point_count
+        columns = {}
+        records = None
+        with timed(timer, "read", self.file_path, points=point_count):
+            with laspy.open(self.file_path, laz_backend=laz_backend(self.backend),
+                            decompression_selection=decompression_selection(names)) as reader:
+                offset = 0
+                for points in reader.chunk_iterator(self.chunk_size):
+                    if self.keep_records:
+                        if records is None:
+                            records = np.empty(point_count, dtype=points.array.dtype)
+                        records[offset:offset + len(points)] = points.array
+                    for name in names:
+                        chunk = np.asarray(points[name])
+                        if name not in columns:
+                            columns[name] = np.empty(point_count, dtype=chunk.dtype)
+                        columns[name][offset:offset + len(chunk)] = chunk
+                    offset += len(points)
+        for name in names:
+            self.columns[name] = columns.get(name, np.empty(0))
+        self.records = records
+
+    def point_record(self, start=0, stop=None):
+        # Kept records as laspy points (a view, assigning a dimension writes through)
+        return laspy.ScaleAwarePointRecord(self.records[start:stop], self.header.point_format, self.header.scales,
+                                           self.header.offsets)
+
+    def column(self, name, timer=None):
+        # One dimension as a numpy array, loaded on first use (raw integers for X, Y, Z)
+        self.load([name], timer)
+        return self.columns[name]
+
+    def release(self, name):
+        # Drop a column that is no longer needed (the label column stays)
+        if name != self.dimension:
+            self.columns.pop(name, None)
+
+    @property
+    def labels(self):
+        # Edits write through to this array
+        return self.columns[self.dimension]
+
+    @property
+    def point_count(self):
+        return self.header.point_count
+
+    @property
+    def nbytes(self):
+        records = self.records.nbytes if self.records is not None else 0
+        return records + sum(column.nbytes for column in self.columns.values())
+
+    @property
+    def dirty(self):
+        return len(self.edits) > self.saved_edits
+
+    def unique_labels(self):
+        return np.unique(self.labels).astype(int)
+
+    def apply(self, remapper, timer=None):
+        # Remap the loaded labels in place and remember the pairs
+        labels = self.labels
+        if self.saved_labels is None:
+            self.saved_labels = labels.copy()
+        with timed(timer, "remap", self.file_path, points=self.point_count):
+            remapper.apply(labels, out=labels)
+        self.edits.extend(remapper.label_changes)
+
+    def revert(self):
+        # Back to the labels as of the last load or save
+        if self.saved_labels is not None:
+            self.labels[:] = self.saved_labels
+            self.saved_labels = None
+        del self.edits[self.saved_edits:]
+
+    def save(self, output_path, progress=None, cancel_event=None, timer=None, laz_chunk_size=None):
+        """Write the point cloud with the edited labels to ``output_path``.
+
+        The cheapest way that gives the edited labels is taken: a byte copy
+        when nothing was edited, a label patch of the copied records for an
+        uncompressed .las saved as .las, the kept records written back with
+        the edited labels, or else the input streamed once more, every chunk
+        relabeled with all edits since the file was loaded (the pairs compose
+        in order, so this equals the in-memory labels). Only the last decodes
+        the input again. The output is written under a temporary name that
+        replaces ``output_path`` at the end, so saving over the input is
+        safe. The output is LAZ or LAS by the extension of ``output_path``.
+        """
+        remapper = LabelRemapper(self.edits)
+        same_file = os.path.abspath(output_path) == os.path.abspath(self.file_path)
+        same_format = os.path.splitext(output_path)[1].lower() == os.path.splitext(self.file_path)[1].lower()
+        saved = False
+        if not remapper and same_format:
+            if not same_file:
+                copy_file_fast(self.file_path, output_path)
+            saved = True
+        elif not self.header.are_points_compressed and same_format:
+            try:
+                patch_las_file(self.file_path, output_path, remapper, self.dimension, self.chunk_size, timer=timer)
+                saved = True
+            except ValueError:
+                # The labels are a bit field, which cannot be patched
+                pass
+        if saved:
+            if progress:
+                progress(self.point_count, self.point_count)
+        elif self.records is not None:
+            self.write_records(output_path, progress, cancel_event, timer, laz_chunk_size)
+        else:
+            relabel_file_streaming(self.file_path, output_path, remapper, self.dimension, self.chunk_size,
+                                   progress=progress, cancel_event=cancel_event, backend=self.backend, timer=timer,
+                                   laz_chunk_size=laz_chunk_size)
+        if os.path.abspath(output_path) == os.path.abspath(self.file_path):
+            # The saved file is the new baseline
+            self.edits = []
+        self.saved_edits = len(self.edits)
+        self.saved_labels = None
+        return output_path
+
+    def write_records(self, output_path, progress=None, cancel_event=None, timer=None, laz_chunk_size=None):
+        # The kept records with the edited labels, written without decoding the input again
+        target = partial_output_path(output_path)
+        points_total = self.point_count
+        try:
+            with open_point_writer(target, self.header, self.backend, laz_chunk_size) as writer:
+                for start in range(0, points_total, self.chunk_size):
+                    if cancel_event is not None and cancel_event.is_set():
+                        raise OperationCancelled()
+                    points = self.point_record(start, start + self.chunk_size)
+                    points[self.dimension] = self.labels[start:start + self.chunk_size]
+                    with timed(timer, "write", output_path, points=len(points)):
+                        writer.write_points(points)
+                    if progress:
+                        progress(start + len(points), points_total)
+        except BaseException:
+            if os.path.exists(target):
+                os.remove(target)
+            raise
+        os.replace(target, output_path)
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Spatial regions (polygons and boxes) for the Point Cloud Label Changer.
+
+@author: kenneyke
+"""
+
+import json
+import os
+import re
+
+import numpy as np
+
+
+def boxes_intersect(a, b):
+    # (xmin, ymin, xmax, ymax) boxes, touching counts as intersecting
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def union_box(boxes):
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    return (boxes[:, 0].min(), boxes[:, 1].min(), boxes[:, 2].max(), boxes[:, 3].max())
+
+
+def points_in_rings(x, y, rings):
+    """Even-odd point in polygon test over all ``rings`` (exterior and holes).
+
+    Vectorized over the points, one pass per polygon edge.
+    """
+    inside = np.zeros(x.shape, dtype=bool)
+    for ring in rings:
+        xi, yi = ring[:, 0], ring[:, 1]
+        xj, yj = np.roll(xi, 1), np.roll(yi, 1)
+        for ax, ay, bx, by in zip(xi.tolist(), yi.tolist(), xj.tolist(), yj.tolist()):
+            if ay == by:
+                continue
+            crosses = (ay > y) != (by > y)
+            crosses &= x < (bx - ax) * (y - ay) / (by - ay) + ax
+            inside ^= crosses
+    return inside
+
+
+# Grid cells per polygon of a region's spatial index, and the most cells along either axis
+GRID_CELLS_PER_POLYGON = 4
+MAX_GRID_SIDE = 256
+
+# Up to this many candidate polygons a chunk skips the grid: filtering every point by
+# each polygon's box is cheaper than sorting the points into cells
+DIRECT_POLYGONS = 16
+
+
+class Region:
+    """Named union of polygons, each a list of rings (exterior first, then holes).
+
+    A uniform grid over the region's bounds indexes the polygons by the
+    cells their bounding box overlaps. ``contains`` bins the points of a
+    chunk into the cells once, then tests each polygon only against the
+    points in its own cells (and inside its box), so a chunk costs about one
+    pass over its points however many polygons the region holds. Chunks that
+    overlap only a few polygons filter their points by each box directly.
+    """
+
+    def __init__(self, name, polygons):
+        self.name = name
+        self.polygons = [[np.asarray(ring, dtype=np.float64)[:, :2] for ring in polygon] for polygon in polygons]
+        if not self.polygons:
+            raise ValueError(f"Region {name!r} has no polygons")
+        self.boxes = np.array([union_box([(r[:, 0].min(), r[:, 1].min(), r[:, 0].max(), r[:, 1].max())
+                                          for r in polygon]) for polygon in self.polygons])
+        self.bounds = union_box(self.boxes)
+        self.build_grid()
+
+    def build_grid(self):
+        # Square-ish cells, about GRID_CELLS_PER_POLYGON of them per polygon
+        xmin, ymin, xmax, ymax = self.bounds
+        width, height = max(xmax - xmin, 1e-9), max(ymax - ymin, 1e-9)
+        cells = len(self.polygons) * GRID_CELLS_PER_POLYGON
+        side = np.sqrt(width * height / cells)
+        self.grid_shape = (int(np.clip(np.ceil(width / side), 1, MAX_GRID_SIDE)),
+                           int(np.clip(np.ceil(height / side), 1, MAX_GRID_SIDE)))
+        self.cell_size = (width / self.grid_shape[0], height / self.grid_shape[1])
+        # Cells overlapped by each polygon's box
+        first = self.cell_index(self.boxes[:, 0], self.boxes[:, 1])
+        last = self.cell_index(self.boxes[:, 2], self.boxes[:, 3])
+        self.polygon_cells = [(np.arange(y0, y1 + 1)[:, None] * self.grid_shape[0] + np.arange(x0, x1 + 1)).ravel()
+                              for x0, y0, x1, y1 in zip(first[0].tolist(), first[1].tolist(),
+                                                        last[0].tolist(), last[1].tolist())]
+
+    def cell_index(self, x, y):
+        # (column, row) of the grid cell holding each point, clipped to the grid
+        nx, ny = self.grid_shape
+        column = np.clip(((x - self.bounds[0]) / self.cell_size[0]).astype(np.int64), 0, nx - 1)
+        row = np.clip(((y - self.bounds[1]) / self.cell_size[1]).astype(np.int64), 0, ny - 1)
+        return column, row
+
+    @classmethod
+    def box(cls, name, xmin, ymin, xmax, ymax):
+        return cls(name, [[[(xmin, ymin), (xmax, ymin), (xmax, ymax), (xmin, ymax)]]])
+
+    def candidates(self, bounds):
+        # Indices of the polygons whose box intersects ``bounds``
+        b = self.boxes
+        return np.flatnonzero((b[:, 0] <= bounds[2]) & (bounds[0] <= b[:, 2])
+                              & (b[:, 1] <= bounds[3]) & (bounds[1] <= b[:, 3]))
+
+    def contains(self, x, y):
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        mask = np.zeros(x.shape, dtype=bool)
+        xmin, ymin, xmax, ymax = self.bounds
+        inside_bounds = np.flatnonzero((x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax))
+        if inside_bounds.size == 0:
+            return mask
+
+        bx, by = x[inside_bounds], y[inside_bounds]
+        candidates = self.candidates((bx.min(), by.min(), bx.max(), by.max())).tolist()
+        if len(candidates) <= DIRECT_POLYGONS:
+            for i in candidates:
+                pxmin, pymin, pxmax, pymax = self.boxes[i]
+                idx = np.flatnonzero((x >= pxmin) & (x <= pxmax) & (y >= pymin) & (y <= pymax) & ~mask)
+                if idx.size:
+                    mask[idx[points_in_rings(x[idx], y[idx], self.polygons[i])]] = True
+            return mask
+
+        # Bin the points into grid cells: the points of cell c are
+        # inside_bounds[order[starts[c]:starts[c] + counts[c]]]
+        column, row = self.cell_index(bx, by)
+        cell = row * self.grid_shape[0] + column
+        order = np.argsort(cell, kind="stable")
+        counts = np.bincount(cell, minlength=self.grid_shape[0] * self.grid_shape[1])
+        starts = np.cumsum(counts) - counts
+
+        for i in candidates:
+            cells = self.polygon_cells[i]
+            cells = cells[counts[cells] > 0]
+            if cells.size == 0:
+                continue
+            # Positions of the points of all these cells in ``order``, without a Python loop
+            lengths = counts[cells]
+            positions = np.repeat(starts[cells] - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+            idx = inside_bounds[order[positions]]
+            pxmin, pymin, pxmax, pymax = self.boxes[i]
+            px, py = x[idx], y[idx]
+            idx = idx[(px >= pxmin) & (px <= pxmax) & (py >= pymin) & (py <= pymax) & ~mask[idx]]
+            if idx.size:
+                mask[idx[points_in_rings(x[idx], y[idx], self.polygons[i])]] = True
+        return mask
+
+
+def parse_wkt(text):
+    """Polygons of a WKT POLYGON or MULTIPOLYGON (coordinates beyond x, y are ignored)."""
+    match = re.match(r"\s*(MULTIPOLYGON|POLYGON)\s*(?:Z|M|ZM)?\s*(\(.*\))\s*$", text, re.IGNORECASE | re.DOTALL)
+    if match is None:
+        raise ValueError("Expected a WKT POLYGON or MULTIPOLYGON")
+    # Turn the nested parentheses into JSON lists: "(1 2, 3 4)" -> "[[1,2],[3,4]]"
+    body = re.sub(r"(-?[\d.eE+-]+)(?:\s+(-?[\d.eE+-]+))+", lambda m: "[" + ",".join(m.group(0).split()) + "]",
+                  match.group(2))
+    nested = json.loads(body.replace("(", "[").replace(")", "]"))
+    return nested if match.group(1).upper() == "MULTIPOLYGON" else [nested]
+
+
+def geojson_polygons(data):
+    # Polygons of a GeoJSON FeatureCollection, Feature or geometry
+    kind = data.get("type")
+    if kind == "FeatureCollection":
+        return [polygon for feature in data["features"] for polygon in geojson_polygons(feature)]
+    if kind == "Feature":
+        return geojson_polygons(data["geometry"]) if data.get("geometry") else []
+    if kind == "GeometryCollection":
+        return [polygon for geometry in data["geometries"] for polygon in geojson_polygons(geometry)]
+    if kind == "Polygon":
+        return [data["coordinates"]]
+    if kind == "MultiPolygon":
+        return list(data["coordinates"])
+    raise ValueError(f"Unsupported GeoJSON geometry {kind!r}, expected polygons")
+
+
+def load_region(file_path, name=None):
+    """Region from a GeoJSON (.geojson/.json) or WKT (.wkt/.txt) file.
+
+    The region is named after the file unless ``name`` is given.
+    """
+    name = name or os.path.splitext(os.path.basename(file_path))[0]
+    with open(file_path) as f:
+        text = f.read()
+    if os.path.splitext(file_path)[1].lower() in (".geojson", ".json"):
+        return Region(name, geojson_polygons(json.loads(text)))
+    return Region(name, parse_wkt(text))
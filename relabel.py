@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+Headless command line entry point for the Point Cloud Label Changer.
+
+Example:
+    python relabel.py --map mapping.xlsx --input DIR --output DIR --workers 8
+
+Multi-node runs go through a job folder on shared storage: submit once, then
+start workers on every node (see Ptc_Label_Queue):
+    python relabel.py --map mapping.xlsx --input DIR --output DIR --queue /nas/job1 --submit
+    python relabel.py --queue /nas/job1 --workers 8
+
+Exit codes: 0 all files relabeled, 1 one or more files failed or the run was
+interrupted, 2 invalid arguments or mapping.
+
+@author: kenneyke
+"""
+
+import argparse
+import json
+import os
+import sys
+
+from Ptc_Label_Engine import LabelRemapper, DEFAULT_CHUNK_SIZE, LAZ_BACKENDS, OUTPUT_FORMATS, laz_backend_self_test
+from Ptc_Label_Batch import (DEFAULT_WORKERS, UNAFFECTED_MODES, BatchOptions, check_mapping, check_rules,
+                             run_batch, format_batch_summary, preview_batch, format_preview)
+from Ptc_Label_Cache import LabelHistogramCache
+from Ptc_Label_Discovery import discover_point_clouds
+from Ptc_Label_Governor import DEFAULT_MEMORY_FRACTION, default_memory_limit
+from Ptc_Label_Mapping import MAPPING_EXTENSIONS, load_mapping
+from Ptc_Label_Journal import JOURNAL_NAME, BatchJournal
+from Ptc_Label_Pipeline import DEFAULT_PIPELINE_MEMORY
+from Ptc_Label_Queue import DEFAULT_LEASE_TIMEOUT, job_summary, run_queue_workers, submit_job
+from Ptc_Label_Rules import Rule, RuleError, RuleSet, load_rules
+from Ptc_Label_Spatial import load_region
+from Ptc_Label_Profiler import StageTimer, profiled
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="relabel", description="Change point cloud labels using a mapping sheet.")
+    parser.add_argument("--map", dest="map_path",
+                        help=f"Mapping ({', '.join(MAPPING_EXTENSIONS)}) with old labels in the first column "
+                             "and new labels in the second")
+    parser.add_argument("--rules", dest="rules_path", default=None,
+                        help="Text (one rule per line) or JSON file of conditional rules, applied after the mapping")
+    parser.add_argument("--rule", dest="rule_texts", action="append", default=[],
+                        help='Conditional rule, e.g. "Ext_Class = 17 where classification == 2 and intensity < 300" '
+                             "(repeatable)")
+    parser.add_argument("--region", dest="region_paths", action="append", default=[],
+                        help='GeoJSON or WKT polygons used by inside("NAME") in rules, as PATH or NAME=PATH '
+                             "(NAME defaults to the file name, repeatable)")
+    parser.add_argument("--input", help="Point cloud file or directory of .las/.laz files")
+    parser.add_argument("--recursive", action="store_true", help="Also take the files in subfolders of --input")
+    parser.add_argument("--include", action="append", default=[],
+                        help='Only take files matching this pattern, by name or path below --input, e.g. "tile_*" '
+                             "(repeatable)")
+    parser.add_argument("--exclude", action="append", default=[],
+                        help='Leave out files matching this pattern, e.g. "*/archive/*" (repeatable)')
+    parser.add_argument("--include-outputs", action="store_true",
+                        help="Also take *_updated files written by earlier runs (left out by default)")
+    parser.add_argument("--output", default=None,
+                        help="Output directory (default: next to each input file)")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Files processed in parallel")
+    parser.add_argument("--dimension", default="Ext_Class", help="Label dimension to change")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="Points per streamed chunk")
+    parser.add_argument("--no-pipeline", dest="pipeline", action="store_false",
+                        help="With one worker, run each file read -> remap -> write in lockstep instead of overlapping "
+                             "the stages")
+    parser.add_argument("--pipeline-memory", type=float, default=DEFAULT_PIPELINE_MEMORY / 1024 ** 2,
+                        help="MB of point records the pipelined reader may hold ahead of the writer")
+    parser.add_argument("--memory-limit", type=float, default=None,
+                        help=f"MB the whole run may use; chunk size and workers are lowered to fit and large files "
+                             f"wait for memory (default: {DEFAULT_MEMORY_FRACTION:.0%}% of the available memory, "
+                             f"0 for no limit)")
+    parser.add_argument("--patch-las", action="store_true",
+                        help="Copy uncompressed .las inputs and patch the labels instead of rewriting them")
+    parser.add_argument("--in-place", action="store_true",
+                        help="Patch the labels of uncompressed .las inputs directly in the input files")
+    parser.add_argument("--laz-backend", choices=list(LAZ_BACKENDS), default="auto",
+                        help="LAZ codec used for decompression and compression")
+    parser.add_argument("--output-format", choices=list(OUTPUT_FORMATS), default="laz",
+                        help="laz (compressed), las (uncompressed, fastest to write) or keep (same as each input)")
+    parser.add_argument("--laz-chunk-size", type=int, default=None,
+                        help="Points per LAZ chunk in compressed outputs (default 50000)")
+    parser.add_argument("--unaffected", choices=list(UNAFFECTED_MODES), default="copy",
+                        help="Files holding none of the changed labels: copy them without re-encoding (default), "
+                             "skip them (no output) or rewrite them like every other file")
+    parser.add_argument("--journal", default=None,
+                        help=f"Completion journal; files it lists as done with the same input and mapping are "
+                             f"skipped on a rerun (default: {JOURNAL_NAME} in the output directory)")
+    parser.add_argument("--no-journal", action="store_true", help="Neither read nor write a completion journal")
+    parser.add_argument("--verify-journal", action="store_true",
+                        help="Record the SHA-1 of every output in the journal and only skip files whose output "
+                             "still has it (slower: every output is read again)")
+    parser.add_argument("--queue", default=None,
+                        help="Job folder on shared storage: with --submit write the job there, otherwise work on it "
+                             "with --workers local processes until every file is done")
+    parser.add_argument("--submit", action="store_true", help="Write the job to --queue and exit")
+    parser.add_argument("--lease-timeout", type=float, default=None,
+                        help="Seconds without a heartbeat after which a queued file is reclaimed from its worker "
+                             f"(default: set when submitting, {DEFAULT_LEASE_TIMEOUT:.0f})")
+    parser.add_argument("--self-test", action="store_true",
+                        help="Report which LAZ backends are available and exit")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Report how many points each change would touch per file, without writing anything")
+    parser.add_argument("--trace", default=None, help="Write a per-stage JSON timing trace here")
+    parser.add_argument("--profile", default=None,
+                        help="Write a cProfile dump of the run here (worker processes are not profiled)")
+    parser.add_argument("--summary", default=None,
+                        help="Write the JSON run summary here (default: relabel_summary.json in the output directory)")
+    args = parser.parse_args(argv)
+    if args.submit and args.queue is None:
+        parser.error("--submit needs --queue")
+    worker_only = args.queue is not None and not args.submit
+    if not args.self_test and not worker_only and (args.input is None or (args.map_path is None and args.rules_path is None
+                                                       and not args.rule_texts)):
+        parser.error("--input and one of --map, --rules or --rule are required")
+    return args
+
+
+def input_files(args):
+    # Discovered files and their header summaries
+    # ({path: (point_count, mins, maxs, record_length, point_format_id)})
+    if not os.path.exists(args.input):
+        return [], {}
+    headers = {file_path: header for file_path, *header in
+               discover_point_clouds(args.input, args.recursive, args.include, args.exclude, args.include_outputs)}
+    return sorted(headers), headers
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.self_test:
+        report = laz_backend_self_test()
+        for name, status in report.items():
+            print(f"{name}: {status}")
+        return EXIT_OK if "ok" in report.values() else EXIT_FAILED
+
+    if args.queue is not None and not args.submit:
+        return work_on_queue(args)
+
+    try:
+        mapping = load_mapping(args.map_path) if args.map_path else None
+        label_changes = mapping.label_changes if mapping is not None else []
+        remapper = mapping.remapper() if mapping is not None else LabelRemapper([])
+    except Exception as e:
+        print(f"Error reading mapping {args.map_path}: {e}", file=sys.stderr)
+        return EXIT_USAGE
+    try:
+        rules = load_rules(args.rules_path) if args.rules_path else RuleSet()
+        rules.rules.extend(Rule.parse(text) for text in args.rule_texts)
+        for rule in rules.rules:
+            rule.compiled()
+        for region_path in args.region_paths:
+            name, sep, path = region_path.partition("=")
+            rules.add_region(load_region(path, name) if sep else load_region(region_path))
+        if rules.missing_regions():
+            raise ValueError(f"Unknown regions in rules: {', '.join(rules.missing_regions())} (load them with --region)")
+    except (OSError, ValueError) as e:
+        print(f"Error reading rules: {e}", file=sys.stderr)
+        return EXIT_USAGE
+
+    files, headers = input_files(args)
+    input_root = args.input if os.path.isdir(args.input) else None
+    if not files:
+        print(f"No point cloud files found in {args.input}", file=sys.stderr)
+        return EXIT_USAGE
+    if args.workers < 1 or args.chunk_size < 1 or (args.laz_chunk_size is not None and args.laz_chunk_size < 1) \
+            or args.pipeline_memory <= 0 or (args.memory_limit is not None and args.memory_limit < 0):
+        print("--workers, --chunk-size, --laz-chunk-size and --pipeline-memory must be positive, --memory-limit "
+              "not negative", file=sys.stderr)
+        return EXIT_USAGE
+
+    if rules:
+        # A rule that cannot run on some of the files fails here, before any output is written
+        try:
+            check_rules(rules, headers)
+        except RuleError as e:
+            print(f"Error in rules: {e}", file=sys.stderr)
+            return EXIT_USAGE
+    if remapper:
+        # Likewise a new label the label field of some of the files cannot hold
+        try:
+            check_mapping(remapper, args.dimension, headers)
+        except ValueError as e:
+            print(f"Error in mapping {args.map_path}: {e}", file=sys.stderr)
+            return EXIT_USAGE
+
+    if args.submit:
+        try:
+            submit_job(args.queue, files, remapper, args.output, args.dimension, args.chunk_size, args.laz_backend,
+                       rules, args.output_format, args.laz_chunk_size, args.lease_timeout or DEFAULT_LEASE_TIMEOUT,
+                       input_root)
+        except OSError as e:
+            print(f"Error writing job to {args.queue}: {e}", file=sys.stderr)
+            return EXIT_USAGE
+        print(f"Queued {len(files)} files in {args.queue}")
+        return EXIT_OK
+
+    timer = StageTimer("relabel") if args.trace else None
+    cache = LabelHistogramCache()
+    if args.dry_run:
+        preview = preview_batch(files, remapper, lambda f: cache.histogram(f, args.dimension, args.chunk_size,
+                                                                           args.laz_backend, timer))
+        cache.close()
+        print(format_preview(preview))
+        if rules:
+            print("Conditional rules are not included in the preview.")
+        if timer is not None:
+            timer.write_trace(args.trace)
+        if args.summary:
+            with open(args.summary, "w") as f:
+                json.dump(preview, f, indent=2)
+        return EXIT_OK
+
+    output_dir = args.output or os.path.dirname(os.path.abspath(files[0]))
+    memory_limit = default_memory_limit() if args.memory_limit is None else int(args.memory_limit * 1024 ** 2) or None
+    options = BatchOptions(workers=args.workers, output_dir=args.output, input_root=input_root,
+                           dimension=args.dimension, chunk_size=args.chunk_size, patch_las=args.patch_las,
+                           in_place=args.in_place, backend=args.laz_backend, laz_chunk_size=args.laz_chunk_size,
+                           output_format=args.output_format, rules=rules, pipeline=args.pipeline,
+                           memory_budget=int(args.pipeline_memory * 1024 ** 2), unaffected=args.unaffected,
+                           memory_limit=memory_limit)
+    journal = None if args.no_journal else BatchJournal(args.journal or os.path.join(output_dir, JOURNAL_NAME),
+                                                             verify=args.verify_journal)
+    print(f"Relabeling {len(files)} files with {len(label_changes)} label changes: {remapper.mapping}")
+    for rule in rules.rules:
+        print(f"Rule: {rule.text}")
+    try:
+        with profiled(args.profile):
+            summary = run_batch(files, remapper, options, timer=timer, journal=journal, label_cache=cache,
+                                headers=headers,
+                                progress=lambda result, files_done, files_total, points_done, points_total:
+                                print(f"[{files_done}/{files_total}] {result['input']}: "
+                                      f"{result['error'] or str(result['points']) + ' points'}"))
+    except KeyboardInterrupt:
+        print("Interrupted", file=sys.stderr)
+        return EXIT_FAILED
+    finally:
+        cache.close()
+    print(format_batch_summary(summary))
+    if timer is not None:
+        timer.write_trace(args.trace)
+        summary["stages"] = timer.summary()
+
+    summary["map"] = os.path.abspath(args.map_path) if args.map_path else None
+    summary["label_changes"] = [list(pair) for pair in label_changes]
+    summary["rules"] = [rule.text for rule in rules.rules]
+    summary_path = args.summary or os.path.join(output_dir, "relabel_summary.json")
+    with open(summary_path, "w") as f:
+        json.dump(summary, f, indent=2)
+
+    return EXIT_OK if summary["failed"] == 0 else EXIT_FAILED
+
+
+def work_on_queue(args):
+    # Join a queued job with --workers local processes, then report the job as a whole
+    if not os.path.exists(os.path.join(args.queue, "manifest.json")):
+        print(f"No job found in {args.queue}, submit one with --submit", file=sys.stderr)
+        return EXIT_USAGE
+    try:
+        processed = run_queue_workers(args.queue, args.workers, lease_timeout=args.lease_timeout)
+    except KeyboardInterrupt:
+        print("Interrupted", file=sys.stderr)
+        return EXIT_FAILED
+    summary = job_summary(args.queue)
+    print(f"This node relabeled {processed} files.")
+    print(format_batch_summary(summary))
+    summary_path = args.summary or os.path.join(args.queue, "relabel_summary.json")
+    with open(summary_path, "w") as f:
+        json.dump(summary, f, indent=2)
+    return EXIT_OK if summary["failed"] == 0 else EXIT_FAILED
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""
+Test setup: the modules live at the top of the repository, not in a package,
+and the tests write their own small point clouds.
+
+@author: kenneyke
+"""
+
+import os
+import sys
+
+import laspy
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def make_las(tmp_path):
+    """Write a small point format 3 .las file and return its path.
+
+    ``labels`` become the classification of its points, one point each.
+    """
+    def make(name, labels, directory=None):
+        directory = directory or tmp_path
+        os.makedirs(directory, exist_ok=True)
+        labels = np.asarray(labels, dtype=np.uint8)
+        las = laspy.create(point_format=3, file_version="1.2")
+        las.header.scales = [0.01, 0.01, 0.01]
+        las.x = np.arange(labels.size, dtype=np.float64)
+        las.y = np.arange(labels.size, dtype=np.float64)[::-1]
+        las.z = np.zeros(labels.size)
+        las.classification = labels
+        path = os.path.join(directory, name)
+        las.write(path)
+        return path
+    return make
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for batch runs of the Point Cloud Label Changer.
+
+@author: kenneyke
+"""
+
+import os
+import threading
+
+import laspy
+import numpy as np
+import pytest
+
+from Ptc_Label_Batch import BatchOptions, check_mapping, run_batch
+from Ptc_Label_Discovery import read_header_summary
+from Ptc_Label_Engine import LabelRemapper
+from Ptc_Label_Pipeline import RelabelPipeline
+from Ptc_Label_Rules import Rule, RuleError, RuleSet
+
+
+def labels_of(path):
+    return np.asarray(laspy.read(path).classification).tolist()
+
+
+@pytest.fixture
+def files(make_las):
+    rng = np.random.default_rng(0)
+    return [make_las(f"t{i}.las", rng.integers(0, 6, 500 + 100 * i)) for i in range(4)]
+
+
+@pytest.mark.parametrize("workers, pipeline", [(1, False), (1, True), (2, False)])
+def test_modes_write_the_same_outputs(tmp_path, files, workers, pipeline):
+    options = BatchOptions(workers=workers, pipeline=pipeline, output_dir=str(tmp_path / "out"),
+                           dimension="classification", chunk_size=128, output_format="las", unaffected="rewrite")
+    label_changes = [(1, 2), (2, 5), (0, 1)]
+    summary = run_batch(files, label_changes, options)
+    assert (summary["succeeded"], summary["failed"]) == (4, 0)
+    remapper = LabelRemapper(label_changes)
+    for path in files:
+        output = str(tmp_path / "out" / os.path.basename(path).replace(".las", "_updated.las"))
+        expected = remapper.apply(np.array(labels_of(path), dtype=np.uint8))
+        assert labels_of(output) == expected.tolist()
+
+
+def test_failed_file_does_not_stop_the_batch(tmp_path, files):
+    broken = tmp_path / "broken.las"
+    broken.write_bytes(b"not a point cloud")
+    options = BatchOptions(workers=1, output_dir=str(tmp_path / "out"), dimension="classification",
+                           output_format="las")
+    summary = run_batch(files + [str(broken)], [(1, 2)], options)
+    assert (summary["succeeded"], summary["failed"]) == (4, 1)
+
+
+def test_new_labels_are_checked_before_the_batch(tmp_path, files):
+    headers = {path: read_header_summary(path) for path in files}
+    # classification is a 5-bit field in point format 3
+    check_mapping(LabelRemapper([(1, 31)]), "classification", headers)
+    with pytest.raises(ValueError, match="0 to 31"):
+        check_mapping(LabelRemapper([(1, 40)]), "classification", headers)
+    with pytest.raises(ValueError, match="Ext_Class"):
+        check_mapping(LabelRemapper([(1, 2)]), "Ext_Class", headers)
+    options = BatchOptions(workers=1, output_dir=str(tmp_path / "out"), dimension="classification")
+    with pytest.raises(ValueError):
+        run_batch(files, [(1, 300)], options)
+    assert not os.path.exists(tmp_path / "out") or not os.listdir(tmp_path / "out")
+
+
+def test_rules_are_checked_before_the_batch(tmp_path, files):
+    rules = RuleSet([Rule.parse("classification = 999 where classification == 1")])
+    options = BatchOptions(workers=1, output_dir=str(tmp_path / "out"), dimension="classification", rules=rules)
+    with pytest.raises(RuleError):
+        run_batch(files, [], options)
+
+
+def test_pipeline_cancel_stops_mid_file(tmp_path, make_las):
+    path = make_las("long.las", np.ones(20_000))
+    cancel_event = threading.Event()
+
+    class CancellingRemapper(LabelRemapper):
+        # Cancels while the first chunk of the file is remapped
+        def apply(self, labels, out=None):
+            cancel_event.set()
+            return super().apply(labels, out)
+
+    pipeline = RelabelPipeline(CancellingRemapper([(1, 2)]), "classification", chunk_size=100)
+    os.makedirs(tmp_path / "out")
+    assert list(pipeline.run([(path, str(tmp_path / "out" / "long.las"))], cancel_event)) == []
+    assert os.listdir(tmp_path / "out") == []
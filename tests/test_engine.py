@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the label remapper of the Point Cloud Label Changer.
+
+@author: kenneyke
+"""
+
+import numpy as np
+import pytest
+
+from Ptc_Label_Engine import LabelRemapper
+
+
+def sequential(labels, label_changes):
+    # The original per-pair loop the remapper replaces
+    labels = labels.copy()
+    for old_label, new_label in label_changes:
+        labels[labels == old_label] = new_label
+    return labels
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16, np.int32, np.int64])
+def test_matches_sequential_pairs(dtype):
+    rng = np.random.default_rng(0)
+    high = min(np.iinfo(dtype).max, 300) + 1
+    for _ in range(50):
+        label_changes = [(int(old), int(new)) for old, new in rng.integers(0, min(high, 256), (6, 2))]
+        labels = rng.integers(0, high, 1000).astype(dtype)
+        assert np.array_equal(LabelRemapper(label_changes).apply(labels), sequential(labels, label_changes))
+
+
+def test_chained_and_swapped_pairs():
+    labels = np.array([1, 2, 3, 4], dtype=np.uint8)
+    for label_changes in ([(1, 2), (2, 3)], [(1, 9), (2, 1), (9, 2)], [(3, 3), (4, 1), (1, 4)]):
+        assert np.array_equal(LabelRemapper(label_changes).apply(labels), sequential(labels, label_changes))
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16])
+def test_negative_key_leaves_unsigned_labels_alone(dtype):
+    # -1 must not wrap around to the last entry of the lookup table
+    labels = np.array([0, 5, np.iinfo(dtype).max], dtype=dtype)
+    remapper = LabelRemapper([(-1, 5), (5, 6)])
+    assert np.array_equal(remapper.apply(labels), sequential(labels, [(5, 6)]))
+
+
+def test_negative_key_on_signed_labels():
+    labels = np.array([-1, 0, 255, 100_000], dtype=np.int64)
+    label_changes = [(-1, 5), (100_000, -2)]
+    assert np.array_equal(LabelRemapper(label_changes).apply(labels), sequential(labels, label_changes))
+
+
+def test_sparse_large_ids():
+    labels = np.array([7, 10 ** 9, 3, 10 ** 9 + 1], dtype=np.int64)
+    label_changes = [(10 ** 9, 1), (3, 10 ** 9 + 1)]
+    assert np.array_equal(LabelRemapper(label_changes).apply(labels), sequential(labels, label_changes))
+
+
+def test_float_labels_and_in_place():
+    labels = np.array([1.0, 2.0, 3.0])
+    LabelRemapper([(2, 5)]).apply(labels, out=labels)
+    assert labels.tolist() == [1.0, 5.0, 3.0]
+
+
+def test_new_label_must_fit():
+    with pytest.raises(ValueError):
+        LabelRemapper([(1, 300)]).apply(np.array([1], dtype=np.uint8))
+
+
+def test_affects():
+    # 1 -> 2 -> 1 ends where it started, only label 2 changes
+    remapper = LabelRemapper([(1, 2), (2, 1)])
+    assert remapper.affects([2, 7])
+    assert not remapper.affects([1, 3])
+    assert not LabelRemapper([(1, 1)])
+
+
+def test_check_fits_uses_final_labels():
+    # 1 -> 300 -> 9 only ever writes 9
+    LabelRemapper([(1, 300), (300, 9)]).check_fits(np.uint8)
+    with pytest.raises(ValueError, match="300"):
+        LabelRemapper([(8, 300)]).check_fits(np.uint8)
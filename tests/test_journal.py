@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the completion journal and resumed batch runs.
+
+@author: kenneyke
+"""
+
+import json
+import os
+
+import laspy
+import numpy as np
+
+from Ptc_Label_Batch import BatchOptions, run_batch
+from Ptc_Label_Journal import BatchJournal, file_fingerprint, settings_digest
+
+
+def finished(tmp_path, verify=False):
+    # A journal holding one finished file
+    input_path, output_path = tmp_path / "in.las", tmp_path / "out.las"
+    input_path.write_bytes(b"input")
+    output_path.write_bytes(b"output")
+    journal = BatchJournal(str(tmp_path / "journal.jsonl"), verify)
+    settings = settings_digest([(1, 2)])
+    journal.record({"input": str(input_path), "output": str(output_path), "points": 5}, settings,
+                   file_fingerprint(input_path))
+    return journal, str(input_path), str(output_path), settings
+
+
+def test_completed_entry(tmp_path):
+    journal, input_path, output_path, settings = finished(tmp_path)
+    assert journal.completed(input_path, output_path, settings)["points"] == 5
+    assert journal.completed(input_path, output_path, settings_digest([(1, 3)])) is None
+    # A fresh journal reads the same entry back from disk
+    assert BatchJournal(journal.path).completed(input_path, output_path, settings) is not None
+
+
+def test_changed_files_are_redone(tmp_path):
+    journal, input_path, output_path, settings = finished(tmp_path)
+    with open(output_path, "ab") as f:
+        f.write(b"more")
+    assert journal.completed(input_path, output_path, settings) is None
+
+    journal, input_path, output_path, settings = finished(tmp_path)
+    with open(input_path, "ab") as f:
+        f.write(b"more")
+    assert journal.completed(input_path, output_path, settings) is None
+
+
+def test_verify_checks_the_output_content(tmp_path):
+    journal, input_path, output_path, settings = finished(tmp_path, verify=True)
+    assert journal.entries[os.path.abspath(input_path), os.path.abspath(output_path)]["output_sha1"]
+    assert journal.completed(input_path, output_path, settings) is not None
+    # Same size and modification time, different bytes
+    stat = os.stat(output_path)
+    with open(output_path, "r+b") as f:
+        f.write(b"OUTPUT")
+    os.utime(output_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert BatchJournal(journal.path).completed(input_path, output_path, settings) is not None
+    assert BatchJournal(journal.path, verify=True).completed(input_path, output_path, settings) is None
+
+
+def test_unhashed_entries_are_redone_when_verifying(tmp_path):
+    journal, input_path, output_path, settings = finished(tmp_path)
+    assert BatchJournal(journal.path, verify=True).completed(input_path, output_path, settings) is None
+
+
+def test_cut_short_last_line_is_ignored(tmp_path):
+    journal, input_path, output_path, settings = finished(tmp_path)
+    with open(journal.path, "a") as f:
+        f.write(json.dumps({"input": "x"})[:5])
+    assert BatchJournal(journal.path).completed(input_path, output_path, settings) is not None
+
+
+def test_batch_resumes(tmp_path, make_las):
+    files = [make_las(f"t{i}.las", [1, 2, 3, i]) for i in range(4)]
+    options = BatchOptions(workers=1, output_dir=str(tmp_path / "out"), dimension="classification",
+                           output_format="las", unaffected="rewrite")
+    journal_path = str(tmp_path / "journal.jsonl")
+
+    summary = run_batch(files, [(1, 9)], options, journal=BatchJournal(journal_path))
+    assert (summary["succeeded"], summary["resumed"]) == (4, 0)
+    output = laspy.read(str(tmp_path / "out" / "t3_updated.las"))
+    assert np.array_equal(output.classification, [9, 2, 3, 3])
+
+    # Only the file that was removed is processed again
+    os.remove(str(tmp_path / "out" / "t2_updated.las"))
+    summary = run_batch(files, [(1, 9)], options, journal=BatchJournal(journal_path))
+    assert (summary["succeeded"], summary["resumed"]) == (1, 3)
+
+    # A different mapping redoes every file
+    summary = run_batch(files, [(1, 8)], options, journal=BatchJournal(journal_path))
+    assert (summary["succeeded"], summary["resumed"]) == (4, 0)
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the shared-filesystem work queue.
+
+@author: kenneyke
+"""
+
+import json
+import os
+import time
+
+import laspy
+import numpy as np
+
+from Ptc_Label_Queue import Lease, job_summary, reclaim_stale, run_worker, submit_job, task_id
+
+
+def test_workers_finish_the_job(tmp_path, make_las):
+    files = [make_las(f"t{i}.las", [1, 2, i]) for i in range(3)]
+    job_dir = str(tmp_path / "job")
+    submit_job(job_dir, files, [(1, 7)], output_dir=str(tmp_path / "out"), dimension="classification",
+               output_format="las")
+    assert run_worker(job_dir, worker_id="a", poll_interval=0.01) == 3
+    assert run_worker(job_dir, worker_id="b", poll_interval=0.01) == 0
+    summary = job_summary(job_dir)
+    assert (summary["succeeded"], summary["pending"], summary["leased"]) == (3, 0, 0)
+    output = laspy.read(str(tmp_path / "out" / "t2_updated.las"))
+    assert np.array_equal(output.classification, [7, 2, 2])
+
+
+def test_stale_lease_is_reclaimed(tmp_path, make_las):
+    files = [make_las(f"t{i}.las", [1, 2]) for i in range(2)]
+    job_dir = str(tmp_path / "job")
+    submit_job(job_dir, files, [(1, 7)], output_dir=str(tmp_path / "out"), dimension="classification",
+               output_format="las", lease_timeout=0.2)
+    # A worker that died holding the first file
+    with open(os.path.join(job_dir, "leases", f"{task_id(0)}.lease"), "w") as f:
+        json.dump({"worker": "dead"}, f)
+
+    assert run_worker(job_dir, worker_id="alive", poll_interval=0.05) == 2
+    assert not os.listdir(os.path.join(job_dir, "leases"))
+    assert job_summary(job_dir)["succeeded"] == 2
+
+
+def test_reclaim_waits_for_the_timeout(tmp_path):
+    lease_path = str(tmp_path / "task.lease")
+    lease = Lease.claim(lease_path, "worker", heartbeat=60)
+    try:
+        observed = {}
+        # First sighting only starts the clock
+        assert not reclaim_stale(lease_path, observed, 0.1)
+        assert not reclaim_stale(lease_path, observed, 60)
+        # A heartbeat (new modification time) restarts it
+        os.utime(lease_path, ns=(time.time_ns(), time.time_ns() + 10 ** 9))
+        time.sleep(0.15)
+        assert not reclaim_stale(lease_path, observed, 0.1)
+        time.sleep(0.15)
+        assert reclaim_stale(lease_path, observed, 0.1)
+        assert not os.path.exists(lease_path)
+        Lease.claim(lease_path, "other", heartbeat=60).release()
+    finally:
+        lease.stopped.set()
+
+
+def test_lease_is_exclusive(tmp_path):
+    lease_path = str(tmp_path / "task.lease")
+    lease = Lease.claim(lease_path, "a", heartbeat=60)
+    assert Lease.claim(lease_path, "b", heartbeat=60) is None
+    assert lease.held()
+    lease.release()
+    assert not os.path.exists(lease_path)
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the conditional relabel rules of the Point Cloud Label Changer.
+
+@author: kenneyke
+"""
+
+import numpy as np
+import pytest
+
+from Ptc_Label_Rules import ChunkColumns, Rule, RuleError, RuleSet, compile_condition
+
+
+def chunk():
+    # A structured array stands in for a laspy point chunk
+    points = np.zeros(6, dtype=[("x", "f8"), ("y", "f8"), ("classification", "u1"), ("Ext_Class", "u1")])
+    points["x"] = [0, 1, 2, 3, 4, 5]
+    points["y"] = [5, 4, 3, 2, 1, 0]
+    points["classification"] = [1, 2, 2, 3, 4, 2]
+    return points
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("classification == 2", [0, 1, 1, 0, 0, 1]),
+    ("classification in (1, 3)", [1, 0, 0, 1, 0, 0]),
+    ("classification not in (1, 3)", [0, 1, 1, 0, 1, 1]),
+    ("2 <= classification < 4", [0, 1, 1, 1, 0, 1]),
+    ("classification == 2 and x > 1", [0, 0, 1, 0, 0, 1]),
+    ("classification == 1 or y < 1", [1, 0, 0, 0, 0, 1]),
+    ("not classification == 2", [1, 0, 0, 1, 1, 0]),
+    ("bbox(1, 1, 3, 4)", [0, 1, 1, 1, 0, 0]),
+])
+def test_conditions(text, expected):
+    evaluate, _, _, _ = compile_condition(text)
+    assert evaluate(ChunkColumns(chunk(), {})).astype(int).tolist() == expected
+
+
+def test_dimensions_and_extent():
+    _, dimensions, regions, extent = compile_condition("classification == 2 and bbox(0, 0, 10, 10)")
+    assert dimensions == {"classification", "x", "y"}
+    assert not regions
+    assert tuple(extent({})) == (0, 0, 10, 10)
+    assert compile_condition("classification == 2")[3] is None
+
+
+@pytest.mark.parametrize("text", [
+    "1 == 1 and classification == 2",
+    "classification < 5 < 10",
+    "3 in (1, 2)",
+    "classification == ",
+    "classification in 3",
+    "len(x) > 2",
+    "classification + 1 == 2",
+])
+def test_invalid_conditions(text):
+    with pytest.raises(RuleError):
+        compile_condition(text)
+
+
+def test_rules_apply_in_order():
+    points = chunk()
+    rules = RuleSet([Rule.parse("Ext_Class = 7 where classification == 2"),
+                     Rule.parse("Ext_Class = 9 where Ext_Class == 7 and x > 2"),
+                     Rule.parse("classification = 0")])
+    assert rules.apply(points) == [3, 1, 6]
+    assert points["Ext_Class"].tolist() == [0, 7, 7, 0, 0, 9]
+    assert points["classification"].tolist() == [0] * 6
+
+
+def test_parse_errors():
+    with pytest.raises(RuleError):
+        Rule.parse("Ext_Class 7")
+    with pytest.raises(RuleError):
+        Rule.parse("Ext_Class = seven")
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the spatial regions of the Point Cloud Label Changer.
+
+@author: kenneyke
+"""
+
+import numpy as np
+import pytest
+
+from Ptc_Label_Spatial import DIRECT_POLYGONS, Region, parse_wkt, points_in_rings
+
+
+def random_polygons(rng, count):
+    # Star-shaped polygons, every third one with a hole
+    polygons = []
+    for k in range(count):
+        cx, cy = rng.uniform(0, 1000, 2)
+        radius = rng.uniform(5, 40)
+        angles = np.sort(rng.uniform(0, 2 * np.pi, rng.integers(3, 12)))
+        ring = np.c_[cx + radius * np.cos(angles), cy + radius * np.sin(angles)]
+        polygons.append([ring, cx + (ring - cx) * 0.3] if k % 3 == 0 else [ring])
+    return polygons
+
+
+@pytest.mark.parametrize("count", [1, DIRECT_POLYGONS, DIRECT_POLYGONS + 1, 300])
+def test_contains_matches_brute_force(count):
+    rng = np.random.default_rng(count)
+    region = Region("r", random_polygons(rng, count))
+    x, y = rng.uniform(-50, 1050, 200_000), rng.uniform(-50, 1050, 200_000)
+    expected = np.zeros(x.size, dtype=bool)
+    for polygon in region.polygons:
+        expected |= points_in_rings(x, y, polygon)
+    assert np.array_equal(region.contains(x, y), expected)
+
+
+def test_box_region():
+    region = Region.box("b", 0, 0, 10, 10)
+    assert region.contains(np.array([5.0, 11.0, -1.0]), np.array([5.0, 5.0, 5.0])).tolist() == [True, False, False]
+    assert region.contains(np.array([]), np.array([])).size == 0
+
+
+def test_parse_wkt_multipolygon():
+    polygons = parse_wkt("MULTIPOLYGON (((0 0, 4 0, 4 4, 0 4, 0 0), (1 1, 2 1, 2 2, 1 2, 1 1)), ((10 10, 12 10, 12 12, 10 10)))")
+    region = Region("w", polygons)
+    assert region.contains(np.array([0.5, 1.5, 11.5, 6.0]), np.array([0.5, 1.5, 10.5, 6.0])).tolist() == \
+        [True, False, True, False]